@@ -0,0 +1,138 @@
+"""
+Arcpy script to plot many rasters on one template map
+
+The template MXD is opened once and one raster layer is reused for every
+map: its data source is replaced by the next input, the symbology is only
+updated when it changes, and the map is exported to PNG. No map document
+copy or working geodatabase is created per map.
+
+The manifest is a CSV file with the columns:
+    input       raster path (relative to the manifest folder or absolute)
+    title       map title (replaces the map_title text of the template)
+    symbology   name of the layer file in Template/LYR, without .lyr (empty: keep the current symbology)
+    output      PNG name, without .png (empty: input name)
+
+The same manifest can be used by ArcPro_Python/batch_plot.py and
+Python_Local/batch_plot.py, which look up the symbology name in their own
+template folders.
+
+Author: Yun Si
+Last modified: 20261018
+Written for: ArcMap 10.7.1 & Python 2.7
+"""
+
+print("Initializing...")
+import os, sys, csv, traceback, time
+import arcpy
+
+
+########## ---------- Settings ---------- ##########
+# Environmental variables
+cwd = os.getcwd()
+overwrite = True
+
+# Input manifest
+in_manifest = os.path.join(cwd, "Input", "manifest.csv")
+
+# Input template map
+in_mxd = os.path.join(cwd, "Template", "MXD", "map.mxd")
+
+# Input template symbology folder
+sym_dir = os.path.join(cwd, "Template", "LYR")
+
+# Output directory
+out_png = os.path.join(cwd, "Output", "PNG")
+resolution = 300
+
+
+########## ---------- FUNCTIONS ---------- ##########
+def read_manifest(manifest_path):
+    """ Read the (input, title, symbology, output) rows of a manifest, with input paths made absolute """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    items = []
+    with open(manifest_path, "rb") as f:
+        for row in csv.DictReader(f):
+            in_tif = os.path.join(manifest_dir, row["input"].strip())
+            name = (row.get("output") or "").strip() or os.path.splitext(os.path.basename(in_tif))[0]
+            items.append((in_tif, (row.get("title") or "").strip(), (row.get("symbology") or "").strip(), name))
+    return items
+
+
+########## ---------- SYS CHECK ---------- ##########
+if not os.path.exists(out_png):
+    os.makedirs(out_png)
+arcpy.env.overwriteOutput = overwrite
+
+
+########## ---------- MAIN ---------- ##########
+try:
+
+    items = read_manifest(in_manifest)
+    print("Maps in manifest: {}".format(len(items)))
+
+    # Get template MXD (once)
+    mxd = arcpy.mapping.MapDocument(in_mxd)
+    main_df = arcpy.mapping.ListDataFrames(mxd, "Layers")[0]  # Main map in template mxd should be named "Layers"
+    # Template mxd should contain a text box with the text: map_title
+    title_elms = [elm for elm in arcpy.mapping.ListLayoutElements(mxd, "TEXT_ELEMENT") if elm.text == "map_title"]
+
+    # Processing
+    StartTime = time.time()
+    lyr = None
+    symbologies = {}  # layer files, read once per name
+    current_sym = None
+    failed = []
+    exported, skipped = 0, 0
+
+    for in_tif, title, sym_name, out_filename in items:
+        out_png_file = os.path.join(out_png, out_filename + ".png")
+        if os.path.exists(out_png_file) and not overwrite:
+            print("Skipping existing map: " + out_filename)
+            skipped += 1
+            continue
+
+        try:
+            print("Creating map: " + out_filename)
+
+            # Plot raster layer: add it for the first map, then replace its data source
+            if lyr is None:
+                arcpy.MakeRasterLayer_management(in_tif, "batch_raster")
+                arcpy.mapping.AddLayer(main_df, arcpy.mapping.Layer("batch_raster"), "TOP")
+                lyr = arcpy.mapping.ListLayers(mxd, "batch_raster", main_df)[0]
+            else:
+                lyr.replaceDataSource(os.path.dirname(in_tif), "RASTER_WORKSPACE", os.path.basename(in_tif))
+
+            # Symbology
+            if sym_name and sym_name != current_sym:
+                if sym_name not in symbologies:
+                    symbologies[sym_name] = arcpy.mapping.Layer(os.path.join(sym_dir, sym_name + ".lyr"))
+                arcpy.mapping.UpdateLayer(main_df, lyr, symbologies[sym_name], True)
+                current_sym = sym_name
+
+            # Zoom to layer
+            main_df.extent = lyr.getExtent()
+
+            # Update text
+            for elm in title_elms:
+                elm.text = title
+
+            # Export
+            arcpy.mapping.ExportToPNG(mxd, out_png_file, resolution=resolution)
+            exported += 1
+
+        except Exception:
+            print("Processing error: " + out_filename)
+            traceback.print_exc()
+            failed.append(out_filename)
+
+    arcpy.ResetEnvironments()
+
+    EndTime = time.time()
+    print("Completed {} maps in ~ {} seconds ({} existing maps skipped)".format(exported, round(EndTime - StartTime, 1),
+                                                                            skipped))
+    if failed:
+        print("Failed: " + ", ".join(failed))
+        sys.exit(1)
+
+except Exception:
+    traceback.print_exc()
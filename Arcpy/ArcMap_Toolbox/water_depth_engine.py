@@ -0,0 +1,273 @@
+"""
+Water depth-invariant index without arcpy
+
+Standalone implementation of water_depth_correction.py that runs on any
+platform with GDAL. The input raster is read block by block; the log of
+every band and all depth-invariant indices ln_i - (ki/kj) * ln_j are computed
+in one vectorized pass per block and written straight to the output, so no
+temporary rasters are created.
+
+Output bands follow the band composite of the toolbox script: the input
+bands first, then index_i_j for all i < j.
+
+The band statistics are read from an ArcGIS band collection statistics file,
+or computed from the log bands over a sample area (mask raster or polygons).
+
+Usage:
+    python water_depth_engine.py --stats stats.txt --input in.tif --output out.tif
+    python water_depth_engine.py --sample sand.shp --input in.tif --output out.tif
+"""
+
+import os, sys, argparse
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+
+##### BAND STATS #####
+def read_stats_file(in_stats_file):
+    """ Parse an ArcGIS band collection statistics file
+
+    Returns the variance of each band and the covariance matrix, for any
+    number of bands.
+    """
+    section = None
+    std, cov = {}, {}
+    with open(in_stats_file) as f:
+        for text in f:
+            if "STATISTICS of INDIVIDUAL LAYERS" in text:
+                section = "indiv"
+                continue
+            if "COVARIANCE MATRIX" in text:
+                section = "cov"
+                continue
+            if "=" in text or "MATRIX" in text:
+                section = None
+                continue
+            text_split = text.split()
+            if section is None or "#" in text or not text_split or not text_split[0].isdigit():
+                continue
+            layer = int(text_split[0])
+            if section == "indiv":
+                std[layer] = float(text_split[4])
+            else:
+                cov[layer] = [float(v) for v in text_split[1:]]
+    bands = sorted(std)
+    var = np.array([std[b] ** 2 for b in bands])
+    cov = np.array([cov[b][:len(bands)] for b in bands])
+    return var, cov
+
+
+def attenuation_ratios(var, cov):
+    """ Get the ratio of attenuation coefficients ki/kj for all band pairs i < j """
+    ratios = {}
+    n_bands = len(var)
+    for i in range(n_bands):
+        for j in range(i+1, n_bands):
+            a_ij = (var[i] - var[j]) / (2 * cov[i, j])
+            ratios[(i, j)] = a_ij + np.sqrt(a_ij * a_ij + 1)
+    return ratios
+
+
+##### DEPTH-INVARIANT INDEX #####
+def band_nodata(src):
+    """ Get the nodata value of every band of a dataset (None where not set) """
+    return [src.GetRasterBand(b+1).GetNoDataValue() for b in range(src.RasterCount)]
+
+
+def nodata_mask(block, nodata=None):
+    """ Get the pixels of a block (bands, rows, cols) equal to the nodata value of their band
+
+    nodata is a list with one value per band (None where not set). The
+    block is compared in its own data type, before any cast to float32.
+    """
+    mask = np.zeros(block.shape, dtype=bool)
+    for b, value in enumerate(nodata or []):
+        if value is not None:
+            mask[b] = block[b] == value
+    return mask
+
+
+def log_bands(block, nodata=None):
+    """ Get the log of a block (bands, rows, cols), NaN where not positive or nodata """
+    valid = (block > 0) & ~nodata_mask(block, nodata)
+    ln = np.full(block.shape, np.nan, dtype=np.float32)
+    np.log(block.astype(np.float32), out=ln, where=valid)
+    return ln
+
+
+def depth_invariant_block(block, ratios, nodata=None):
+    """ Get the input bands and all depth-invariant indices of a block (bands, rows, cols)
+
+    Pixels that are not positive (or equal to nodata) have no log and are
+    set to NaN in the indices. Nodata pixels are set to NaN in the input
+    bands too, as NaN is the nodata value of the output. nodata has one
+    value per band (see nodata_mask).
+    """
+    ln = log_bands(block, nodata)
+    mask = nodata_mask(block, nodata)
+    block = block.astype(np.float32)
+    block[mask] = np.nan
+    pairs = sorted(ratios)
+    i = np.array([p[0] for p in pairs], dtype=int)
+    j = np.array([p[1] for p in pairs], dtype=int)
+    k = np.array([ratios[p] for p in pairs], dtype=np.float32)[:, None, None]
+    return np.concatenate([block, ln[i] - k * ln[j]])
+
+
+def blocks(width, height, block_size):
+    """ Get (xoff, yoff, xsize, ysize) windows covering a raster """
+    for yoff in range(0, height, block_size):
+        for xoff in range(0, width, block_size):
+            yield xoff, yoff, min(block_size, width - xoff), min(block_size, height - yoff)
+
+
+def depth_invariant(in_raster_file, out_raster_file, ratios, block_size=512):
+    """ Write the input bands and depth-invariant indices of a raster to a tiled GeoTIFF """
+    src = gdal.Open(in_raster_file)
+    n_bands = src.RasterCount
+    nodata = band_nodata(src)
+    n_out = n_bands + len(ratios)
+    dst = gdal.GetDriverByName("GTiff").Create(out_raster_file, src.RasterXSize, src.RasterYSize, n_out,
+                                               gdal.GDT_Float32,
+                                               options=["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256",
+                                                        "COMPRESS=DEFLATE", "PREDICTOR=3", "BIGTIFF=IF_SAFER"])
+    dst.SetGeoTransform(src.GetGeoTransform())
+    dst.SetProjection(src.GetProjection())
+    names = ["band_{}".format(b+1) for b in range(n_bands)]
+    names += ["index_{}_{}".format(i+1, j+1) for i, j in sorted(ratios)]
+    for n, name in enumerate(names):
+        dst.GetRasterBand(n+1).SetDescription(name)
+        dst.GetRasterBand(n+1).SetNoDataValue(float("nan"))
+
+    for xoff, yoff, xsize, ysize in blocks(src.RasterXSize, src.RasterYSize, block_size):
+        block = src.ReadAsArray(xoff, yoff, xsize, ysize).reshape(n_bands, ysize, xsize)
+        out = depth_invariant_block(block, ratios, nodata)
+        for n in range(n_out):
+            dst.GetRasterBand(n+1).WriteArray(out[n], xoff, yoff)
+    dst.FlushCache()
+    dst = None
+    src = None
+
+
+##### SAMPLE STATS #####
+class BandStats(object):
+    """ Streaming mean and covariance of band values
+
+    Blocks of samples are merged into the running totals with the pairwise
+    form of Welford's algorithm (Chan et al.), which stays numerically
+    stable over many blocks without keeping the samples in memory.
+    """
+
+    def __init__(self, n_bands):
+        self.n = 0
+        self.mean = np.zeros(n_bands)
+        self.m2 = np.zeros((n_bands, n_bands))
+
+    def update(self, samples):
+        """ Add samples (n_samples, bands) """
+        n_b = len(samples)
+        if n_b == 0:
+            return
+        samples = np.asarray(samples, dtype=np.float64)
+        mean_b = samples.mean(axis=0)
+        d = samples - mean_b
+        delta = mean_b - self.mean
+        n = self.n + n_b
+        self.m2 += d.T.dot(d) + np.outer(delta, delta) * self.n * n_b / n
+        self.mean += delta * n_b / n
+        self.n = n
+
+    def cov(self, ddof=1):
+        return self.m2 / (self.n - ddof)
+
+    def var(self, ddof=1):
+        return np.diag(self.cov(ddof)).copy()
+
+
+def sample_masks(sample_file, src, windows):
+    """ Get the sample mask of each window of src from a mask raster or polygons
+
+    A mask raster must be on the grid of src, pixels that are non-zero and
+    not nodata are samples. Polygons are rasterized window by window.
+    """
+    sample = gdal.OpenEx(sample_file, gdal.OF_RASTER | gdal.OF_VECTOR)
+    if sample.RasterCount > 0:
+        if (sample.RasterXSize, sample.RasterYSize) != (src.RasterXSize, src.RasterYSize):
+            raise ValueError("{} does not match the size of the input raster".format(sample_file))
+        band = sample.GetRasterBand(1)
+        nodata = band.GetNoDataValue()
+        for xoff, yoff, xsize, ysize in windows:
+            mask = band.ReadAsArray(xoff, yoff, xsize, ysize)
+            yield (mask != 0) & (mask != nodata) if nodata is not None else mask != 0
+    else:
+        layer = sample.GetLayer(0)
+        gt = src.GetGeoTransform()
+        for xoff, yoff, xsize, ysize in windows:
+            mem = gdal.GetDriverByName("MEM").Create("", xsize, ysize, 1, gdal.GDT_Byte)
+            mem.SetGeoTransform((gt[0] + xoff * gt[1] + yoff * gt[2], gt[1], gt[2],
+                                 gt[3] + xoff * gt[4] + yoff * gt[5], gt[4], gt[5]))
+            mem.SetProjection(src.GetProjection())
+            gdal.RasterizeLayer(mem, [1], layer, burn_values=[1])
+            yield mem.GetRasterBand(1).ReadAsArray() != 0
+            mem = None
+    sample = None
+
+
+def sample_stats(in_raster_file, sample_file, block_size=512):
+    """ Get the variance of each log band and the covariance matrix over a sample mask or polygons
+
+    Only pixels where all bands have a log are used. Returns the same
+    (var, cov) as read_stats_file.
+    """
+    src = gdal.Open(in_raster_file)
+    n_bands = src.RasterCount
+    nodata = band_nodata(src)
+    windows = list(blocks(src.RasterXSize, src.RasterYSize, block_size))
+    stats = BandStats(n_bands)
+    for (xoff, yoff, xsize, ysize), mask in zip(windows, sample_masks(sample_file, src, windows)):
+        if not mask.any():
+            continue
+        block = src.ReadAsArray(xoff, yoff, xsize, ysize).reshape(n_bands, ysize, xsize)
+        ln = log_bands(block, nodata)[:, mask].T
+        stats.update(ln[~np.isnan(ln).any(axis=1)])
+    src = None
+    if stats.n < 2:
+        raise ValueError("{} covers fewer than 2 valid pixels".format(sample_file))
+    return stats.var(), stats.cov()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Water depth-invariant index (Edwards & Mumby, 1999)")
+    stats = parser.add_mutually_exclusive_group(required=True)
+    stats.add_argument('--stats', type=str, help="ArcGIS band collection statistics file")
+    stats.add_argument('--sample', type=str, help="mask raster or polygons of the sample area (e.g. sand)")
+    parser.add_argument('--input', '-i', type=str, required=True)
+    parser.add_argument('--output', '-o', type=str, required=True)
+    parser.add_argument('--block-size', type=int, default=512)
+    args = parser.parse_args()
+
+    for path in (args.stats or args.sample, args.input):
+        if not os.path.exists(path):
+            print(path + " does not exist. please try again...")
+            sys.exit(1)
+    if os.path.exists(args.output):
+        os.remove(args.output)
+
+    print("Getting band statistics...")
+    if args.stats:
+        var, cov = read_stats_file(args.stats)
+    else:
+        var, cov = sample_stats(args.input, args.sample, args.block_size)
+    ratios = attenuation_ratios(var, cov)
+    for (i, j), ki_kj in sorted(ratios.items()):
+        print("index_{}_{}: var_i {}, var_j {}, cov_ij {}, ki_kj {}".format(i+1, j+1, var[i], var[j], cov[i, j], ki_kj))
+
+    print("Calculating water depth-invariant index...")
+    depth_invariant(args.input, args.output, ratios, args.block_size)
+    print("Completed!")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Arcpy script to plot many rasters on one template map
+
+The template APRX is opened once and one raster layer is reused for every
+map: its data source is swapped to the next input, the symbology is only
+applied when it changes, and the layout is exported to PNG. No project copy
+or working geodatabase is created per map.
+
+The manifest is a CSV file with the columns:
+    input       raster path (relative to the manifest folder or absolute)
+    title       map title (replaces the map_title text of the template)
+    symbology   name of the layer file in Template/LYRX, without .lyrx (empty: keep the current symbology)
+    output      PNG name, without .png (empty: input name)
+
+The same manifest can be used by ArcMap_Python/batch_plot.py and
+Python_Local/batch_plot.py, which look up the symbology name in their own
+template folders.
+
+Author: Yun Si
+Last modified: 20261018
+Written for: ArcGIS Pro 3.1 & Python 3.9
+"""
+
+print("Initializing...")
+import os, sys, csv, copy, traceback, time
+import arcpy
+
+
+########## ---------- Settings ---------- ##########
+# Environmental variables
+cwd = os.getcwd()
+overwrite = True
+
+# Input manifest
+in_manifest = os.path.join(cwd, "Input", "manifest.csv")
+
+# Input template map
+in_aprx = os.path.join(cwd, "Template", "APRX", "map.aprx")
+
+# Input template symbology folder
+sym_dir = os.path.join(cwd, "Template", "LYRX")
+
+# Output directory
+out_png = os.path.join(cwd, "Output", "PNG")
+resolution = 300
+
+
+########## ---------- FUNCTIONS ---------- ##########
+def read_manifest(manifest_path):
+    """ Read the (input, title, symbology, output) rows of a manifest, with input paths made absolute """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    items = []
+    with open(manifest_path, newline="") as f:
+        for row in csv.DictReader(f):
+            in_tif = os.path.join(manifest_dir, row["input"].strip())
+            name = (row.get("output") or "").strip() or os.path.splitext(os.path.basename(in_tif))[0]
+            items.append((in_tif, (row.get("title") or "").strip(), (row.get("symbology") or "").strip(), name))
+    return items
+
+
+def set_data_source(lyr, tif_path):
+    """ Point a raster layer to another raster file """
+    old_conn = lyr.connectionProperties
+    new_conn = copy.deepcopy(old_conn)
+    new_conn["connection_info"]["database"] = os.path.dirname(tif_path)
+    new_conn["dataset"] = os.path.basename(tif_path)
+    lyr.updateConnectionProperties(old_conn, new_conn)
+
+
+########## ---------- SYS CHECK ---------- ##########
+if not os.path.exists(out_png):
+    os.makedirs(out_png)
+arcpy.env.overwriteOutput = overwrite
+
+
+########## ---------- MAIN ---------- ##########
+try:
+
+    items = read_manifest(in_manifest)
+    print("Maps in manifest: {}".format(len(items)))
+
+    # Get template APRX (once)
+    aprx = arcpy.mp.ArcGISProject(in_aprx)
+    m = aprx.listMaps()[0]
+    lyt = aprx.listLayouts()[0]
+    mf = lyt.listElements("MAPFRAME_ELEMENT", "*")[0]
+    # Template aprx should contain a text box with the text: map_title
+    title_elms = [elm for elm in lyt.listElements("TEXT_ELEMENT") if elm.text == "map_title"]
+
+    # Processing
+    StartTime = time.time()
+    lyr = None
+    symbologies = {}  # layer file symbology, read once per name
+    current_sym = None
+    failed = []
+    exported, skipped = 0, 0
+
+    for in_tif, title, sym_name, out_filename in items:
+        out_png_file = os.path.join(out_png, out_filename + ".png")
+        if os.path.exists(out_png_file) and not overwrite:
+            print("Skipping existing map: " + out_filename)
+            skipped += 1
+            continue
+
+        try:
+            print("Creating map: " + out_filename)
+
+            # Plot raster layer: add it for the first map, then swap its data source
+            if lyr is None:
+                lyr = m.addDataFromPath(in_tif)
+            else:
+                set_data_source(lyr, in_tif)
+
+            # Symbology
+            if sym_name and sym_name != current_sym:
+                if sym_name not in symbologies:
+                    sym_file = arcpy.mp.LayerFile(os.path.join(sym_dir, sym_name + ".lyrx"))
+                    symbologies[sym_name] = sym_file.listLayers()[0].symbology
+                lyr.symbology = symbologies[sym_name]
+                current_sym = sym_name
+
+            # Zoom to layer
+            mf.camera.setExtent(mf.getLayerExtent(lyr, True, True))
+
+            # Update text
+            for elm in title_elms:
+                elm.text = title
+
+            # Export
+            lyt.exportToPNG(out_png_file, resolution=resolution)
+            exported += 1
+
+        except Exception:
+            print("Processing error: " + out_filename)
+            traceback.print_exc()
+            failed.append(out_filename)
+
+    arcpy.ResetEnvironments()
+
+    EndTime = time.time()
+    print("Completed {} maps in ~ {} seconds ({} existing maps skipped)".format(exported, round(EndTime - StartTime, 1),
+                                                                            skipped))
+    if failed:
+        print("Failed: " + ", ".join(failed))
+        sys.exit(1)
+
+except Exception:
+    traceback.print_exc()
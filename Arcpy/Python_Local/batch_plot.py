@@ -0,0 +1,177 @@
+"""
+Plot many rasters as PNG maps without arcpy
+
+Linux counterpart of ArcPro_Python/batch_plot.py and ArcMap_Python/batch_plot.py
+(requires GDAL and matplotlib). It reads the same manifest, with the
+symbology names looked up as JSON colormap specs in Template/JSON instead of
+layer files. Each worker builds the map figure once and redraws it for every
+raster. Rasters are read at the output resolution, so large rasters are read
+from their overviews.
+
+The manifest is a CSV file with the columns:
+    input       raster path (relative to the manifest folder or absolute)
+    title       map title
+    symbology   name of the colormap spec in the symbology folder, without .json (empty: default stretch)
+    output      PNG name, without .png (empty: input name)
+
+The colormap specs are described in helper/symbology.py (example:
+Template/JSON/raster.json).
+
+Usage:
+    python batch_plot.py --manifest Input/manifest.csv
+    python batch_plot.py --manifest Input/manifest.csv --output Output/PNG --dpi 300 --workers 4
+"""
+
+import os, csv, argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from osgeo import gdal
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import ListedColormap, BoundaryNorm, to_rgba
+from matplotlib.patches import Patch
+
+import helper.symbology as symbology
+
+gdal.UseExceptions()
+
+_plotter = None
+
+
+def read_manifest(manifest_path):
+    """ Read the (input, title, symbology, output) rows of a manifest, with input paths made absolute """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    items = []
+    with open(manifest_path, newline="") as f:
+        for row in csv.DictReader(f):
+            in_tif = os.path.join(manifest_dir, row["input"].strip())
+            name = (row.get("output") or "").strip() or os.path.splitext(os.path.basename(in_tif))[0]
+            items.append((in_tif, (row.get("title") or "").strip(), (row.get("symbology") or "").strip(), name))
+    return items
+
+
+def read_raster(tif_path, bands, max_size):
+    """ Read bands as a masked array (bands, rows, cols) of at most max_size pixels per side, and its extent """
+    ds = gdal.Open(tif_path)
+    gt = ds.GetGeoTransform()
+    scale = min(1.0, float(max_size) / max(ds.RasterXSize, ds.RasterYSize))
+    xsize, ysize = max(1, int(round(ds.RasterXSize * scale))), max(1, int(round(ds.RasterYSize * scale)))
+    arrays = []
+    for b in bands:
+        band = ds.GetRasterBand(b)
+        array = band.ReadAsArray(buf_xsize=xsize, buf_ysize=ysize).astype(np.float64)
+        nodata = band.GetNoDataValue()
+        mask = ~np.isfinite(array)
+        if nodata is not None:
+            mask |= array == nodata
+        arrays.append(np.ma.masked_array(array, mask))
+    extent = (gt[0], gt[0] + ds.RasterXSize * gt[1], gt[3] + ds.RasterYSize * gt[5], gt[3])
+    return np.ma.stack(arrays), extent
+
+
+class MapPlotter(object):
+    """ Map figure (title, map, colorbar or legend) built once and redrawn for every raster """
+
+    def __init__(self, width=8, height=8, dpi=150):
+        self.dpi = dpi
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0.1, 0.08, 0.72, 0.82])
+        self.cax = self.fig.add_axes([0.85, 0.2, 0.03, 0.6])
+        self.title = self.fig.suptitle("")
+        self.max_size = int(max(width, height) * dpi)
+
+    def render(self, tif_path, title, spec, out_png_file):
+        kind = spec.get("type", "stretch")
+        array, extent = read_raster(tif_path, symbology.spec_bands(spec), self.max_size)
+        alpha = 1 - spec.get("transparency", 0) / 100.0
+        self.ax.cla()
+        self.cax.cla()
+        self.cax.set_visible(False)
+
+        if kind == "rgb":
+            rgba = symbology.colorize(array, symbology.resolve_spec(spec, array))
+            self.ax.imshow(rgba, extent=extent, interpolation="nearest")
+
+        elif kind == "classified":
+            classes = sorted(spec["classes"], key=lambda c: c["value"])
+            values = [c["value"] for c in classes]
+            cmap = ListedColormap([to_rgba(c["color"]) for c in classes])
+            norm = BoundaryNorm(np.append(np.array(values) - 0.5, values[-1] + 0.5), cmap.N)
+            data = np.ma.masked_where(~np.isin(array[0], values), array[0])
+            self.ax.imshow(data, extent=extent, cmap=cmap, norm=norm, alpha=alpha, interpolation="nearest")
+            handles = [Patch(color=c["color"], label=c.get("label", str(c["value"]))) for c in classes]
+            self.ax.legend(handles=handles, loc="upper left", bbox_to_anchor=(1.02, 1), frameon=False)
+
+        else:
+            low, high = symbology.stretch_range(array[0], spec)
+            image = self.ax.imshow(array[0], extent=extent, cmap=symbology.get_colormap(spec), vmin=low, vmax=high,
+                                   alpha=alpha, interpolation="nearest")
+            self.cax.set_visible(True)
+            colorbar = self.fig.colorbar(image, cax=self.cax)
+            colorbar.set_label(spec.get("label", ""))
+
+        self.ax.set_xlim(extent[0], extent[1])
+        self.ax.set_ylim(extent[2], extent[3])
+        self.ax.ticklabel_format(useOffset=False, style="plain")
+        self.ax.tick_params(labelsize=7)
+        self.title.set_text(title)
+        self.fig.savefig(out_png_file, dpi=self.dpi)
+
+
+def init_plotter(width, height, dpi):
+    """ Process pool initializer: build the map figure once per worker """
+    global _plotter
+    _plotter = MapPlotter(width, height, dpi)
+
+
+def plot_item(task):
+    """ Render one manifest item: task is (in_tif, title, spec, out_png_file), returns the error or None """
+    in_tif, title, spec, out_png_file = task
+    try:
+        _plotter.render(in_tif, title, spec, out_png_file)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--manifest', '-m', type=str, default=os.path.join("Input", "manifest.csv"))
+    parser.add_argument('--symbology-dir', type=str, default=os.path.join("Template", "JSON"))
+    parser.add_argument('--output', '-o', type=str, default=os.path.join("Output", "PNG"))
+    parser.add_argument('--width', type=float, default=8, help="in inches")
+    parser.add_argument('--height', type=float, default=8, help="in inches")
+    parser.add_argument('--dpi', type=int, default=150)
+    parser.add_argument('--workers', '-w', type=int, default=1)
+    parser.add_argument('--no-overwrite', action='store_true', help="skip maps whose PNG exists")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    specs = {}
+    tasks = []
+    for in_tif, title, sym_name, out_filename in read_manifest(args.manifest):
+        out_png_file = os.path.join(args.output, out_filename + ".png")
+        if args.no_overwrite and os.path.exists(out_png_file):
+            continue
+        if sym_name not in specs:
+            specs[sym_name] = symbology.read_spec(os.path.join(args.symbology_dir, sym_name + ".json") if sym_name else None)
+        tasks.append((in_tif, title, specs[sym_name], out_png_file))
+    print("Maps to plot:", len(tasks))
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers, initializer=init_plotter,
+                                 initargs=(args.width, args.height, args.dpi)) as executor:
+            errors = list(executor.map(plot_item, tasks, chunksize=8))
+    else:
+        init_plotter(args.width, args.height, args.dpi)
+        errors = [plot_item(task) for task in tasks]
+
+    failed = [(task[3], error) for task, error in zip(tasks, errors) if error]
+    for out_png_file, error in failed:
+        print("Failed:", out_png_file, error)
+    print("COMPLETED! {} / {} maps".format(len(tasks) - len(failed), len(tasks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Web mercator tile pyramid
+
+The raster is warped (as a VRT) to EPSG:3857 on the tile grid of the
+highest zoom level, so every tile of that level is a 256 x 256 window of the
+VRT. Tiles of the lower zoom levels are overviews built from their 4
+children, not from the raster.
+
+Every tile has a content hash: the hash of its data and colormap spec on the
+highest zoom level, the hash of the children hashes below. The hashes are
+kept with the tiles, so a re-run only renders the tiles whose hash changed
+and only rebuilds the overviews above them.
+"""
+
+import io
+import os
+import math
+import sqlite3
+import hashlib
+
+import numpy as np
+from osgeo import gdal
+from PIL import Image
+
+from . import symbology
+
+gdal.UseExceptions()
+
+TILE_SIZE = 256
+ORIGIN = 20037508.342789244  # half of the web mercator extent, in m
+EMPTY = "empty"  # hash of tiles without valid pixels, which are not stored
+
+_datasets = {}
+_stores = {}
+
+
+##### TILE GRID #####
+def tile_span(z):
+    """ Get the size of a tile of zoom level z, in m """
+    return 2 * ORIGIN / 2 ** z
+
+
+def zoom_for_resolution(resolution):
+    """ Get the lowest zoom level with pixels smaller than resolution (m) """
+    return max(0, int(math.ceil(math.log(tile_span(0) / TILE_SIZE / resolution, 2) - 1e-9)))
+
+
+def tile_range(bounds, z):
+    """ Get the (xmin, ymin, xmax, ymax) XYZ tile indices (inclusive) covering bounds (xmin, ymin, xmax, ymax) in m """
+    span = tile_span(z)
+    n = 2 ** z - 1
+    x0 = min(max(int(math.floor((bounds[0] + ORIGIN) / span)), 0), n)
+    x1 = min(max(int(math.ceil((bounds[2] + ORIGIN) / span)) - 1, x0), n)
+    y0 = min(max(int(math.floor((ORIGIN - bounds[3]) / span)), 0), n)
+    y1 = min(max(int(math.ceil((ORIGIN - bounds[1]) / span)) - 1, y0), n)
+    return x0, y0, x1, y1
+
+
+def tile_bounds(z, x, y):
+    """ Get the (xmin, ymin, xmax, ymax) of a tile, in m """
+    span = tile_span(z)
+    return -ORIGIN + x * span, ORIGIN - (y + 1) * span, -ORIGIN + (x + 1) * span, ORIGIN - y * span
+
+
+##### WARP #####
+def warp(in_tif, vrt_path, max_zoom=None, resampling="bilinear"):
+    """ Warp a raster to a VRT on the tile grid of max_zoom (default: the raster resolution)
+
+    Returns (max_zoom, (x0, y0, x1, y1) tile range of max_zoom). The VRT
+    has an alpha band for the valid pixels.
+    """
+    probe = gdal.Warp("", in_tif, format="VRT", dstSRS="EPSG:3857")
+    gt = probe.GetGeoTransform()
+    bounds = (gt[0], gt[3] + probe.RasterYSize * gt[5], gt[0] + probe.RasterXSize * gt[1], gt[3])
+    if max_zoom is None:
+        max_zoom = zoom_for_resolution(gt[1])
+    probe = None
+    x0, y0, x1, y1 = tile_range(bounds, max_zoom)
+    xmin, ymax = tile_bounds(max_zoom, x0, y0)[0], tile_bounds(max_zoom, x0, y0)[3]
+    xmax, ymin = tile_bounds(max_zoom, x1, y1)[2], tile_bounds(max_zoom, x1, y1)[1]
+    resolution = tile_span(max_zoom) / TILE_SIZE
+    gdal.Warp(vrt_path, in_tif, format="VRT", dstSRS="EPSG:3857", outputBounds=(xmin, ymin, xmax, ymax),
+              xRes=resolution, yRes=resolution, resampleAlg=resampling, dstAlpha=True)
+    return max_zoom, (x0, y0, x1, y1)
+
+
+def read_masked(ds, bands, xoff=0, yoff=0, xsize=None, ysize=None, buf_xsize=None, buf_ysize=None):
+    """ Read bands of a warped VRT as a masked array (bands, rows, cols), masked where alpha is 0 or nodata """
+    xsize = ds.RasterXSize if xsize is None else xsize
+    ysize = ds.RasterYSize if ysize is None else ysize
+    window = dict(xoff=xoff, yoff=yoff, win_xsize=xsize, win_ysize=ysize, buf_xsize=buf_xsize, buf_ysize=buf_ysize)
+    alpha = ds.GetRasterBand(ds.RasterCount).ReadAsArray(**window)
+    arrays = []
+    for b in bands:
+        band = ds.GetRasterBand(b)
+        array = band.ReadAsArray(**window).astype(np.float64)
+        mask = (alpha == 0) | ~np.isfinite(array)
+        if band.GetNoDataValue() is not None:
+            mask |= array == band.GetNoDataValue()
+        arrays.append(np.ma.masked_array(array, mask))
+    return np.ma.stack(arrays)
+
+
+##### RENDERING #####
+def open_cached(path):
+    """ Open a dataset once per process """
+    if path not in _datasets:
+        _datasets[path] = gdal.Open(path)
+    return _datasets[path]
+
+
+def open_store(path):
+    """ Open a tile store read-only once per process """
+    if path not in _stores:
+        _stores[path] = TileStore(path, readonly=True)
+    return _stores[path]
+
+
+def init_worker():
+    """ Process pool initializer: forget the datasets and stores inherited from the parent
+
+    Forked workers would share the file offsets of the parent's handles, so
+    every worker opens its own.
+    """
+    _datasets.clear()
+    _stores.clear()
+
+
+def close_cached():
+    _datasets.clear()
+    for store in _stores.values():
+        store.close()
+    _stores.clear()
+
+
+def encode_png(rgba):
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def decode_png(data):
+    if data is None:
+        return np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGBA"))
+
+
+def spec_hash(spec):
+    return hashlib.sha1(repr(sorted(spec.items())).encode()).hexdigest()
+
+
+def render_tile(task):
+    """ Render a tile of the highest zoom level: task is (z, x, y, vrt_path, (x0, y0), spec, old_hash)
+
+    Returns (z, x, y, hash, png): png is None if the hash did not change or
+    the tile is empty.
+    """
+    z, x, y, vrt_path, (x0, y0), spec, old_hash = task
+    ds = open_cached(vrt_path)
+    array = read_masked(ds, symbology.spec_bands(spec), (x - x0) * TILE_SIZE, (y - y0) * TILE_SIZE,
+                        TILE_SIZE, TILE_SIZE)
+    mask = np.ma.getmaskarray(array)
+    if mask.all():
+        return z, x, y, EMPTY, None
+    digest = hashlib.sha1(np.ascontiguousarray(array.filled(0)).tobytes())
+    digest.update(np.packbits(mask).tobytes())
+    digest.update(spec_hash(spec).encode())
+    tile_hash = digest.hexdigest()
+    if tile_hash == old_hash:
+        return z, x, y, tile_hash, None
+    return z, x, y, tile_hash, encode_png(symbology.colorize(array, spec))
+
+
+def overview_hash(child_hashes):
+    """ Get the hash of an overview tile from the hashes of its 4 children (None where missing) """
+    hashes = [h or EMPTY for h in child_hashes]
+    if all(h == EMPTY for h in hashes):
+        return EMPTY
+    return hashlib.sha1("".join(hashes).encode()).hexdigest()
+
+
+def child_tiles(x, y):
+    """ Get the (x, y) of the 4 children of a tile: (top left, top right, bottom left, bottom right) """
+    return [(2 * x, 2 * y), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)]
+
+
+def render_overview(task):
+    """ Render an overview tile from its children: task is (z, x, y, store path, nearest)
+
+    The children are read from the store by the worker, so only the tiles
+    being rendered are in memory. Classified rasters are downsampled by
+    nearest neighbour, the others by averaging with alpha weights. Returns
+    (z, x, y, png).
+    """
+    z, x, y, store_path, nearest = task
+    store = open_store(store_path)
+    mosaic = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 4), dtype=np.uint8)
+    for k, (cx, cy) in enumerate(child_tiles(x, y)):
+        row, col = divmod(k, 2)
+        data = store.read(z + 1, cx, cy)
+        mosaic[row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE] = decode_png(data)
+    if nearest:
+        rgba = mosaic[::2, ::2]
+    else:
+        blocks = mosaic.reshape(TILE_SIZE, 2, TILE_SIZE, 2, 4).astype(np.float64)
+        alpha = blocks[..., 3:]
+        weight = alpha.sum(axis=(1, 3))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rgb = np.where(weight > 0, (blocks[..., :3] * alpha).sum(axis=(1, 3)) / weight, 0)
+        rgba = np.round(np.concatenate([rgb, weight / 4], axis=-1)).astype(np.uint8)
+    return z, x, y, encode_png(np.ascontiguousarray(rgba))
+
+
+##### OUTPUT #####
+class TileStore(object):
+    """ XYZ folder (z/x/y.png) or MBTiles file, with the content hash of every tile in SQLite
+
+    The hashes of an XYZ folder are kept in hashes.db inside it, those of an
+    MBTiles file in its tile_hashes table. MBTiles are written in WAL mode,
+    so that workers can read committed tiles (readonly stores) while the
+    next zoom level is written.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.mbtiles = path.lower().endswith(".mbtiles")
+        self.readonly = readonly
+        if readonly:
+            self.db = sqlite3.connect("file:{}?mode=ro".format(path if self.mbtiles else os.path.join(path, "hashes.db")),
+                                      uri=True, timeout=60)
+            return
+        if self.mbtiles:
+            self.db = sqlite3.connect(path, timeout=60)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, "
+                            "tile_row INTEGER, tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))")
+        else:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.db = sqlite3.connect(os.path.join(path, "hashes.db"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS tile_hashes (z INTEGER, x INTEGER, y INTEGER, hash TEXT, "
+                        "PRIMARY KEY (z, x, y))")
+
+    def hashes(self, z):
+        """ Get the {(x, y): hash} of a zoom level """
+        rows = self.db.execute("SELECT x, y, hash FROM tile_hashes WHERE z = ?", (z,))
+        return {(x, y): h for x, y, h in rows}
+
+    def zooms(self):
+        """ Get the zoom levels with stored hashes """
+        return [z for z, in self.db.execute("SELECT DISTINCT z FROM tile_hashes")]
+
+    def prune(self, z, keep):
+        """ Remove the tiles and hashes of zoom level z that are not in keep ({(x, y)}) """
+        for x, y in set(self.hashes(z)) - set(keep):
+            if self.mbtiles:
+                self.db.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                (z, x, 2 ** z - 1 - y))
+            elif os.path.exists(self.tile_file(z, x, y)):
+                os.remove(self.tile_file(z, x, y))
+            self.db.execute("DELETE FROM tile_hashes WHERE z = ? AND x = ? AND y = ?", (z, x, y))
+
+    def tile_file(self, z, x, y):
+        return os.path.join(self.path, str(z), str(x), "{}.png".format(y))
+
+    def read(self, z, x, y):
+        """ Get the png of a tile, None if it is not stored """
+        if self.mbtiles:
+            row = self.db.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                  (z, x, 2 ** z - 1 - y)).fetchone()
+            return bytes(row[0]) if row else None
+        tile_file = self.tile_file(z, x, y)
+        if not os.path.exists(tile_file):
+            return None
+        with open(tile_file, "rb") as f:
+            return f.read()
+
+    def exists(self, z, x, y):
+        if self.mbtiles:
+            return self.db.execute("SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                   (z, x, 2 ** z - 1 - y)).fetchone() is not None
+        return os.path.exists(self.tile_file(z, x, y))
+
+    def write(self, z, x, y, tile_hash, png):
+        """ Store a tile and its hash, png None removes the tile (empty tile) """
+        if self.mbtiles:
+            self.db.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                            (z, x, 2 ** z - 1 - y))
+            if png is not None:
+                self.db.execute("INSERT INTO tiles VALUES (?, ?, ?, ?)", (z, x, 2 ** z - 1 - y, sqlite3.Binary(png)))
+        else:
+            tile_file = self.tile_file(z, x, y)
+            if png is not None:
+                if not os.path.exists(os.path.dirname(tile_file)):
+                    os.makedirs(os.path.dirname(tile_file))
+                with open(tile_file + ".tmp", "wb") as f:
+                    f.write(png)
+                os.replace(tile_file + ".tmp", tile_file)
+            elif os.path.exists(tile_file):
+                os.remove(tile_file)
+        self.db.execute("INSERT OR REPLACE INTO tile_hashes VALUES (?, ?, ?, ?)", (z, x, y, tile_hash))
+
+    def set_metadata(self, metadata):
+        if self.mbtiles:
+            self.db.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                                [(k, str(v)) for k, v in metadata.items()])
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        if not self.readonly:
+            self.db.commit()
+            if self.mbtiles:
+                self.db.execute("PRAGMA journal_mode=DELETE")  # single file MBTiles
+        self.db.close()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Colormap specs
+
+JSON equivalent of the lyr / lyrx symbology of the arcpy scripts, shared by
+batch_plot.py and make_tiles.py. "type" is one of:
+    stretch     "band", "min" / "max" (default: "percent_clip" [2, 98]), "colormap" (matplotlib name or
+                list of colors), "label" (colorbar title)
+    classified  "band", "classes": [{"value", "color", "label"}]
+    rgb         "bands" [r, g, b], "min" / "max" per band (default: "percent_clip" [2, 98])
+and all types take "transparency" (0-100, as in ArcGIS).
+"""
+
+import json
+
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.colors import LinearSegmentedColormap, to_rgba
+
+DEFAULT_SPEC = {"type": "stretch", "band": 1, "percent_clip": [2, 98], "colormap": "viridis"}
+
+
+def read_spec(spec_path):
+    """ Read a colormap spec, DEFAULT_SPEC if spec_path is empty """
+    if not spec_path:
+        return dict(DEFAULT_SPEC)
+    with open(spec_path) as f:
+        return json.load(f)
+
+
+def spec_bands(spec):
+    """ Get the band numbers used by a spec """
+    return spec.get("bands", [1, 2, 3]) if spec.get("type") == "rgb" else [spec.get("band", 1)]
+
+
+def get_colormap(spec):
+    colormap = spec.get("colormap", "viridis")
+    if isinstance(colormap, list):
+        return LinearSegmentedColormap.from_list("spec", colormap)
+    return colormaps[colormap]
+
+
+def stretch_range(array, spec):
+    """ Get the (min, max) of a stretch: from the spec or a percent clip of the valid values """
+    if "min" in spec and "max" in spec:
+        return spec["min"], spec["max"]
+    values = array.compressed()
+    if not len(values):
+        return 0, 1
+    low, high = np.percentile(values, spec.get("percent_clip", [2, 98]))
+    return spec.get("min", low), spec.get("max", high)
+
+
+def resolve_spec(spec, array):
+    """ Get a copy of a spec with the stretch min / max of the masked array (bands, rows, cols)
+
+    Tiles of a raster are colorized separately, so percent clips are
+    resolved once (e.g. on an overview) for the whole raster.
+    """
+    spec = dict(spec)
+    kind = spec.get("type", "stretch")
+    if kind == "rgb" and not ("min" in spec and "max" in spec):
+        ranges = [stretch_range(array[k], spec) for k in range(3)]
+        spec["min"], spec["max"] = [float(r[0]) for r in ranges], [float(r[1]) for r in ranges]
+    elif kind == "stretch":
+        spec["min"], spec["max"] = [float(v) for v in stretch_range(array[0], spec)]
+    return spec
+
+
+def colorize(array, spec):
+    """ Get the RGBA (rows, cols, 4) uint8 colors of a masked array (bands, rows, cols) with a resolved spec """
+    kind = spec.get("type", "stretch")
+    alpha = 1 - spec.get("transparency", 0) / 100.0
+    mask = np.ma.getmaskarray(array).any(axis=0)
+    rgba = np.zeros(array.shape[1:] + (4,))
+
+    if kind == "rgb":
+        for k in range(3):
+            low, high = spec["min"][k], spec["max"][k]
+            rgba[..., k] = np.clip((array[k].filled(low) - low) / float(high - low or 1), 0, 1)
+        rgba[..., 3] = alpha
+
+    elif kind == "classified":
+        values = array[0].filled(0)
+        unclassified = np.ones(values.shape, dtype=bool)
+        for c in spec["classes"]:
+            selected = values == c["value"]
+            rgba[selected] = to_rgba(c["color"])
+            unclassified &= ~selected
+        rgba[..., 3] *= alpha
+        mask |= unclassified
+
+    else:
+        low, high = spec["min"], spec["max"]
+        rgba[:] = get_colormap(spec)(np.clip((array[0].filled(low) - low) / float(high - low or 1), 0, 1))
+        rgba[..., 3] *= alpha
+
+    rgba[mask] = 0
+    return np.round(rgba * 255).astype(np.uint8)
@@ -0,0 +1,121 @@
+"""
+Web mercator XYZ tiles / MBTiles of a raster
+
+Tile pyramid of the raster and symbology plotted by batch_plot.py, for web
+viewers (requires GDAL, matplotlib & Pillow). Tiles of the highest zoom
+level are rendered in a process pool and the lower zoom levels are built
+from them. On re-runs, tiles whose content hash did not change are skipped
+and only the overviews above changed tiles are rebuilt. Tiles left from an
+earlier run with a larger extent or other zoom levels are removed.
+
+Usage:
+    python make_tiles.py --input raster.tif --symbology Template/JSON/raster.json --output Output/Tiles
+    python make_tiles.py --input raster.tif --symbology Template/JSON/raster.json --output raster.mbtiles --min-zoom 8
+"""
+
+import os, time, argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import helper.pyramid as pyramid
+import helper.symbology as symbology
+
+
+def run(fn, tasks, executor):
+    """ Map fn over tasks in the executor, or serially without one """
+    if executor is None:
+        return map(fn, tasks)
+    return executor.map(fn, tasks, chunksize=16)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--input', '-i', type=str, required=True)
+    parser.add_argument('--symbology', '-s', type=str, default=None, help="colormap spec (json), default: stretch")
+    parser.add_argument('--output', '-o', type=str, required=True, help="XYZ folder or .mbtiles file")
+    parser.add_argument('--min-zoom', type=int, default=None, help="default: one tile for the whole raster")
+    parser.add_argument('--max-zoom', type=int, default=None, help="default: raster resolution")
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    StartTime = time.time()
+
+    spec = symbology.read_spec(args.symbology)
+    nearest = spec.get("type") == "classified"
+    store = pyramid.TileStore(args.output)
+    vrt_path = os.path.splitext(args.output)[0] + ".warp.vrt"
+    executor = ProcessPoolExecutor(args.workers, initializer=pyramid.init_worker) if args.workers > 1 else None
+    try:
+        max_zoom, (x0, y0, x1, y1) = pyramid.warp(args.input, vrt_path, args.max_zoom, "near" if nearest else "bilinear")
+        ds = pyramid.open_cached(vrt_path)
+        # Percent clips are resolved once for the whole raster, on an overview
+        scale = min(1.0, 1024.0 / max(ds.RasterXSize, ds.RasterYSize))
+        overview = pyramid.read_masked(ds, symbology.spec_bands(spec), buf_xsize=max(1, int(ds.RasterXSize * scale)),
+                                       buf_ysize=max(1, int(ds.RasterYSize * scale)))
+        spec = symbology.resolve_spec(spec, overview)
+        min_zoom = args.min_zoom
+        if min_zoom is None:
+            min_zoom = max(0, max_zoom - max(x1 - x0, y1 - y0).bit_length())
+        print("Zoom levels: {} - {}".format(min_zoom, max_zoom))
+
+        # Highest zoom level
+        old = store.hashes(max_zoom)
+        tasks = []
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                old_hash = old.get((x, y))
+                if old_hash != pyramid.EMPTY and not store.exists(max_zoom, x, y):
+                    old_hash = None
+                tasks.append((max_zoom, x, y, vrt_path, (x0, y0), spec, old_hash))
+        hashes, changed = {}, 0
+        kept = {}
+        for z, x, y, tile_hash, png in run(pyramid.render_tile, tasks, executor):
+            hashes[(x, y)] = tile_hash
+            if tile_hash != old.get((x, y)) or png is not None:
+                store.write(z, x, y, tile_hash, png)
+                changed += 1
+        store.commit()
+        kept[max_zoom] = set(hashes)
+        print("Zoom {}: {} tiles, {} updated".format(max_zoom, len(tasks), changed))
+
+        # Overviews
+        for z in range(max_zoom - 1, min_zoom - 1, -1):
+            old = store.hashes(z)
+            parents = sorted(set((x // 2, y // 2) for x, y in hashes))
+            child_hashes = {}
+            tasks = []
+            for x, y in parents:
+                tile_hash = pyramid.overview_hash([hashes.get(c) for c in pyramid.child_tiles(x, y)])
+                child_hashes[(x, y)] = tile_hash
+                if tile_hash == old.get((x, y)) and (tile_hash == pyramid.EMPTY or store.exists(z, x, y)):
+                    continue
+                if tile_hash == pyramid.EMPTY:
+                    store.write(z, x, y, tile_hash, None)
+                    continue
+                tasks.append((z, x, y, args.output, nearest))
+            for z_, x, y, png in run(pyramid.render_overview, tasks, executor):
+                store.write(z_, x, y, child_hashes[(x, y)], png)
+            store.commit()
+            hashes = child_hashes
+            kept[z] = set(hashes)
+            print("Zoom {}: {} tiles, {} updated".format(z, len(parents), len(tasks)))
+
+        # Tiles of an earlier, larger extent or other zoom levels
+        for z in store.zooms():
+            store.prune(z, kept.get(z, ()))
+        store.commit()
+
+        store.set_metadata({"name": os.path.splitext(os.path.basename(args.input))[0], "format": "png",
+                            "type": "overlay", "minzoom": min_zoom, "maxzoom": max_zoom})
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        pyramid.close_cached()
+        store.close()
+        if os.path.exists(vrt_path):
+            os.remove(vrt_path)
+
+    EndTime = time.time()
+    print("COMPLETED! ~ {} seconds".format(round(EndTime - StartTime, 1)))
+
+
+if __name__ == '__main__':
+    main()
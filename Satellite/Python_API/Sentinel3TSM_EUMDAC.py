@@ -7,17 +7,20 @@ References:
 
 """
 
-import os, shutil
-import json, requests
+import os
+import json
 import eumdac
-import datetime, time
-import fnmatch
+import datetime
+import threading
+
+import helper.datatailor as datatailor_helper
 
 start_date = "20210401"
 end_date = "20210430"
 cur_dir = os.getcwd()
 geometry = r"Template\map.geojson"
 out_path = r"Downloads"
+max_in_flight = 3 # Customisations running at the same time, within the Data Tailor quota
 
 
 # API credentials
@@ -52,17 +55,28 @@ print(f'\nFound Datasets: {products.total_results} datasets for the given time r
 
 if products.total_results != 0:
     # Prioritize NT (non-critical time), only use NR (near real time) if NT unavailable
-    # Get NT list (without product creation date)
+    # Select one product per granule from the product ids, without opening the products
+    # Product id fields: 9 = creation date, 16 = timeliness (NT or NR)
     print("If Non-Critical Time dataset is available, only Non-Critical Time dataset will be downloaded.")
     print("If Non-Critical Time dataset is not available, Near Real Time dataset will be downloaded.\n")
-    NT_list = []
+    selected_products = {}
     for product in products:
+        product_name_split = str(product).split("_")
+        if len(product_name_split) > 16:
+            timeliness = product_name_split[16]
+            key = "_".join(product_name_split[:9] + product_name_split[10:16] + product_name_split[17:])
+        else:
+            timeliness, key = None, str(product)
+        rank = (timeliness == "NT", product_name_split[9] if len(product_name_split) > 9 else "")
+        if key not in selected_products or rank > selected_products[key][0]:
+            selected_products[key] = (rank, product)
+    # Outputs are named after the product file, as opened (only the selected products are opened)
+    selected = []
+    for rank, product in selected_products.values():
         with product.open() as fsrc:
-            if "NT" in fsrc.name:
-                NT_name = fsrc.name
-                NT_name_split = NT_name.split("_")
-                del NT_name_split[9]
-                NT_list.append("_".join(NT_name_split))
+            product_name = fsrc.name
+        selected.append((product, os.path.join(cur_dir, out_path, os.path.splitext(product_name)[0] + ".tif")))
+    print(f"Selected Datasets: {len(selected)}\n")
 
 
     # Customize
@@ -74,68 +88,19 @@ if products.total_results != 0:
         filter={"bands": ["tsm_nn"]}
     )
 
-    count = 1
-    for product in products:
-        customisation  = datatailor.new_customisation(product, chain)
-
-        # Prioritize NT (non-critical time), only use NR (near real time) if NT unavailable
-        with product.open() as fsrc:
-            product_name = fsrc.name
-        product_name_split = product_name.split("_")
-        if product_name_split[16] == "NT": 
-            pass # If NT, continue to download NT
+    # Customize and download, keeping several customisations in flight
+    count = 0
+    count_lock = threading.Lock() # report is called from the download threads
+    def report(file_path, error):
+        global count
+        if error is None:
+            with count_lock:
+                count += 1
+                print(f'Downloaded Sentinel-3 TSM imagery {count}: {os.path.basename(file_path)}')
         else:
-            product_name_split[16] = "NT"
-            del product_name_split[9]
-            if any("_".join(product_name_split) in x for x in NT_list):
-                continue # If NR, but NT available, skip to next
-            else:
-                pass # If NR, and NT not available, download NR
-
-        try:
-            pass
-            #print(f"Customisation {customisation._id} started.")
-        except eumdac.datatailor.DataTailorError as error:
-            print(f"Error related to the Data Tailor: '{error.msg}'")
-        except requests.exceptions.RequestException as error:
-            print(f"Unexpected error: {error}")
-
-        status = customisation.status
-        sleep_time = 10 # seconds
-
-        # Customisation Loop
-        while status:
-            status = customisation.status
-
-            if "DONE" in status:
-                #print(f"Customisation {customisation._id} is successfully completed.")
-                
-                # Download
-                try:
-                    tif, = fnmatch.filter(customisation.outputs, '*.tif')
-                    print(f'Downloading Sentinel-3 TSM imagery {count}: {os.path.splitext(product_name)[0] + ".tif"}')
-                    with customisation.stream_output(tif,) as stream, \
-                        open(os.path.join(cur_dir, out_path, os.path.splitext(product_name)[0] + ".tif"), mode='wb') as fdst:
-                        shutil.copyfileobj(stream, fdst)
-                        count+=1
-
-                except eumdac.datatailor.CustomisationError as error:
-                    print(f"Data Tailor Error", error)
-                except requests.exceptions.RequestException as error:
-                    print(f"Unexpected error: {error}")
-                break
-
-            elif status in ["ERROR","FAILED","DELETED","KILLED","INACTIVE"]:
-                print(f"Customisation {customisation._id} was unsuccessful. Customisation log is printed.\n")
-                print(customisation.logfile)
-                break
-
-            elif "QUEUED" in status:
-                #print(f"Customisation {customisation._id} is queued.")
-                pass
-            elif "RUNNING" in status:
-                #print(f"Customisation {customisation._id} is running.")
-                pass
-            time.sleep(sleep_time)
+            print(f"Error for {os.path.basename(file_path)}: {error}")
+
+    scheduler = datatailor_helper.CustomisationScheduler(datatailor, chain, max_in_flight, poll_interval=10)
+    scheduler.run(selected, report)
 
 print("\nCOMPLETED!\n")
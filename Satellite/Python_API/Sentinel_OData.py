@@ -1,8 +1,12 @@
 import os, argparse
-import json, requests
+import json
 import datetime
 import pandas as pd
 
+import helper.auth as auth
+import helper.download as download
+import helper.search as search
+
 
 # Get inputs
 parser = argparse.ArgumentParser()
@@ -14,31 +18,11 @@ parser.add_argument('--path', type=str)
 parser.add_argument('--username', '-u', type=str)
 parser.add_argument('--password', '-p', type=str)
 parser.add_argument('--geometry', '-g', type=str)
+parser.add_argument('--workers', '-w', type=int, default=4)
+parser.add_argument('--index', type=str, default="catalogue.db", help="search index, relative to the download path")
 args = parser.parse_args()
 
 
-# Credentials
-def get_access_token(username: str, password: str) -> str:
-    data = {
-        "client_id": "cdse-public",
-        "username": username,
-        "password": password,
-        "grant_type": "password",
-        }
-    try:
-        r = requests.post("https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token",
-        data=data,
-        )
-        r.raise_for_status()
-    except Exception as e:
-        raise Exception(
-            f"Access token creation failed. Reponse from the server was: {r.json()}"
-            )
-    return r.json()["access_token"]
-        
-access_token = get_access_token(args.username, args.password)
-
-
 # Search for images
 startdate = datetime.datetime.strptime(args.startdate, '%Y%m%d').strftime('%Y-%m-%d')
 enddate = datetime.datetime.strptime(args.enddate, '%Y%m%d').strftime('%Y-%m-%d')
@@ -50,32 +34,41 @@ features = gj['features'][0]
 coordinates = [str(xy[0]) + " " + str(xy[1]) for xy in features["geometry"]["coordinates"][0]]
 polygon = "POLYGON(({}))".format(coordinates).replace("[","").replace("\'","").replace("]","")
 
-json = requests.get(f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products?$filter=ContentDate/Start gt {startdate}T00:00:00.000Z and ContentDate/Start lt {enddate}T00:00:00.000Z and\
-                        Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' and att/OData.CSC.DoubleAttribute/Value le {cloud}) and\
-                            Collection/Name eq '{data_collection}' and\
-                                OData.CSC.Intersects(area=geography'SRID=4326;{polygon}')").json()
-img_list = pd.DataFrame.from_dict(json['value'])
+with search.Catalogue(os.path.join(os.getcwd(), args.path, args.index), workers=args.workers) as catalogue:
+    products = catalogue.search(search.product_filter(data_collection, cloud, polygon),
+                                f"{startdate}T00:00:00.000Z", f"{enddate}T00:00:00.000Z")
+img_list = pd.DataFrame(products)
 print("Images found:", len(img_list))
 
 
 # Download images
+jobs = []
 for i in range(len(img_list)):
-    id = img_list.iloc[i, 1]
-    name = img_list.iloc[i, 2].split(".SAFE")[0]
+    id = img_list["Id"].iloc[i]
+    name = img_list["Name"].iloc[i].split(".SAFE")[0]
     url = f"https://zipper.dataspace.copernicus.eu/odata/v1/Products({id})/$value"
+    file_path = os.path.join(os.getcwd(), args.path, name + ".zip")
+    if os.path.exists(file_path):
+        continue # Already downloaded
+    jobs.append((url, file_path, download.product_checksum(img_list.iloc[i])))
+print("Images already downloaded:", len(img_list) - len(jobs))
 
-    print("Downloading imagery:", name)
-
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    session = requests.Session()
-    session.headers.update(headers)
-    response = session.get(url, headers=headers, stream=True)
+def report(file_path, error):
+    if error is None:
+        print("Downloaded imagery:", os.path.splitext(os.path.basename(file_path))[0])
+    else:
+        print("ERROR:", error)
 
-    file_path = os.path.join(os.getcwd(), args.path, name + ".zip")
-    with open(file_path, "wb") as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                file.write(chunk)
+if jobs:
+    # Credentials, refreshed by the token manager during the downloads
+    token_manager = auth.TokenManager(args.username, args.password)
+    token_manager.token()
+    session = download.make_session(args.workers)
+    session.auth = token_manager
+    downloader = download.Downloader(session, args.workers)
+    print("Downloading imagery with {} workers...".format(args.workers))
+    failed = downloader.download_all(jobs, report)
+    if failed:
+        print("Failed downloads:", len(failed))
 
 print("COMPLETED!")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+CDSE access tokens
+
+CDSE access tokens expire after a few minutes, well before a bulk download
+is done. TokenManager keeps the access/refresh token pair, refreshes it
+shortly before the access token expires (with the refresh token, or the
+password when the refresh token has expired too) and is shared by all
+download workers as the auth of their session. A request answered with 401
+is sent once more with a fresh token.
+"""
+
+import json
+import time
+import base64
+import threading
+
+import requests
+from requests.auth import AuthBase
+
+TOKEN_URL = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
+DEFAULT_LIFETIME = 600  # seconds, CDSE access tokens last 10 minutes
+
+
+def jwt_expiry(token):
+    """ Get the exp claim (seconds since the epoch) of a JWT, None if the token is not a JWT or has none """
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class AuthError(requests.RequestException):
+    pass
+
+
+class TokenManager(AuthBase):
+    """ Thread-safe access token cache, usable as requests auth
+
+    margin is the number of seconds before expiry at which a token is
+    refreshed.
+    """
+
+    def __init__(self, username, password, url=TOKEN_URL, client_id="cdse-public", margin=60, timeout=60):
+        self.username = username
+        self.password = password
+        self.url = url
+        self.client_id = client_id
+        self.margin = margin
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._refresh_token = None
+        self._expires = 0
+        self._refresh_expires = 0
+
+    def _request(self, data):
+        requested = time.time()
+        try:
+            r = self.session.post(self.url, data=dict(data, client_id=self.client_id), timeout=self.timeout)
+            r.raise_for_status()
+            token = r.json()
+        except (requests.RequestException, ValueError) as e:
+            raise AuthError("Access token creation failed. Response from the server was: {}".format(e))
+        self._access_token = token["access_token"]
+        self._refresh_token = token.get("refresh_token")
+        self._expires = self._expiry(requested, token.get("expires_in"), self._access_token)
+        self._refresh_expires = self._expiry(requested, token.get("refresh_expires_in"), self._refresh_token)
+
+    @staticmethod
+    def _expiry(requested, lifetime, token):
+        """ Get the expiry time of a token from its lifetime, else its JWT exp claim, else DEFAULT_LIFETIME
+
+        A lifetime of 0 (Keycloak's value for tokens without expiry) is
+        treated as missing.
+        """
+        if lifetime:
+            return requested + lifetime
+        exp = jwt_expiry(token)
+        return exp if exp is not None else requested + DEFAULT_LIFETIME
+
+    def _renew(self):
+        if self._refresh_token is not None and time.time() < self._refresh_expires - self.margin:
+            try:
+                self._request({"grant_type": "refresh_token", "refresh_token": self._refresh_token})
+                return
+            except AuthError:
+                pass
+        self._request({"grant_type": "password", "username": self.username, "password": self.password})
+
+    def token(self, stale=None):
+        """ Get a valid access token
+
+        stale is a token that was rejected by the server: it is replaced
+        unless another worker has already done so.
+        """
+        with self._lock:
+            if (self._access_token is None or self._access_token == stale
+                    or time.time() >= self._expires - self.margin):
+                self._renew()
+            return self._access_token
+
+    def __call__(self, r):
+        r.headers["Authorization"] = "Bearer {}".format(self.token())
+        r.register_hook("response", self._retry_unauthorized)
+        return r
+
+    def _retry_unauthorized(self, r, **kwargs):
+        """ Send a request answered with 401 once more with a new token """
+        if r.status_code != 401 or getattr(r.request, "_token_retried", False):
+            return r
+        stale = r.request.headers.get("Authorization", "").replace("Bearer ", "", 1)
+        r.content
+        r.close()
+        prep = r.request.copy()
+        prep.headers["Authorization"] = "Bearer {}".format(self.token(stale))
+        prep._token_retried = True
+        retry = r.connection.send(prep, **kwargs)
+        retry.history.append(r)
+        retry.request = prep
+        return retry
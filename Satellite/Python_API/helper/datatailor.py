@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Data Tailor customisations
+
+Instead of waiting for each customisation to finish before submitting the
+next one, up to max_in_flight customisations are kept running and polled
+together. Outputs are streamed to disk by a small pool of threads as soon as
+a customisation is done, and finished customisations are deleted to free
+the Data Tailor quota. A done customisation holds quota until its download
+has deleted it, so it still counts toward max_in_flight.
+"""
+
+import os
+import time
+import shutil
+import fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+FAILED_STATES = ("ERROR", "FAILED", "DELETED", "KILLED", "INACTIVE")
+
+
+class CustomisationError(Exception):
+    pass
+
+
+class CustomisationScheduler(object):
+    """ Run customisations of a chain on many products with a bounded number in flight
+
+    datatailor only needs new_customisation(product, chain), and the
+    customisations status, outputs, stream_output(name), logfile and
+    delete(), so eumdac.DataTailor can be replaced by a fake in tests.
+    A customisation is given up after status_retries failed status polls in
+    a row.
+    """
+
+    def __init__(self, datatailor, chain, max_in_flight=3, poll_interval=10, download_workers=2, pattern="*.tif",
+                 status_retries=3):
+        self.datatailor = datatailor
+        self.chain = chain
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.status_retries = status_retries
+        self.download_workers = download_workers
+        self.pattern = pattern
+
+    @staticmethod
+    def _delete(customisation):
+        try:
+            customisation.delete()
+        except Exception:
+            pass
+
+    def _download(self, customisation, file_path):
+        """ Stream the output of a finished customisation to file_path and delete the customisation """
+        try:
+            outputs = fnmatch.filter(customisation.outputs, self.pattern)
+            if len(outputs) != 1:
+                raise CustomisationError("{} outputs match {}".format(len(outputs), self.pattern))
+            with customisation.stream_output(outputs[0]) as stream, open(file_path + ".part", "wb") as fdst:
+                shutil.copyfileobj(stream, fdst, 1024 * 1024)
+            os.replace(file_path + ".part", file_path)
+        finally:
+            self._delete(customisation)
+
+    def run(self, jobs, callback=None):
+        """ Customise and download (product, file_path) jobs
+
+        callback(file_path, error) is called as each job finishes. Returns
+        {file_path: error} of the failed jobs.
+        """
+        queue = deque(jobs)
+        in_flight = []  # [customisation, file_path, status errors in a row]
+        downloads = set()
+        failed = {}
+
+        def finish(file_path, error):
+            if error is not None:
+                failed[file_path] = error
+            if callback is not None:
+                callback(file_path, error)
+
+        def download(customisation, file_path):
+            try:
+                self._download(customisation, file_path)
+                finish(file_path, None)
+            except Exception as error:
+                finish(file_path, error)
+
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            while queue or in_flight or downloads:
+                downloads = set(f for f in downloads if not f.done())
+
+                # Submit customisations while fewer than max_in_flight hold quota (running or downloading)
+                while queue and len(in_flight) + len(downloads) < self.max_in_flight:
+                    product, file_path = queue[0]
+                    try:
+                        customisation = self.datatailor.new_customisation(product, self.chain)
+                    except Exception as error:
+                        if in_flight or downloads:
+                            break # Quota may be full, retry when a customisation has finished
+                        queue.popleft()
+                        finish(file_path, error)
+                        continue
+                    queue.popleft()
+                    in_flight.append([customisation, file_path, 0])
+
+                # Poll all customisations in flight
+                running = []
+                for job in in_flight:
+                    customisation, file_path = job[:2]
+                    try:
+                        status = customisation.status
+                    except Exception as error:
+                        job[2] += 1
+                        if job[2] < self.status_retries:
+                            running.append(job)
+                            continue
+                        self._delete(customisation)
+                        finish(file_path, error)
+                        continue
+                    job[2] = 0
+                    if "DONE" in status:
+                        downloads.add(executor.submit(download, customisation, file_path))
+                    elif status in FAILED_STATES:
+                        finish(file_path, CustomisationError("Customisation {} was unsuccessful ({}):\n{}".format(
+                            getattr(customisation, "_id", ""), status, customisation.logfile)))
+                        self._delete(customisation)
+                    else:
+                        running.append(job)
+                in_flight = running
+                if in_flight:
+                    time.sleep(self.poll_interval)
+                elif downloads:
+                    # Nothing to poll: wait for a download to free its quota
+                    wait(downloads, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+        return failed
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Product downloads
+
+Products are downloaded by a bounded pool of threads sharing one pooled
+requests session. Each product is streamed in large chunks to a .part file,
+so a dropped connection resumes with an HTTP Range request instead of
+starting over. Failed requests are retried with exponential backoff and the
+finished file is verified against the OData Checksum before it is renamed.
+"""
+
+import os
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+def make_session(pool_size=4, headers=None):
+    """ Get a session with one pooled connection per download worker """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def product_checksum(product):
+    """ Get (algorithm, value) of the first OData Checksum hashlib supports, or None """
+    checksums = product.get("Checksum")
+    if not isinstance(checksums, list):
+        return None
+    for checksum in checksums:
+        algorithm = str(checksum.get("Algorithm", "")).lower().replace("-", "")
+        if checksum.get("Value") and algorithm in hashlib.algorithms_available:
+            return algorithm, checksum["Value"].lower()
+    return None
+
+
+def file_checksum(file_path, algorithm, chunk_size=CHUNK_SIZE):
+    h = hashlib.new(algorithm)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _retryable(error):
+    """ Connection errors, timeouts and server side HTTP errors are worth retrying """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+class Downloader(object):
+    """ Resumable downloads with retries, run by a pool of workers on a shared session """
+
+    def __init__(self, session=None, workers=4, chunk_size=CHUNK_SIZE, retries=5, backoff=2.0, timeout=60):
+        self.session = session if session is not None else make_session(workers)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def _fetch(self, url, part_path):
+        """ Stream url to part_path, resuming from the bytes already in part_path """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if offset and r.status_code == 416:
+                # The .part file already holds the whole product
+                return
+            r.raise_for_status()
+            if r.status_code != 206:
+                # The server ignored the range, start over
+                offset = 0
+            expected = r.headers.get("Content-Length")
+            written = 0
+            with open(part_path, "ab" if offset else "wb") as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    written += len(chunk)
+            if expected is not None and written < int(expected):
+                raise requests.ConnectionError("Connection closed after {} of {} bytes".format(written, expected))
+
+    def download(self, url, file_path, checksum=None):
+        """ Download url to file_path, verified against checksum (algorithm, value) if given
+
+        Existing files are skipped. Raises DownloadError when the retries
+        are exhausted or the checksum does not match.
+        """
+        if os.path.exists(file_path):
+            return file_path
+        part_path = file_path + ".part"
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(url, part_path)
+                break
+            except requests.RequestException as error:
+                if attempt == self.retries or not _retryable(error):
+                    raise DownloadError("{} failed: {}".format(os.path.basename(file_path), error))
+                time.sleep(self.backoff * 2 ** attempt)
+        if checksum is not None:
+            algorithm, value = checksum
+            if file_checksum(part_path, algorithm) != value:
+                os.remove(part_path)
+                raise DownloadError("{} failed: {} checksum mismatch".format(os.path.basename(file_path), algorithm))
+        os.replace(part_path, file_path)
+        return file_path
+
+    def download_all(self, jobs, callback=None):
+        """ Download (url, file_path, checksum) jobs with the worker pool
+
+        callback(file_path, error) is called as each job finishes. Returns
+        {file_path: error} of the failed jobs.
+        """
+        def run(job):
+            url, file_path, checksum = job
+            try:
+                self.download(url, file_path, checksum)
+                error = None
+            except DownloadError as e:
+                error = e
+            if callback is not None:
+                callback(file_path, error)
+            return file_path, error
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(run, jobs))
+        return {file_path: error for file_path, error in results if error is not None}
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Catalogue search
+
+OData searches are paged: the first page reports the total count and the
+remaining $top/$skip pages are fetched concurrently (or @odata.nextLink is
+followed when the server gives no count), so large date ranges are not
+truncated at the first page. Pages are ordered by sensing start and Id, so
+products with the same sensing start are neither dropped nor repeated.
+The catalogue caps $skip (10000 on CDSE), so date windows with more
+products than the cap are split in two until they fit.
+
+Results are kept in a SQLite index keyed by the query without its dates,
+with the [start, end) sensing intervals that were searched for each query.
+A later run of the same query only asks the catalogue for the parts of its
+date range that no earlier search covered. Products are published some
+time after sensing, so the last ingestion_margin before now is never
+recorded as covered and is searched again on the next run.
+"""
+
+import json
+import sqlite3
+import datetime
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import download
+
+CATALOGUE_URL = "https://catalogue.dataspace.copernicus.eu/odata/v1/Products"
+
+
+def product_filter(collection, cloud, polygon):
+    """ Get the OData filter of a collection, maximum cloud cover and area """
+    return ("Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover' and att/OData.CSC.DoubleAttribute/Value le {}) and "
+            "Collection/Name eq '{}' and "
+            "OData.CSC.Intersects(area=geography'SRID=4326;{}')").format(cloud, collection, polygon)
+
+
+def date_filter(start, end, inclusive=False):
+    """ Get the OData filter of sensing start times between two ISO timestamps """
+    return "ContentDate/Start {} {} and ContentDate/Start lt {}".format("ge" if inclusive else "gt", start, end)
+
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+
+def parse_time(timestamp):
+    """ Get the datetime of an ISO timestamp (e.g. 2024-01-01T00:00:00.000Z), to the second """
+    return datetime.datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def format_time(time):
+    return time.strftime(TIME_FORMAT)
+
+
+def sensing_start(product):
+    return product["ContentDate"]["Start"]
+
+
+def merge_intervals(intervals):
+    """ Merge overlapping or touching [start, end) intervals """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(interval) for interval in merged]
+
+
+def interval_gaps(intervals, start, end):
+    """ Get the parts of [start, end) not covered by merged, sorted intervals """
+    gaps = []
+    for covered_start, covered_end in intervals:
+        if covered_end <= start:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > start:
+            gaps.append((start, covered_start))
+        start = max(start, covered_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+class Catalogue(object):
+    """ Paged OData search with a SQLite index of the results """
+
+    def __init__(self, index_path, session=None, url=CATALOGUE_URL, page_size=1000, workers=4, timeout=60,
+                 max_skip=10000, ingestion_margin=datetime.timedelta(days=3)):
+        self.session = session if session is not None else download.make_session(workers)
+        self.url = url
+        self.page_size = page_size
+        self.max_skip = max_skip
+        self.ingestion_margin = ingestion_margin
+        self.workers = workers
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS coverage (key TEXT, start TEXT, end TEXT, PRIMARY KEY (key, start))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS products (key TEXT, id TEXT, name TEXT, sensing_start TEXT, product TEXT, "
+                        "PRIMARY KEY (key, id))")
+        self.db.commit()
+
+    def _get(self, url, params=None):
+        r = self.session.get(url, params=params, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def _params(self, query_filter):
+        return {"$filter": query_filter, "$orderby": "ContentDate/Start asc,Id asc", "$top": self.page_size}
+
+    def _first_page(self, query_filter):
+        return self._get(self.url, dict(self._params(query_filter), **{"$count": "True"}))
+
+    def fetch(self, query_filter, first=None):
+        """ Get all products matching an OData filter, ordered by sensing start
+
+        first is the first page ($count included) when already requested.
+        """
+        params = self._params(query_filter)
+        if first is None:
+            first = self._first_page(query_filter)
+        products = list(first["value"])
+        count = first.get("@odata.count")
+        if count is not None:
+            skips = range(len(products), count, self.page_size) if products else []
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pages = executor.map(lambda skip: self._get(self.url, dict(params, **{"$skip": skip}))["value"], skips)
+                for page in pages:
+                    products.extend(page)
+        else:
+            next_link = first.get("@odata.nextLink")
+            while next_link:
+                page = self._get(next_link)
+                products.extend(page["value"])
+                next_link = page.get("@odata.nextLink")
+        return products
+
+    def fetch_window(self, query_filter, start, end):
+        """ Get the products of a query sensed in [start, end), split in smaller windows beyond the $skip cap """
+        window_filter = "{} and {}".format(date_filter(start, end, inclusive=True), query_filter)
+        first = self._first_page(window_filter)
+        count = first.get("@odata.count")
+        if count is not None and count > self.max_skip + self.page_size:
+            t0, t1 = parse_time(start), parse_time(end)
+            middle = format_time(t0 + (t1 - t0) // 2)
+            if start < middle < end:
+                return self.fetch_window(query_filter, start, middle) + self.fetch_window(query_filter, middle, end)
+        return self.fetch(window_filter, first)
+
+    def search(self, query_filter, start, end):
+        """ Get the products of a query sensed between start and end (ISO timestamps)
+
+        Only the parts of [start, end) that no earlier search of the same
+        query covered are requested from the catalogue, the rest come from
+        the index. Coverage is only recorded up to ingestion_margin before
+        now, as later products may not be published yet.
+        """
+        key = hashlib.sha1(query_filter.encode("utf-8")).hexdigest()
+        covered = self.db.execute("SELECT start, end FROM coverage WHERE key = ? ORDER BY start", (key,)).fetchall()
+        gaps = interval_gaps(covered, start, end)
+        products = []
+        for gap_start, gap_end in gaps:
+            products.extend(self.fetch_window(query_filter, gap_start, gap_end))
+        horizon = format_time(datetime.datetime.now(datetime.timezone.utc) - self.ingestion_margin)
+        searched = [(gap_start, min(gap_end, horizon)) for gap_start, gap_end in gaps if gap_start < horizon]
+
+        with self._lock:
+            self.db.executemany("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?)",
+                                [(key, p["Id"], p["Name"], sensing_start(p), json.dumps(p)) for p in products])
+            if searched:
+                self.db.execute("DELETE FROM coverage WHERE key = ?", (key,))
+                self.db.executemany("INSERT INTO coverage VALUES (?, ?, ?)",
+                                    [(key, s, e) for s, e in merge_intervals(covered + searched)])
+            self.db.commit()
+        rows = self.db.execute("SELECT product FROM products WHERE key = ? AND sensing_start > ? AND sensing_start < ? "
+                               "ORDER BY sensing_start", (key, start, end)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
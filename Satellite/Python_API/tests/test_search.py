@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Catalogue searches over disjoint, overlapping and extending date windows, with a fake paged OData session """
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helper.search as search
+
+QUERY = search.product_filter("SENTINEL-2", 20, "POLYGON((0 0, 1 0, 1 1, 0 0))")
+
+
+def monthly_products():
+    """ One product on the 15th of every month of 2024 """
+    return [{"Id": "P{:02d}".format(m), "Name": "P{:02d}.SAFE".format(m),
+             "ContentDate": {"Start": "2024-{:02d}-15T00:00:00.000Z".format(m)}} for m in range(1, 13)]
+
+
+class FakeResponse(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeSession(object):
+    """ OData catalogue answering $filter on ContentDate/Start with $top/$skip/$count pages, $skip capped at max_skip """
+
+    def __init__(self, products, max_skip=10000):
+        self.products = sorted(products, key=lambda p: (p["ContentDate"]["Start"], p["Id"]))
+        self.max_skip = max_skip
+        self.windows = []
+
+    def get(self, url, params=None, timeout=None):
+        assert params["$orderby"] == "ContentDate/Start asc,Id asc"
+        match = re.match(r"ContentDate/Start (ge|gt) (\S+) and ContentDate/Start lt (\S+) and ", params["$filter"])
+        op, start, end = match.groups()
+        skip = params.get("$skip", 0)
+        assert skip <= self.max_skip, "$skip above the cap"
+        if "$skip" not in params:
+            self.windows.append((start, end))
+        products = [p for p in self.products if (p["ContentDate"]["Start"] >= start if op == "ge" else
+                                                 p["ContentDate"]["Start"] > start) and p["ContentDate"]["Start"] < end]
+        data = {"value": products[skip:skip + params["$top"]]}
+        if params.get("$count") == "True":
+            data["@odata.count"] = len(products)
+        return FakeResponse(data)
+
+
+def month(m, year=2024):
+    return "{}-{:02d}-01T00:00:00.000Z".format(year, m)
+
+
+def ids(products):
+    return [p["Id"] for p in products]
+
+
+def test_search_windows(tmp_path):
+    session = FakeSession(monthly_products())
+    with search.Catalogue(str(tmp_path / "catalogue.db"), session=session, page_size=2, workers=2) as catalogue:
+        # Disjoint windows
+        assert ids(catalogue.search(QUERY, month(1), month(3))) == ["P01", "P02"]
+        assert ids(catalogue.search(QUERY, month(6), month(8))) == ["P06", "P07"]
+        # Spanning window: only the gaps are fetched
+        session.windows = []
+        assert ids(catalogue.search(QUERY, month(1), month(12))) == ["P{:02d}".format(m) for m in range(1, 12)]
+        assert session.windows == [(month(3), month(6)), (month(8), month(12))]
+        # Overlapping window inside the covered range: nothing is fetched
+        session.windows = []
+        assert ids(catalogue.search(QUERY, month(2), month(7))) == ["P02", "P03", "P04", "P05", "P06"]
+        assert session.windows == []
+        # Extending window: only the new months are fetched
+        assert ids(catalogue.search(QUERY, month(4), month(1, 2025))) == ["P{:02d}".format(m) for m in range(4, 13)]
+        assert session.windows == [(month(12), month(1, 2025))]
+
+    # The coverage is kept in the index
+    session = FakeSession(monthly_products())
+    with search.Catalogue(str(tmp_path / "catalogue.db"), session=session, page_size=2) as catalogue:
+        assert len(catalogue.search(QUERY, month(1), month(1, 2025))) == 12
+        assert session.windows == []
+
+
+def test_recent_window_searched_again(tmp_path):
+    session = FakeSession(monthly_products())
+    with search.Catalogue(str(tmp_path / "catalogue.db"), session=session) as catalogue:
+        catalogue.search(QUERY, month(1), month(1, 2100))
+        # A product published after the first run, sensed before its end
+        recent = search.format_time(search.datetime.datetime.now(search.datetime.timezone.utc))
+        session.products.append({"Id": "NEW", "Name": "NEW.SAFE", "ContentDate": {"Start": recent}})
+        session.windows = []
+        assert ids(catalogue.search(QUERY, month(1), month(1, 2100)))[-1] == "NEW"
+        assert len(session.windows) == 1 and session.windows[0][0] > month(1, 2025)
+
+
+def test_skip_cap(tmp_path):
+    # 40 products on 20 days, two with the same sensing start each day
+    products = [{"Id": "P{:02d}{}".format(d, k), "Name": "P{:02d}{}.SAFE".format(d, k),
+                 "ContentDate": {"Start": "2024-01-{:02d}T10:00:00.000Z".format(d)}} for d in range(1, 21) for k in "ab"]
+    session = FakeSession(products, max_skip=6)
+    with search.Catalogue(str(tmp_path / "catalogue.db"), session=session, page_size=3, max_skip=6) as catalogue:
+        found = ids(catalogue.search(QUERY, month(1), month(2)))
+    assert found == ids(session.products)
+    assert len(session.windows) > 1
@@ -0,0 +1,67 @@
+"""
+Cloud-masked composites of downloaded Sentinel 2 / Landsat scenes
+
+Local counterpart of Download_Sentinel2SR.js and Download_Landsat5SR.js for
+the SAFE zips downloaded by Sentinel_OData.py (or Landsat Collection 2
+Level 2 tars). Tiles are composited in parallel and written to a Cloud
+Optimized GeoTIFF.
+
+Usage:
+    python Composite.py --input Downloads --output sentinel2_202406.tif --resolution 10
+    python Composite.py --input Downloads --output landsat_2023.tif --resolution 30 --method quality
+"""
+
+import os, shutil, argparse, tempfile
+import numpy as np
+
+import helper.composite as composite
+import helper.raster as raster
+import helper.tiles as tiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--input', '-i', type=str, nargs='+', required=True, help="scene archives or folders containing them")
+    parser.add_argument('--output', '-o', type=str, required=True)
+    parser.add_argument('--method', type=str, default="median", choices=["median", "quality"])
+    parser.add_argument('--bands', type=str, nargs='+', default=None, help="default: all bands of the first scene")
+    parser.add_argument('--resolution', type=float, default=10)
+    parser.add_argument('--crs', type=str, default=None, help="default: crs of the first scene")
+    parser.add_argument('--bounds', type=float, nargs=4, default=None, metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+                        help="in the output crs, default: union of the scenes")
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    scenes = composite.find_scenes(args.input)
+    print("Scenes found:", len(scenes))
+    if not scenes:
+        return
+    bands = args.bands or list(scenes[0].bands)
+    if args.method == "quality":
+        missing = [b for scene in scenes for b in composite.QUALITY_BANDS[scene.sensor] if b not in bands]
+        if missing:
+            parser.error("quality mosaic needs bands {}".format(", ".join(sorted(set(missing)))))
+
+    grid = composite.target_grid(scenes, args.resolution, args.crs, args.bounds)
+    print("Output size: {} x {}".format(grid.width, grid.height))
+    work_dir = tempfile.mkdtemp(prefix="composite_")
+    try:
+        for scene in scenes:
+            composite.warp_scene(scene, bands, grid, work_dir)
+
+        tasks = [(tile, scenes, bands, args.method) for tile in tiles.tiles(grid.width, grid.height, args.tile_size)]
+        print("Compositing {} tiles with {} workers...".format(len(tasks), args.workers))
+        with raster.TileWriter(args.output, grid.width, grid.height, len(bands), grid.geotransform, grid.projection,
+                               np.float32, np.nan, bands) as writer:
+            for n, (tile, array) in enumerate(tiles.run(composite.composite_tile, tasks, args.workers)):
+                writer.write(tile, array)
+                if (n + 1) % 100 == 0:
+                    print("{} / {} tiles".format(n + 1, len(tasks)))
+    finally:
+        shutil.rmtree(work_dir)
+    print("COMPLETED!")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+GLCM texture bands of an image
+
+Raw gray_corr, gray_ent, gray_idm and gray_savg bands of the gray level
+image of LULC_RandomForest.js, computed tile by tile in parallel and written
+to a Cloud Optimized GeoTIFF.
+
+Usage:
+    python GLCM_Texture.py --input sentinel2_202406.tif --output sentinel2_202406_glcm.tif
+    python GLCM_Texture.py --input image.tif --output image_glcm.tif --gray-bands b4 b3 b2 --weights 0.3 0.59 0.11
+"""
+
+import os, argparse
+import numpy as np
+
+import helper.features as features
+import helper.glcm as glcm
+import helper.raster as raster
+import helper.tiles as tiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--input', '-i', type=str, required=True)
+    parser.add_argument('--output', '-o', type=str, required=True)
+    parser.add_argument('--glcm-size', type=int, default=3, help="GLCM neighborhood size, in pixels")
+    parser.add_argument('--gray-bands', type=str, nargs='+', default=[name for name, weight in features.GRAY_BANDS])
+    parser.add_argument('--weights', type=float, nargs='+', default=[weight for name, weight in features.GRAY_BANDS])
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    if len(args.gray_bands) != len(args.weights):
+        parser.error("--gray-bands and --weights differ in length")
+    gray_bands = list(zip(args.gray_bands, args.weights))
+
+    ds = raster.open_cached(args.input)
+    tasks = [(tile, args.input, args.glcm_size, gray_bands)
+             for tile in tiles.tiles(ds.RasterXSize, ds.RasterYSize, args.tile_size)]
+    print("Computing {} tiles with {} workers...".format(len(tasks), args.workers))
+    with raster.TileWriter(args.output, ds.RasterXSize, ds.RasterYSize, len(glcm.GLCM_BANDS), ds.GetGeoTransform(),
+                           ds.GetProjection(), np.float32, np.nan, glcm.GLCM_BANDS) as writer:
+        for n, (tile, array) in enumerate(tiles.run(features.glcm_image_tile, tasks, args.workers)):
+            writer.write(tile, array)
+            if (n + 1) % 100 == 0:
+                print("{} / {} tiles".format(n + 1, len(tasks)))
+    print("COMPLETED!")
+
+
+if __name__ == '__main__':
+    main()
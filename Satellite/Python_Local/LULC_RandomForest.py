@@ -0,0 +1,135 @@
+"""
+Land use land cover classification with Random Forest
+
+Local counterpart of LULC_RandomForest.js: GLCM texture and PCA features,
+Random Forest trained on labelled points and a tiled parallel classification
+of the image, written to a Cloud Optimized GeoTIFF. The object-based mode
+(OB) classifies the mean features of SNIC segments instead of pixels (PB).
+
+Usage:
+    python LULC_RandomForest.py --train-image sentinel2_2022.tif --classify-image sentinel2_202406.tif
+                                --labels SGMY_Mangrove_2024.shp --output sentinel2_202406_mangrove.tif
+    python LULC_RandomForest.py --classify-type OB --snic-seedspace 10 --train-image sentinel2_2022.tif
+                                --classify-image sentinel2_202406.tif --labels SGMY_Mangrove_2024.shp
+                                --output sentinel2_202406_mangrove.tif
+"""
+
+import os, shutil, argparse, tempfile
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, confusion_matrix
+
+import helper.features as features
+import helper.raster as raster
+import helper.tiles as tiles
+
+
+def sample(args, image_path, labels, textures, segments):
+    """ Get the (features, labels) of an image: pixel features (PB) or mean features of their segment (OB) """
+    if image_path in segments:
+        clusters_path, stats = segments[image_path]
+        return features.sample_segments(clusters_path, labels, stats, args.tile_size, args.workers)
+    return features.sample(image_path, labels, textures[image_path], args.glcm_size, args.tile_size, args.workers)
+
+
+def train(args, textures, segments):
+    """ Train the Random Forest and report train / test accuracy """
+    test_image = args.test_image or args.train_image
+    srs_wkt = raster.open_cached(args.train_image).GetProjection()
+    train, test = features.read_labels(args.labels, args.label_field, srs_wkt, args.split, args.seed)
+    print("Labels (train / test):", len(train), "/", len(test))
+    X_train, y_train = sample(args, args.train_image, features.buffer_labels(train, args.buffer), textures, segments)
+    X_test, y_test = sample(args, test_image, test, textures, segments)
+    print("Samples (train / test):", len(y_train), "/", len(y_test))
+
+    # Training
+    classifier = RandomForestClassifier(n_estimators=args.trees, n_jobs=args.workers, random_state=args.seed)
+    classifier.fit(X_train, y_train)
+    print("Features:", features.feature_names(raster.open_cached(args.train_image), textures[args.train_image]))
+    print("Confusion matrix (train):\n", confusion_matrix(y_train, classifier.predict(X_train)))
+    print("Accuracy (train):", accuracy_score(y_train, classifier.predict(X_train)))
+
+    # Validation
+    if len(y_test):
+        y_pred = classifier.predict(X_test)
+        print("Confusion matrix (test):\n", confusion_matrix(y_test, y_pred))
+        print("Accuracy (test):", accuracy_score(y_test, y_pred))
+    return classifier
+
+
+def classify(args, textures, segments, classifier):
+    """ Classify the image tile by tile: every pixel (PB) or every segment once (OB) """
+    ds = raster.open_cached(args.classify_image)
+    if args.classify_image in segments:
+        clusters_path, stats = segments[args.classify_image]
+        tasks = [(tile, clusters_path) for tile in tiles.tiles(ds.RasterXSize, ds.RasterYSize, args.tile_size)]
+        # Segments are classified once, tiles only look up the class of their segment ids
+        classes = features.classify_segments(classifier, stats)
+        fn, initializer, initargs = features.classify_segment_tile, features.init_classes, (classes,)
+    else:
+        texture = textures[args.classify_image]
+        tasks = [(tile, args.classify_image, texture, args.glcm_size)
+                 for tile in tiles.tiles(ds.RasterXSize, ds.RasterYSize, args.tile_size)]
+        fn, initializer, initargs = features.classify_tile, features.init_model, (classifier,)
+    print("Classifying {} tiles with {} workers...".format(len(tasks), args.workers))
+    with raster.TileWriter(args.output, ds.RasterXSize, ds.RasterYSize, 1, ds.GetGeoTransform(), ds.GetProjection(),
+                           np.uint8, features.NO_LABEL, ["classification"]) as writer:
+        for tile, classes in tiles.run(fn, tasks, args.workers, initializer, initargs):
+            writer.write(tile, classes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--train-image', type=str, required=True)
+    parser.add_argument('--test-image', type=str, default=None, help="default: train image")
+    parser.add_argument('--classify-image', type=str, required=True)
+    parser.add_argument('--labels', type=str, required=True, help="labelled points (any OGR vector)")
+    parser.add_argument('--label-field', type=str, default="LULC")
+    parser.add_argument('--output', '-o', type=str, required=True)
+    parser.add_argument('--classify-type', type=str, default="PB", choices=["PB", "OB"], help="pixel-based or object-based")
+    parser.add_argument('--split', type=float, default=0.3, help="train-test split [0:1]")
+    parser.add_argument('--buffer', type=float, default=10, help="buffer of the training points, in image crs units")
+    parser.add_argument('--glcm-size', type=int, default=3, help="GLCM neighborhood size, in pixels")
+    parser.add_argument('--pca-components', type=int, default=1)
+    parser.add_argument('--snic-seedspace', type=int, default=10, help="superpixel seed spacing, in pixels")
+    parser.add_argument('--snic-compact', type=float, default=1, help="0 disables spatial distance weighting")
+    parser.add_argument('--snic-connect', type=int, default=8, choices=[4, 8])
+    parser.add_argument('--snic-neighbor', type=int, default=256, help="segmentation tile size, in pixels")
+    parser.add_argument('--snic-overlap', type=int, default=None, help="overlap of the segmentation tiles, default: 2 seed spacings")
+    parser.add_argument('--trees', type=int, default=50)
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--stats-step', type=int, default=1, help="use every n-th tile for the GLCM scaling and PCA")
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    test_image = args.test_image or args.train_image
+
+    # Texture scaling and PCA of each image
+    textures = {}
+    for image_path in (args.train_image, test_image, args.classify_image):
+        if image_path not in textures:
+            print("Getting texture statistics:", image_path)
+            textures[image_path] = features.fit_texture(image_path, args.glcm_size, args.pca_components,
+                                                        args.tile_size, args.workers, args.stats_step)
+
+    # Segments and their mean features
+    work_dir = tempfile.mkdtemp(prefix="lulc_")
+    try:
+        segments = {}
+        if args.classify_type == "OB":
+            snic_args = (args.snic_seedspace, args.snic_compact, args.snic_connect, args.snic_overlap)
+            for image_path in textures:
+                print("Segmenting:", image_path)
+                clusters_path = os.path.join(work_dir, "clusters_{}.tif".format(len(segments)))
+                segments[image_path] = (clusters_path, features.segment(image_path, clusters_path, textures[image_path],
+                                                                        args.glcm_size, snic_args, args.snic_neighbor,
+                                                                        args.workers))
+        classifier = train(args, textures, segments)
+        classify(args, textures, segments, classifier)
+    finally:
+        shutil.rmtree(work_dir)
+    print("COMPLETED!")
+
+
+if __name__ == '__main__':
+    main()
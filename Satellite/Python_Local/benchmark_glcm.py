@@ -0,0 +1,115 @@
+"""
+Benchmark of the GLCM texture engine
+
+Compares helper/glcm.py with a reference implementation that builds the
+co-occurrence matrix of every pixel window explicitly, on a synthetic
+quantized image: largest difference of each band and time per image size.
+The tile-parallel run (tiles with a halo, stitched) is checked against the
+whole image.
+
+Usage:
+    python benchmark_glcm.py
+    python benchmark_glcm.py --sizes 64 128 256 --reference-max 128 --workers 4
+"""
+
+import os, time, argparse
+import numpy as np
+
+import helper.glcm as glcm
+import helper.tiles as tiles
+
+_image = None
+
+
+def synthetic_image(rows, cols, levels=100, seed=0):
+    """ Smooth random gray levels with some no data """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:rows, :cols]
+    gray = 0.5 + 0.25 * np.sin(x / 7.0) * np.cos(y / 11.0) + 0.15 * rng.random((rows, cols))
+    q = np.clip(gray * levels, 0, levels).astype(np.int16)
+    q[rng.random((rows, cols)) < 0.01] = -1
+    return q
+
+
+def glcm_reference(q, size=3, levels=100, offsets=glcm.GLCM_OFFSETS):
+    """ Per-pixel GLCM of q (with a halo of size pixels), one co-occurrence matrix per window and offset """
+    rows, cols = q.shape[0] - 2 * size, q.shape[1] - 2 * size
+    out = np.zeros((4, rows, cols))
+    i, j = np.mgrid[:levels + 1, :levels + 1]
+    for r in range(rows):
+        for c in range(cols):
+            window = q[r:r + 2 * size + 1, c:c + 2 * size + 1]
+            for dy, dx in offsets:
+                first, second = glcm.pair_images(window, dy, dx)
+                valid = (first >= 0) & (second >= 0)
+                if not valid.any():
+                    out[:, r, c] = np.nan
+                    continue
+                p = np.bincount(first[valid] * (levels + 1) + second[valid], minlength=(levels + 1) ** 2)
+                p = p.reshape(levels + 1, levels + 1) / float(valid.sum())
+                mean_i, mean_j = (i * p).sum(), (j * p).sum()
+                std = np.sqrt(((i - mean_i) ** 2 * p).sum() * ((j - mean_j) ** 2 * p).sum())
+                out[0, r, c] += ((i - mean_i) * (j - mean_j) * p).sum() / std if std > 1e-12 else 0
+                out[1, r, c] -= (p[p > 0] * np.log(p[p > 0])).sum()
+                out[2, r, c] += (p / (1.0 + (i - j) ** 2)).sum()
+                out[3, r, c] += mean_i + mean_j
+    return out / len(offsets)
+
+
+def texture_tile(task):
+    """ Get the GLCM of a tile of the benchmark image: task is (tile, size) """
+    tile, size = task
+    return tile, glcm.glcm_texture(tiles.array_window(_image, tile, size), size)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    global _image
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 64, 128, 256, 512], help="image sizes, in pixels")
+    parser.add_argument('--reference-max', type=int, default=64, help="largest image size run with the reference")
+    parser.add_argument('--glcm-size', type=int, default=3)
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--parallel-size', type=int, default=2048, help="image size of the tile-parallel run")
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    size = args.glcm_size
+
+    print("{:>6} {:>12} {:>12} {:>9}  max abs difference ({})".format(
+        "size", "engine (s)", "ref (s)", "speedup", ", ".join(glcm.GLCM_BANDS)))
+    for n in args.sizes:
+        q = synthetic_image(n + 2 * size, n + 2 * size)
+        out, t_engine = timed(glcm.glcm_texture, q, size)
+        if n > args.reference_max:
+            print("{:>6} {:>12.4f} {:>12} {:>9}".format(n, t_engine, "-", "-"))
+            continue
+        ref, t_ref = timed(glcm_reference, q, size)
+        if not np.array_equal(np.isnan(out), np.isnan(ref)):
+            raise AssertionError("No data windows differ from the reference")
+        error = np.nanmax(np.abs(out - ref).reshape(4, -1), axis=1)
+        print("{:>6} {:>12.4f} {:>12.4f} {:>8.0f}x  {}".format(
+            n, t_engine, t_ref, t_ref / t_engine, " ".join("{:.2e}".format(e) for e in error)))
+
+    # Tiles with halo against the whole image
+    _image = synthetic_image(args.parallel_size, args.parallel_size, seed=1)
+    whole, t_whole = timed(glcm.glcm_texture, np.pad(_image, size, mode="reflect"), size)
+    stitched = np.empty_like(whole)
+    tasks = [(tile, size) for tile in tiles.tiles(args.parallel_size, args.parallel_size, args.tile_size)]
+    start = time.perf_counter()
+    for tile, array in tiles.run(texture_tile, tasks, args.workers):
+        stitched[:, tile.yoff:tile.yoff + tile.ysize, tile.xoff:tile.xoff + tile.xsize] = array
+    t_tiles = time.perf_counter() - start
+    # Running sums (idm, entropy) are rounded differently from one tile to the whole image
+    if not np.allclose(stitched, whole, rtol=1e-5, atol=1e-5, equal_nan=True):
+        raise AssertionError("Tiles differ from the whole image")
+    print("{0} x {0}: whole image {1:.2f} s, {2} tiles with {3} workers {4:.2f} s, max abs difference {5:.2e}".format(
+        args.parallel_size, t_whole, len(tasks), args.workers, t_tiles, np.nanmax(np.abs(stitched - whole))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Cloud-masked composites of Sentinel 2 L2A and Landsat Collection 2 Level 2 scenes
+
+Local counterpart of the median composites of Download_Sentinel2SR.js and
+Download_Landsat5SR.js. Scenes are read straight from the downloaded
+archives (SAFE zips, Landsat tars or folders) through GDAL virtual file
+systems. Each scene is warped on the fly to a common grid by a VRT, so a
+tile of the composite only reads the matching window of the scenes that
+overlap it. Clouds are masked with the Sentinel 2 scene classification
+(SCL) or the Landsat QA_PIXEL band.
+
+Tiles are composited band by band, so memory is bounded by tile size times
+the number of overlapping scenes for a single band.
+"""
+
+import os
+import re
+import tarfile
+import zipfile
+import warnings
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from osgeo import gdal, osr
+
+from . import raster
+
+gdal.UseExceptions()
+
+# Sentinel 2 L2A bands and the SCL classes that are masked
+# (no data, saturated, cloud shadow, cloud medium / high probability, thin cirrus)
+S2_BANDS = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B8A", "B9", "B11", "B12"]
+S2_RESOLUTIONS = ["10m", "20m", "60m"]
+SCL_MASK = [0, 1, 3, 8, 9, 10]
+
+# Landsat Collection 2 QA_PIXEL bits that are masked (fill, dilated cloud, cloud, cloud shadow)
+QA_MASK_BITS = [0, 1, 3, 4]
+LANDSAT_PREFIXES = ("LT04", "LT05", "LE07", "LC08", "LC09")
+
+# Bands of the NDVI used as quality by quality mosaics (NIR, red)
+QUALITY_BANDS = {"S2": ("B8", "B4"), "LT04": ("SR_B4", "SR_B3"), "LT05": ("SR_B4", "SR_B3"),
+                 "LE07": ("SR_B4", "SR_B3"), "LC08": ("SR_B5", "SR_B4"), "LC09": ("SR_B5", "SR_B4")}
+
+Grid = namedtuple("Grid", ["width", "height", "geotransform", "projection", "bounds", "resolution"])
+
+
+def list_files(path):
+    """ Get {file name: GDAL path} of the files in a zip, tar or folder """
+    path = os.path.abspath(path)
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            names = z.namelist()
+        return {os.path.basename(n): "/vsizip/{}/{}".format(path, n) for n in names if not n.endswith("/")}
+    if os.path.isfile(path) and tarfile.is_tarfile(path):
+        with tarfile.open(path) as t:
+            names = [m.name for m in t.getmembers() if m.isfile()]
+        return {os.path.basename(n): "/vsitar/{}/{}".format(path, n) for n in names}
+    files = {}
+    for root, dirs, file_names in os.walk(path):
+        for f in file_names:
+            files[f] = os.path.join(root, f)
+    return files
+
+
+def is_scene(path):
+    name = os.path.basename(os.path.normpath(path))
+    return name.startswith("S2") or name.startswith(LANDSAT_PREFIXES)
+
+
+class Scene(object):
+    """ Band and mask files of a Sentinel 2 L2A or Landsat Collection 2 Level 2 scene
+
+    Reflectance is DN * scale + offset. The Sentinel 2 offset removes the
+    BOA_ADD_OFFSET of processing baseline 04.00 and later (as the harmonized
+    collection on GEE).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.normpath(path))
+        files = list_files(path)
+        self.bands = OrderedDict()
+        if self.name.startswith("S2"):
+            self.sensor = "S2"
+            for band in S2_BANDS:
+                token = "_B{}_".format(band[1:].zfill(2))
+                for resolution in S2_RESOLUTIONS:
+                    match = [p for f, p in files.items() if token in f and f.endswith(resolution + ".jp2")]
+                    if match:
+                        self.bands[band] = match[0]
+                        break
+            self.mask = next((p for f, p in files.items() if f.endswith("_SCL_20m.jp2")), None)
+            baseline = re.search(r"_N(\d{4})_", self.name)
+            self.scale = 1e-4
+            self.offset = -0.1 if baseline is not None and int(baseline.group(1)) >= 400 else 0.0
+        elif self.name.startswith(LANDSAT_PREFIXES):
+            self.sensor = self.name[:4]
+            band_files = {}
+            for f, p in files.items():
+                match = re.search(r"_SR_B(\d+)\.TIF$", f, re.IGNORECASE)
+                if match:
+                    band_files[int(match.group(1))] = p
+            for b in sorted(band_files):
+                self.bands["SR_B{}".format(b)] = band_files[b]
+            self.mask = next((p for f, p in files.items() if f.upper().endswith("_QA_PIXEL.TIF")), None)
+            self.scale = 0.0000275
+            self.offset = -0.2
+        else:
+            raise ValueError("{} is not a Sentinel 2 or Landsat scene".format(self.name))
+        if self.mask is None:
+            raise ValueError("{} has no cloud mask band (SCL / QA_PIXEL)".format(self.name))
+        self.vrt = None
+        self.window = None
+
+    def valid(self, dn, qa):
+        """ Get the cloud-free pixels with data from a band (DN) and the mask band """
+        if self.sensor == "S2":
+            clear = ~np.isin(qa, SCL_MASK)
+        else:
+            bits = sum(1 << b for b in QA_MASK_BITS)
+            clear = (qa.astype(np.int64) & bits) == 0
+        return clear & (dn != 0)
+
+    def extent(self, srs):
+        """ Get (xmin, ymin, xmax, ymax) of the scene in srs """
+        ds = gdal.Open(self.mask)
+        gt = ds.GetGeoTransform()
+        src = osr.SpatialReference(wkt=ds.GetProjection())
+        width, height = ds.RasterXSize, ds.RasterYSize
+        ds = None
+        for s in (src, srs):
+            if hasattr(s, "SetAxisMappingStrategy"):
+                s.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src, srs)
+        corners = [transform.TransformPoint(gt[0] + x * gt[1] + y * gt[2], gt[3] + x * gt[4] + y * gt[5])[:2]
+                   for x in (0, width) for y in (0, height)]
+        xs, ys = zip(*corners)
+        return min(xs), min(ys), max(xs), max(ys)
+
+
+def find_scenes(paths):
+    """ Get the scenes of a list of scene archives / folders, or folders containing them """
+    scenes = []
+    for path in paths:
+        if is_scene(path):
+            scenes.append(Scene(path))
+        elif os.path.isdir(path):
+            scenes.extend(Scene(os.path.join(path, f)) for f in sorted(os.listdir(path))
+                          if is_scene(f) and not f.endswith((".part", ".tmp")))
+    return scenes
+
+
+def target_grid(scenes, resolution, crs=None, bounds=None):
+    """ Get the output grid: crs (default: first scene), bounds (default: union of the scenes) snapped to resolution """
+    srs = osr.SpatialReference()
+    if crs is not None:
+        srs.SetFromUserInput(crs)
+    else:
+        srs.ImportFromWkt(gdal.Open(scenes[0].mask).GetProjection())
+    if hasattr(srs, "SetAxisMappingStrategy"):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if bounds is None:
+        extents = np.array([scene.extent(srs) for scene in scenes])
+        bounds = extents[:, 0].min(), extents[:, 1].min(), extents[:, 2].max(), extents[:, 3].max()
+    xmin = np.floor(bounds[0] / resolution) * resolution
+    ymin = np.floor(bounds[1] / resolution) * resolution
+    xmax = np.ceil(bounds[2] / resolution) * resolution
+    ymax = np.ceil(bounds[3] / resolution) * resolution
+    width, height = int(round((xmax - xmin) / resolution)), int(round((ymax - ymin) / resolution))
+    return Grid(width, height, (xmin, resolution, 0, ymax, 0, -resolution), srs.ExportToWkt(),
+                (xmin, ymin, xmax, ymax), resolution)
+
+
+def warp_scene(scene, bands, grid, work_dir):
+    """ Write a VRT of the scene bands and mask band (last) warped to the grid
+
+    Also sets the pixel window of the scene on the grid, used to skip tiles
+    it does not cover.
+    """
+    missing = [b for b in bands if b not in scene.bands]
+    if missing:
+        raise ValueError("{} has no band {}".format(scene.name, ", ".join(missing)))
+    stack_path = os.path.join(work_dir, scene.name + ".stack.vrt")
+    scene.vrt = os.path.join(work_dir, scene.name + ".vrt")
+    gdal.BuildVRT(stack_path, [scene.bands[b] for b in bands] + [scene.mask], separate=True, resolution="highest")
+    gdal.Warp(scene.vrt, stack_path, format="VRT", outputBounds=grid.bounds, xRes=grid.resolution, yRes=grid.resolution,
+              dstSRS=grid.projection, resampleAlg="near", warpOptions=["INIT_DEST=0"])
+    srs = osr.SpatialReference(wkt=grid.projection)
+    if hasattr(srs, "SetAxisMappingStrategy"):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    xmin, ymin, xmax, ymax = scene.extent(srs)
+    gt = grid.geotransform
+    x0 = max(int(np.floor((xmin - gt[0]) / gt[1])), 0)
+    x1 = min(int(np.ceil((xmax - gt[0]) / gt[1])), grid.width)
+    y0 = max(int(np.floor((ymax - gt[3]) / gt[5])), 0)
+    y1 = min(int(np.ceil((ymin - gt[3]) / gt[5])), grid.height)
+    scene.window = (x0, y0, x1, y1)
+
+
+def _overlaps(scene, tile):
+    x0, y0, x1, y1 = scene.window
+    return tile.xoff < x1 and tile.xoff + tile.xsize > x0 and tile.yoff < y1 and tile.yoff + tile.ysize > y0
+
+
+def _read(scene, band, tile):
+    ds = raster.open_cached(scene.vrt)
+    return ds.GetRasterBand(band).ReadAsArray(tile.xoff, tile.yoff, tile.xsize, tile.ysize)
+
+
+def composite_tile(task):
+    """ Composite one tile: task is (tile, scenes, bands, method)
+
+    method is "median" (per-pixel median of the clear observations) or
+    "quality" (per-pixel observation with the highest NDVI, as GEE
+    qualityMosaic). Returns (tile, array (bands, rows, cols)), NaN where no
+    scene is clear.
+    """
+    tile, scenes, bands, method = task
+    n_bands = len(bands)
+    out = np.full((n_bands, tile.ysize, tile.xsize), np.nan, dtype=np.float32)
+    scenes = [scene for scene in scenes if _overlaps(scene, tile)]
+    if not scenes:
+        return tile, out
+    mask_band = n_bands + 1
+    valid = np.stack([scene.valid(_read(scene, 1, tile), _read(scene, mask_band, tile)) for scene in scenes])
+
+    if method == "median":
+        for b in range(n_bands):
+            stack = np.full(valid.shape, np.nan, dtype=np.float32)
+            for k, scene in enumerate(scenes):
+                if valid[k].any():
+                    dn = _read(scene, b + 1, tile)
+                    stack[k][valid[k]] = dn[valid[k]] * scene.scale + scene.offset
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)  # All-NaN pixels
+                out[b] = np.nanmedian(stack, axis=0)
+
+    elif method == "quality":
+        best_quality = np.full(valid.shape[1:], -np.inf, dtype=np.float32)
+        best = np.full(valid.shape[1:], -1, dtype=np.int32)
+        for k, scene in enumerate(scenes):
+            nir_band, red_band = QUALITY_BANDS[scene.sensor]
+            nir = _read(scene, bands.index(nir_band) + 1, tile) * scene.scale + scene.offset
+            red = _read(scene, bands.index(red_band) + 1, tile) * scene.scale + scene.offset
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ndvi = (nir - red) / (nir + red)
+            better = valid[k] & (ndvi > best_quality)
+            best_quality[better] = ndvi[better]
+            best[better] = k
+        for k, scene in enumerate(scenes):
+            selected = best == k
+            if not selected.any():
+                continue
+            for b in range(n_bands):
+                out[b][selected] = _read(scene, b + 1, tile)[selected] * scene.scale + scene.offset
+
+    else:
+        raise ValueError("Unknown composite method {}".format(method))
+    return tile, out
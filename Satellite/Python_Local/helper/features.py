@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+LULC classification features
+
+Local counterpart of the feature steps of LULC_RandomForest.js: a gray
+level image (0.3 NIR + 0.59 R + 0.11 G) gives GLCM texture bands, which are
+min-max scaled and reduced by PCA. The features of a pixel are the image
+bands and the principal components.
+
+The scaling and PCA statistics need one pass over the image. Features are
+then computed per tile (read with a halo for the GLCM windows) whenever
+they are needed, instead of being stored for the whole image.
+
+In the object-based mode, the features of a pixel are the means of its SNIC
+segment. The segment sums are reduced per tile with bincount and added up,
+so only one row per segment is kept in memory, and segments are classified
+once instead of every pixel.
+"""
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from . import glcm, raster, snic, tiles
+
+gdal.UseExceptions()
+
+# Gray level image of the GLCM (band name: weight)
+GRAY_BANDS = [("B8", 0.3), ("B4", 0.59), ("B3", 0.11)]
+NO_LABEL = 255
+
+
+def band_names(ds):
+    """ Get the band descriptions of a dataset (b1, b2, ... where missing) """
+    return [ds.GetRasterBand(b+1).GetDescription() or "b{}".format(b+1) for b in range(ds.RasterCount)]
+
+
+def gray_tile(ds, tile, size, gray_bands=GRAY_BANDS):
+    """ Get the quantized gray levels of a tile with a halo of size pixels """
+    names = band_names(ds)
+    missing = [name for name, weight in gray_bands if name not in names]
+    if missing:
+        raise ValueError("Image has no band {}".format(", ".join(missing)))
+    bands = [names.index(name) + 1 for name, weight in gray_bands]
+    array = tiles.read_window(ds, tile, size, bands).astype(np.float32)
+    gray = sum(weight * array[k] for k, (name, weight) in enumerate(gray_bands))
+    return glcm.quantize(gray)
+
+
+def glcm_tile(ds, tile, size, gray_bands=GRAY_BANDS):
+    return glcm.glcm_texture(gray_tile(ds, tile, size, gray_bands), size)
+
+
+def glcm_image_tile(task):
+    """ Get the raw GLCM bands of a tile: task is (tile, image_path, size, gray_bands) """
+    tile, image_path, size, gray_bands = task
+    return tile, glcm_tile(raster.open_cached(image_path), tile, size, gray_bands)
+
+
+class RunningStats(object):
+    """ Streaming count, minimum, maximum, mean and covariance of band values
+
+    Partial statistics (e.g. of tiles) are merged with the pairwise update
+    of Chan et al.
+    """
+
+    def __init__(self, n_bands):
+        self.n = 0
+        self.mean = np.zeros(n_bands)
+        self.m2 = np.zeros((n_bands, n_bands))
+        self.minimum = np.full(n_bands, np.inf)
+        self.maximum = np.full(n_bands, -np.inf)
+
+    @classmethod
+    def from_samples(cls, samples):
+        """ Get the statistics of samples (n_samples, bands) """
+        stats = cls(samples.shape[1])
+        if len(samples):
+            samples = np.asarray(samples, dtype=np.float64)
+            stats.n = len(samples)
+            stats.mean = samples.mean(axis=0)
+            d = samples - stats.mean
+            stats.m2 = d.T.dot(d)
+            stats.minimum = samples.min(axis=0)
+            stats.maximum = samples.max(axis=0)
+        return stats
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + np.outer(delta, delta) * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+
+    def cov(self):
+        return self.m2 / max(self.n - 1, 1)
+
+
+class Texture(object):
+    """ Min-max scaling of the GLCM bands and their principal components (glcm_fn and pca_fn) """
+
+    def __init__(self, minimum, maximum, mean, components, sd):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        self.components = components
+        self.sd = sd
+
+    @classmethod
+    def from_stats(cls, stats, n_components=1):
+        """ Get the scaling and PCA from the statistics of the raw GLCM bands """
+        span = np.where(stats.maximum > stats.minimum, stats.maximum - stats.minimum, 1)
+        mean = (stats.mean - stats.minimum) / span
+        cov = stats.cov() / np.outer(span, span)
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        order = np.argsort(eigenvalues)[::-1][:n_components]
+        return cls(stats.minimum, stats.maximum, mean, eigenvectors[:, order].T,
+                   np.sqrt(np.maximum(eigenvalues[order], 1e-12)))
+
+    @property
+    def names(self):
+        return ["pc{}".format(k+1) for k in range(len(self.sd))]
+
+    def transform(self, raw):
+        """ Get the principal components (components, rows, cols) of raw GLCM bands (4, rows, cols) """
+        span = np.where(self.maximum > self.minimum, self.maximum - self.minimum, 1)
+        scaled = (raw - self.minimum[:, None, None]) / span[:, None, None] - self.mean[:, None, None]
+        pcs = np.tensordot(self.components, scaled, axes=1) / self.sd[:, None, None]
+        return pcs.astype(np.float32)
+
+
+def texture_stats_tile(task):
+    """ Get the RunningStats of the raw GLCM bands of a tile: task is (tile, image_path, size) """
+    tile, image_path, size = task
+    raw = glcm_tile(raster.open_cached(image_path), tile, size)
+    samples = raw.reshape(raw.shape[0], -1).T
+    return RunningStats.from_samples(samples[np.isfinite(samples).all(axis=1)])
+
+
+def fit_texture(image_path, size=3, n_components=1, tile_size=512, workers=None, sample_step=1):
+    """ Get the Texture of an image from the GLCM of every sample_step-th tile """
+    ds = raster.open_cached(image_path)
+    tasks = [(tile, image_path, size) for tile in tiles.tiles(ds.RasterXSize, ds.RasterYSize, tile_size)[::sample_step]]
+    stats = RunningStats(len(glcm.GLCM_BANDS))
+    for tile_stats in tiles.run(texture_stats_tile, tasks, workers):
+        stats.merge(tile_stats)
+    return Texture.from_stats(stats, n_components)
+
+
+def feature_tile(ds, tile, texture, size=3):
+    """ Get the features (image bands and principal components) of a tile """
+    bands = tiles.read_window(ds, tile).astype(np.float32)
+    return np.concatenate([bands, texture.transform(glcm_tile(ds, tile, size))])
+
+
+def feature_names(ds, texture):
+    return band_names(ds) + texture.names
+
+
+##### LABELS #####
+def read_labels(label_path, field, srs_wkt, split=0.3, seed=0):
+    """ Get the (wkt, label) train and test geometries of a labelled vector in the image crs
+
+    Features are split randomly as the randomColumn split of the GEE
+    script: random > split for training, the rest for testing.
+    """
+    source = ogr.Open(label_path)
+    layer = source.GetLayer(0)
+    dst = osr.SpatialReference(wkt=srs_wkt)
+    src = layer.GetSpatialRef()
+    transform = None
+    if src is not None and not src.IsSame(dst):
+        for s in (src, dst):
+            if hasattr(s, "SetAxisMappingStrategy"):
+                s.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src, dst)
+    rng = np.random.default_rng(seed)
+    train, test = [], []
+    for feature in layer:
+        geometry = feature.GetGeometryRef().Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        label = (geometry.ExportToWkt(), int(feature.GetField(field)))
+        (train if rng.random() > split else test).append(label)
+    source = None
+    return train, test
+
+
+def buffer_labels(labels, buffer_m):
+    """ Buffer label geometries (in image crs units) to sample more pixels """
+    if not buffer_m:
+        return labels
+    return [(ogr.CreateGeometryFromWkt(wkt).Buffer(buffer_m).ExportToWkt(), label) for wkt, label in labels]
+
+
+def label_tiles(labels, tile_list, geotransform):
+    """ Get (tile, labels) for the tiles that the label geometries overlap """
+    boxes = []
+    for wkt, label in labels:
+        xmin, xmax, ymin, ymax = ogr.CreateGeometryFromWkt(wkt).GetEnvelope()
+        cols = sorted(((xmin - geotransform[0]) / geotransform[1], (xmax - geotransform[0]) / geotransform[1]))
+        rows = sorted(((ymax - geotransform[3]) / geotransform[5], (ymin - geotransform[3]) / geotransform[5]))
+        boxes.append((cols[0], rows[0], cols[1], rows[1]))
+    result = []
+    for tile in tile_list:
+        selected = [labels[k] for k, (c0, r0, c1, r1) in enumerate(boxes)
+                    if c0 <= tile.xoff + tile.xsize and c1 >= tile.xoff and r0 <= tile.yoff + tile.ysize and r1 >= tile.yoff]
+        if selected:
+            result.append((tile, selected))
+    return result
+
+
+def rasterize_labels(ds, tile, labels):
+    """ Burn (wkt, label) geometries into a tile, NO_LABEL elsewhere """
+    gt = ds.GetGeoTransform()
+    mem = gdal.GetDriverByName("MEM").Create("", tile.xsize, tile.ysize, 1, gdal.GDT_Byte)
+    mem.SetGeoTransform((gt[0] + tile.xoff * gt[1] + tile.yoff * gt[2], gt[1], gt[2],
+                         gt[3] + tile.xoff * gt[4] + tile.yoff * gt[5], gt[4], gt[5]))
+    mem.SetProjection(ds.GetProjection())
+    mem.GetRasterBand(1).Fill(NO_LABEL)
+    layer = ogr.GetDriverByName("Memory").CreateDataSource("").CreateLayer("labels", osr.SpatialReference(wkt=ds.GetProjection()))
+    layer.CreateField(ogr.FieldDefn("label", ogr.OFTInteger))
+    for wkt, label in labels:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+        feature.SetField("label", label)
+        layer.CreateFeature(feature)
+    gdal.RasterizeLayer(mem, [1], layer, options=["ATTRIBUTE=label"])
+    return mem.GetRasterBand(1).ReadAsArray()
+
+
+def sample_tile(task):
+    """ Get the (features, labels) of the labelled pixels of a tile: task is (tile, labels, image_path, texture, size) """
+    tile, labels, image_path, texture, size = task
+    ds = raster.open_cached(image_path)
+    label = rasterize_labels(ds, tile, labels)
+    if not (label != NO_LABEL).any():
+        return np.zeros((0, ds.RasterCount + len(texture.sd)), dtype=np.float32), np.zeros(0, dtype=np.uint8)
+    features = feature_tile(ds, tile, texture, size)
+    X = features.reshape(features.shape[0], -1).T
+    y = label.ravel()
+    keep = (y != NO_LABEL) & np.isfinite(X).all(axis=1)
+    return X[keep], y[keep]
+
+
+def sample(image_path, labels, texture, size=3, tile_size=512, workers=None):
+    """ Get the (features, labels) of all pixels covered by label geometries """
+    ds = raster.open_cached(image_path)
+    tile_list = tiles.tiles(ds.RasterXSize, ds.RasterYSize, tile_size)
+    tasks = [(tile, selected, image_path, texture, size)
+             for tile, selected in label_tiles(labels, tile_list, ds.GetGeoTransform())]
+    X, y = [], []
+    for X_tile, y_tile in tiles.run(sample_tile, tasks, workers):
+        X.append(X_tile)
+        y.append(y_tile)
+    if not X:
+        return np.zeros((0, ds.RasterCount + len(texture.sd)), dtype=np.float32), np.zeros(0, dtype=np.uint8)
+    return np.concatenate(X), np.concatenate(y)
+
+
+##### CLASSIFICATION #####
+_model = None
+
+
+def init_model(model):
+    """ Process pool initializer: keep the classifier in the worker, running on one core, with its own datasets """
+    global _model
+    raster.clear_cache()
+    _model = model
+    if hasattr(_model, "n_jobs"):
+        _model.n_jobs = 1
+
+
+def classify_tile(task):
+    """ Classify the pixels of a tile: task is (tile, image_path, texture, size), NO_LABEL where features are missing """
+    tile, image_path, texture, size = task
+    ds = raster.open_cached(image_path)
+    features = feature_tile(ds, tile, texture, size)
+    X = features.reshape(features.shape[0], -1).T
+    valid = np.isfinite(X).all(axis=1)
+    classes = np.full(X.shape[0], NO_LABEL, dtype=np.uint8)
+    if valid.any():
+        classes[valid] = _model.predict(X[valid])
+    return tile, classes.reshape(tile.ysize, tile.xsize)
+
+
+##### OBJECTS #####
+def segment_sums(ids, features):
+    """ Get the (ids, counts, feature sums) of the segments of a tile, ignoring pixels with missing features """
+    values = features.reshape(features.shape[0], -1)
+    ids = ids.ravel()
+    keep = (ids > 0) & np.isfinite(values).all(axis=0)
+    unique, inverse = np.unique(ids[keep], return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(unique))
+    sums = np.stack([np.bincount(inverse, weights=v[keep], minlength=len(unique)) for v in values], axis=1)
+    return unique, counts, sums
+
+
+class SegmentStats(object):
+    """ Pixel count and feature sums of every segment id (0 is no segment) """
+
+    def __init__(self, n_segments, n_features):
+        self.count = np.zeros(n_segments + 1, dtype=np.int64)
+        self.sums = np.zeros((n_segments + 1, n_features))
+
+    def add(self, ids, counts, sums):
+        """ Add the segment_sums of a tile, the ids of a tile are unique """
+        self.count[ids] += counts
+        self.sums[ids] += sums
+
+    def means(self):
+        """ Get the mean features of every segment id, NaN for empty segments """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (self.sums / self.count[:, None]).astype(np.float32)
+
+
+def segment_tile(task):
+    """ Segment a tile and get its segment_sums: task is (tile, image_path, texture, size, snic_args)
+
+    snic_args are the (spacing, compactness, connectivity, overlap) of snic.segment_tile.
+    """
+    tile, image_path, texture, size, snic_args = task
+    ds = raster.open_cached(image_path)
+    ids = snic.segment_tile(ds, tile, *snic_args)
+    return tile, ids, segment_sums(ids, feature_tile(ds, tile, texture, size))
+
+
+def segment(image_path, clusters_path, texture, size, snic_args, tile_size=256, workers=None):
+    """ Write the segment ids of an image to clusters_path and get the SegmentStats of its features """
+    ds = raster.open_cached(image_path)
+    tile_list = tiles.tiles(ds.RasterXSize, ds.RasterYSize, tile_size)
+    stats = SegmentStats(snic.n_segments(ds.RasterXSize, ds.RasterYSize, snic_args[0]),
+                         ds.RasterCount + len(texture.sd))
+    tasks = [(tile, image_path, texture, size, snic_args) for tile in tile_list]
+    with raster.TileWriter(clusters_path, ds.RasterXSize, ds.RasterYSize, 1, ds.GetGeoTransform(), ds.GetProjection(),
+                           np.int32, 0, ["clusters"]) as writer:
+        for n, (tile, ids, sums) in enumerate(tiles.run(segment_tile, tasks, workers)):
+            writer.write(tile, ids)
+            stats.add(*sums)
+            if (n + 1) % 100 == 0:
+                print("{} / {} tiles".format(n + 1, len(tasks)))
+    return stats
+
+
+def sample_segment_tile(task):
+    """ Get the (segment ids, labels) of the labelled pixels of a tile: task is (tile, labels, clusters_path) """
+    tile, labels, clusters_path = task
+    ds = raster.open_cached(clusters_path)
+    label = rasterize_labels(ds, tile, labels).ravel()
+    ids = tiles.read_window(ds, tile)[0].ravel()
+    keep = (label != NO_LABEL) & (ids > 0)
+    return ids[keep], label[keep]
+
+
+def sample_segments(clusters_path, labels, stats, tile_size=256, workers=None):
+    """ Get the (segment mean features, labels) of all pixels covered by label geometries """
+    ds = raster.open_cached(clusters_path)
+    tile_list = tiles.tiles(ds.RasterXSize, ds.RasterYSize, tile_size)
+    tasks = [(tile, selected, clusters_path) for tile, selected in label_tiles(labels, tile_list, ds.GetGeoTransform())]
+    ids, y = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.uint8)]
+    for ids_tile, y_tile in tiles.run(sample_segment_tile, tasks, workers):
+        ids.append(ids_tile)
+        y.append(y_tile)
+    ids, y = np.concatenate(ids), np.concatenate(y)
+    keep = stats.count[ids] > 0
+    return stats.means()[ids[keep]], y[keep]
+
+
+def classify_segments(model, stats):
+    """ Get the class of every segment id, NO_LABEL for empty segments """
+    classes = np.full(len(stats.count), NO_LABEL, dtype=np.uint8)
+    valid = np.flatnonzero(stats.count > 0)
+    if len(valid):
+        classes[valid] = model.predict(stats.means()[valid])
+    return classes
+
+
+_classes = None
+
+
+def init_classes(classes):
+    """ Process pool initializer: keep the segment classes in the worker, with its own datasets """
+    global _classes
+    raster.clear_cache()
+    _classes = classes
+
+
+def classify_segment_tile(task):
+    """ Get the classes of the pixels of a tile from their segment: task is (tile, clusters_path) """
+    tile, clusters_path = task
+    return tile, _classes[tiles.read_window(raster.open_cached(clusters_path), tile)[0]]
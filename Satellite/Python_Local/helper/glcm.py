@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+GLCM texture
+
+Local counterpart of ee.Image.glcmTexture for the bands used by
+LULC_RandomForest.js: gray_corr, gray_ent, gray_idm and gray_savg. For every
+pixel, the co-occurrences of gray levels within the (2*size+1)^2 window are
+counted for the offsets of GLCM_OFFSETS and the statistics are averaged over
+the offsets.
+
+All pixels of an image are computed in one sweep per offset. Correlation,
+inverse difference moment and sum average only depend on sums over the
+pixel pairs of a window, which are read from integral images of the pair
+values at a constant cost per pixel. Entropy needs the pair histogram of
+each window: the histograms of all window rows are slid across the image
+together, adding and removing one column of pairs per step and updating
+sum(c log c) incrementally.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+GLCM_BANDS = ["gray_corr", "gray_ent", "gray_idm", "gray_savg"]
+# (dy, dx) offsets, the statistics do not depend on the sign of the offset
+GLCM_OFFSETS = [(0, 1), (1, 1), (1, 0), (1, -1)]
+
+
+def quantize(gray, vmin=0.0, vmax=0.3, levels=100):
+    """ Rescale gray values from [vmin, vmax] to integer levels [0, levels], -1 where gray is NaN
+
+    Same as gray.unitScale(vmin, vmax).multiply(levels).toInt() on GEE, with
+    values outside the range clipped.
+    """
+    scaled = (np.asarray(gray, dtype=np.float32) - vmin) / (vmax - vmin) * levels
+    q = np.clip(np.nan_to_num(scaled, nan=-1), 0, levels).astype(np.int16)
+    q[np.isnan(scaled)] = -1
+    return q
+
+
+def pair_images(q, dy, dx):
+    """ Get the first and second pixel of every (dy, dx) pair of an image """
+    x0, x1 = max(0, -dx), max(0, dx)
+    height, width = q.shape
+    first = q[:height - dy, x0:width - x1]
+    second = q[dy:, x0 + dx:width - x1 + dx]
+    return first, second
+
+
+def box_sums(values, window, shape):
+    """ Get the sums of values over all windows (rows, cols) with an integral image """
+    integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=values.dtype)
+    np.cumsum(values, axis=0, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    h, w = window
+    height, width = shape
+    return (integral[h:h + height, w:w + width] - integral[:height, w:w + width]
+            - integral[h:h + height, :width] + integral[:height, :width])
+
+
+def sliding_entropy(codes, window, n, n_codes):
+    """ Get the entropy of the valid codes (>= 0) in all windows of a code image
+
+    n is the number of valid codes of each window (rows, cols). One
+    histogram per output row is kept and all rows are slid one column at a
+    time. With the running sum of c log c over the histogram bins, the
+    entropy is log n - sum(c log c) / n.
+    """
+    h, w = window
+    height, width = n.shape
+    clogc = np.arange(h * w + 2, dtype=np.float64)
+    clogc[1:] *= np.log(clogc[1:])
+    step = np.diff(clogc)  # c log c increase from c to c+1
+
+    # Invalid codes are counted in an extra bin with zero weight
+    weight = sliding_window_view((codes >= 0).astype(np.float64), h, axis=0)[:height]
+    codes = np.where(codes >= 0, codes, n_codes).astype(np.int64)
+    index = sliding_window_view(codes, h, axis=0)[:height] + (np.arange(height) * (n_codes + 1))[:, None, None]
+    counts = np.zeros(height * (n_codes + 1), dtype=np.int32)
+    sum_clogc = np.zeros(height)
+    ent = np.empty((height, width), dtype=np.float64)
+
+    def add(col):
+        for t in range(h):
+            i, c = index[:, col, t], counts[index[:, col, t]]
+            sum_clogc[:] += step[c] * weight[:, col, t]
+            counts[i] = c + 1
+
+    def remove(col):
+        for t in range(h):
+            i, c = index[:, col, t], counts[index[:, col, t]] - 1
+            sum_clogc[:] -= step[c] * weight[:, col, t]
+            counts[i] = c
+
+    for col in range(w):
+        add(col)
+    for j in range(width):
+        if j > 0:
+            remove(j - 1)
+            add(j + w - 1)
+        ent[:, j] = sum_clogc
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.log(n) - ent / n
+
+
+def glcm_texture(q, size=3, levels=100, offsets=GLCM_OFFSETS):
+    """ Get gray_corr, gray_ent, gray_idm and gray_savg (4, rows, cols) of a quantized image
+
+    q holds gray levels [0, levels] (-1 for no data) and a halo of size
+    pixels on every side, which is not part of the output. Windows without
+    valid pairs are NaN, windows with constant gray levels have zero
+    correlation.
+    """
+    shape = (q.shape[0] - 2 * size, q.shape[1] - 2 * size)
+    out = np.zeros((4,) + shape, dtype=np.float64)
+    for dy, dx in offsets:
+        first, second = pair_images(q, dy, dx)
+        window = (2 * size + 1 - abs(dy), 2 * size + 1 - abs(dx))
+        valid = (first >= 0) & (second >= 0)
+        a = np.where(valid, first, 0).astype(np.int64)
+        b = np.where(valid, second, 0).astype(np.int64)
+        # Integer sums are exact, only idm is summed in floating point
+        n = box_sums(valid.astype(np.int64), window, shape).astype(np.float64)
+        sum_a, sum_b = box_sums(a, window, shape), box_sums(b, window, shape)
+        sum_aa, sum_bb = box_sums(a * a, window, shape), box_sums(b * b, window, shape)
+        sum_ab = box_sums(a * b, window, shape)
+        sum_idm = box_sums(valid / (1.0 + (a - b) ** 2), window, shape)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_a, mean_b = sum_a / n, sum_b / n
+            var_a = sum_aa / n - mean_a ** 2
+            var_b = sum_bb / n - mean_b ** 2
+            cov = sum_ab / n - mean_a * mean_b
+            std = np.sqrt(np.maximum(var_a, 0) * np.maximum(var_b, 0))
+            corr = np.where(std > 1e-12, cov / np.where(std > 1e-12, std, 1), 0)
+            out[0] += np.where(n > 0, corr, np.nan)
+            out[2] += sum_idm / n
+        out[1] += sliding_entropy(np.where(valid, first.astype(np.int64) * (levels + 1) + second, -1),
+                                  window, n, (levels + 1) ** 2)
+        out[3] += mean_a + mean_b
+    return (out / len(offsets)).astype(np.float32)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Raster output
+
+Outputs are streamed tile by tile into a tiled GeoTIFF and converted to a
+Cloud Optimized GeoTIFF (compressed, with internal overviews) at the end.
+"""
+
+import os
+
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+GDAL_TYPES = {np.dtype(np.float32): gdal.GDT_Float32,
+              np.dtype(np.float64): gdal.GDT_Float64,
+              np.dtype(np.int32): gdal.GDT_Int32,
+              np.dtype(np.uint16): gdal.GDT_UInt16,
+              np.dtype(np.int16): gdal.GDT_Int16,
+              np.dtype(np.uint8): gdal.GDT_Byte}
+
+_datasets = {}
+
+
+def open_cached(path):
+    """ Open a dataset once per process """
+    if path not in _datasets:
+        _datasets[path] = gdal.Open(path)
+    return _datasets[path]
+
+
+def clear_cache():
+    """ Forget the cached datasets, e.g. in a forked worker: its inherited handles share the parent's file offsets """
+    _datasets.clear()
+
+
+if hasattr(os, "register_at_fork"):  # not on Windows, where workers are spawned with an empty cache
+    os.register_at_fork(after_in_child=clear_cache)
+
+
+class TileWriter(object):
+    """ Write tiles (bands, rows, cols) into a tiled GeoTIFF and convert it to a COG on close """
+
+    def __init__(self, out_path, width, height, n_bands, geotransform, projection, dtype=np.float32,
+                 nodata=None, band_names=None, compress="DEFLATE"):
+        self.out_path = out_path
+        self.tmp_path = out_path + ".tmp.tif"
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+        self.ds = gdal.GetDriverByName("GTiff").Create(self.tmp_path, width, height, n_bands, GDAL_TYPES[self.dtype],
+                                                       options=["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256",
+                                                                "COMPRESS=LZW", "BIGTIFF=IF_SAFER"])
+        self.ds.SetGeoTransform(geotransform)
+        self.ds.SetProjection(projection)
+        for b in range(n_bands):
+            band = self.ds.GetRasterBand(b+1)
+            if nodata is not None:
+                band.SetNoDataValue(nodata)
+            if band_names is not None:
+                band.SetDescription(band_names[b])
+
+    def write(self, tile, array):
+        """ Write the bands of a tile """
+        array = np.asarray(array, dtype=self.dtype)
+        if array.ndim == 2:
+            array = array[None]
+        for b in range(array.shape[0]):
+            self.ds.GetRasterBand(b+1).WriteArray(array[b], tile.xoff, tile.yoff)
+
+    def close(self):
+        """ Convert the GeoTIFF to a COG """
+        self.ds.FlushCache()
+        self.ds = None
+        options = ["COMPRESS={}".format(self.compress), "OVERVIEWS=AUTO", "BIGTIFF=IF_SAFER"]
+        if self.compress in ("DEFLATE", "ZSTD", "LZW"):
+            options.append("PREDICTOR={}".format("FLOATING_POINT" if self.dtype.kind == "f" else "STANDARD"))
+        gdal.Translate(self.out_path, self.tmp_path, format="COG", creationOptions=options)
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.ds = None
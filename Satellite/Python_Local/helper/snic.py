@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+SNIC superpixels
+
+Local counterpart of ee.Algorithms.Image.Segmentation.SNIC with the seeds of
+seedGrid, used by the object-based mode of LULC_RandomForest.py. Starting
+from the seeds, pixels are taken from a priority queue in order of their
+distance to the centroid of the neighbouring superpixel and the centroid is
+updated with every pixel (Achanta & Susstrunk, 2017):
+
+    distance^2 = |color - centroid color|^2 + (compactness / spacing)^2 * |xy - centroid xy|^2
+
+Large rasters are segmented in tiles, each read with an overlap so that
+superpixels are not cut at the tile borders (neighborhoodSize on GEE). The
+seeds lie on one grid for the whole raster and a superpixel takes the id of
+its seed, so a superpixel crossing a tile border has the same id in both
+tiles without relabelling.
+"""
+
+import heapq
+import math
+
+import numpy as np
+
+from . import tiles
+
+NEIGHBORS = {4: [(-1, 0), (0, -1), (0, 1), (1, 0)],
+             8: [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]}
+
+
+def seed_grid(width, height, spacing):
+    """ Get the number of (rows, cols) of the seed grid of a raster """
+    return len(range(spacing // 2, height, spacing)), len(range(spacing // 2, width, spacing))
+
+
+def n_segments(width, height, spacing):
+    """ Get the largest segment id of a raster (0 is no segment) """
+    rows, cols = seed_grid(width, height, spacing)
+    return rows * cols
+
+
+def window_seeds(width, height, spacing, xoff, yoff, xsize, ysize):
+    """ Get the (row, col, id) of the seeds in a window, in window pixels """
+    seed_cols = seed_grid(width, height, spacing)[1]
+    seeds = []
+    for row in range(spacing // 2, height, spacing):
+        if yoff <= row < yoff + ysize:
+            for col in range(spacing // 2, width, spacing):
+                if xoff <= col < xoff + xsize:
+                    seeds.append((row - yoff, col - xoff, 1 + (row // spacing) * seed_cols + col // spacing))
+    return seeds
+
+
+def snic(image, seeds, spacing, compactness=1.0, connectivity=8):
+    """ Segment an image (bands, rows, cols) from seeds [(row, col, id)]
+
+    Pixels with a NaN band are not segmented. Returns the segment ids
+    (rows, cols) as int32, 0 where no segment was grown.
+    """
+    n_bands, rows, cols = image.shape
+    # Pixels are vectors of colors and weighted coordinates, so that the
+    # distance is one math.dist. The image gets a border of invalid pixels
+    # instead of bound checks.
+    width = cols + 2
+    valid = np.pad(np.isfinite(image).all(axis=0), 1).ravel().tolist()
+    weight = float(compactness) / spacing
+    row, col = np.mgrid[-1:rows + 1, -1:cols + 1]
+    vectors = np.concatenate([np.pad(np.nan_to_num(image), ((0, 0), (1, 1), (1, 1))),
+                              weight * row[None], weight * col[None]]).reshape(n_bands + 2, -1).T.tolist()
+    steps = [dr * width + dc for dr, dc in NEIGHBORS[connectivity]]
+    labels = [0] * len(valid)
+    # Smallest distance queued for each pixel, farther candidates are not queued
+    best = [math.inf] * len(valid)
+
+    # Running sums of the superpixel vectors
+    count = [0] * len(seeds)
+    sums = [[0.0] * (n_bands + 2) for seed in seeds]
+    queue = [(0.0, (row + 1) * width + col + 1, k) for k, (row, col, id) in enumerate(seeds)]
+    queue = [item for item in queue if valid[item[1]]]
+    heapq.heapify(queue)
+    heappush, heappop, dist = heapq.heappush, heapq.heappop, math.dist
+
+    while queue:
+        d, i, k = heappop(queue)
+        if labels[i]:
+            continue
+        labels[i] = k + 1
+        count[k] += 1
+        n = float(count[k])
+        total = sums[k] = [s + v for s, v in zip(sums[k], vectors[i])]
+        centroid = [s / n for s in total]
+        for step in steps:
+            j = i + step
+            if not labels[j] and valid[j]:
+                d = dist(vectors[j], centroid)
+                if d < best[j]:
+                    best[j] = d
+                    heappush(queue, (d, j, k))
+
+    ids = np.array([0] + [id for row, col, id in seeds], dtype=np.int32)
+    return ids[np.array(labels, dtype=np.int64).reshape(rows + 2, width)[1:-1, 1:-1]]
+
+
+def segment_tile(ds, tile, spacing, compactness=1.0, connectivity=8, overlap=None, bands=None):
+    """ Get the segment ids of a tile, segmented with an overlap of pixels (default: 2 seed spacings) """
+    if overlap is None:
+        overlap = 2 * spacing
+    width, height = ds.RasterXSize, ds.RasterYSize
+    image = tiles.read_window(ds, tile, overlap, bands).astype(np.float32)
+    # Do not grow segments into the reflected padding outside the raster
+    (top, bottom), (left, right) = tile.pad(overlap, width, height)
+    image[:, :top] = np.nan
+    image[:, image.shape[1] - bottom:] = np.nan
+    image[:, :, :left] = np.nan
+    image[:, :, image.shape[2] - right:] = np.nan
+    xoff, yoff = tile.xoff - overlap, tile.yoff - overlap
+    seeds = window_seeds(width, height, spacing, xoff, yoff, image.shape[2], image.shape[1])
+    return snic(image, seeds, spacing, compactness, connectivity)[tile.core(overlap)]
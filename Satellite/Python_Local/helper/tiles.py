@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Tiled processing
+
+Large rasters are processed tile by tile so that memory stays bounded by the
+tile size. Neighbourhood operations (e.g. GLCM windows) read each tile with
+a halo of extra pixels and only keep the core of the result. Tiles are run
+in a process pool and their results are returned in order, so a single
+writer can stream them to the output.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+class Tile(namedtuple("Tile", ["xoff", "yoff", "xsize", "ysize"])):
+    """ Pixel window of a tile """
+
+    def window(self, halo, width, height):
+        """ Get the (xoff, yoff, xsize, ysize) window of the tile grown by halo, clipped to the raster """
+        x0, y0 = max(self.xoff - halo, 0), max(self.yoff - halo, 0)
+        x1 = min(self.xoff + self.xsize + halo, width)
+        y1 = min(self.yoff + self.ysize + halo, height)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def pad(self, halo, width, height):
+        """ Get the ((top, bottom), (left, right)) padding that makes the clipped window a full halo window """
+        x0, y0, xsize, ysize = self.window(halo, width, height)
+        return ((y0 - (self.yoff - halo), (self.yoff + self.ysize + halo) - (y0 + ysize)),
+                (x0 - (self.xoff - halo), (self.xoff + self.xsize + halo) - (x0 + xsize)))
+
+    def core(self, halo):
+        """ Get the (rows, cols) slices of the tile in a full halo window """
+        return slice(halo, halo + self.ysize), slice(halo, halo + self.xsize)
+
+
+def tiles(width, height, tile_size=512):
+    """ Get the tiles covering a raster, row by row """
+    return [Tile(xoff, yoff, min(tile_size, width - xoff), min(tile_size, height - yoff))
+            for yoff in range(0, height, tile_size)
+            for xoff in range(0, width, tile_size)]
+
+
+def read_window(ds, tile, halo=0, bands=None):
+    """ Read a tile with halo from a GDAL dataset as (bands, rows, cols)
+
+    Where the halo falls outside the raster, the window is padded by
+    reflecting the edge pixels.
+    """
+    width, height = ds.RasterXSize, ds.RasterYSize
+    xoff, yoff, xsize, ysize = tile.window(halo, width, height)
+    if bands is None:
+        bands = range(1, ds.RasterCount + 1)
+    array = np.stack([ds.GetRasterBand(b).ReadAsArray(xoff, yoff, xsize, ysize) for b in bands])
+    if halo:
+        (top, bottom), (left, right) = tile.pad(halo, width, height)
+        if top or bottom or left or right:
+            array = np.pad(array, ((0, 0), (top, bottom), (left, right)), mode="reflect")
+    return array
+
+
+def array_window(array, tile, halo=0):
+    """ Get a tile with halo of an in-memory array (rows, cols) or (bands, rows, cols), padded as read_window """
+    height, width = array.shape[-2:]
+    xoff, yoff, xsize, ysize = tile.window(halo, width, height)
+    window = array[..., yoff:yoff + ysize, xoff:xoff + xsize]
+    if halo:
+        (top, bottom), (left, right) = tile.pad(halo, width, height)
+        if top or bottom or left or right:
+            window = np.pad(window, ((0, 0),) * (array.ndim - 2) + ((top, bottom), (left, right)), mode="reflect")
+    return window
+
+
+def run(fn, tasks, workers=None, initializer=None, initargs=()):
+    """ Map fn over tasks in a process pool (workers is None or > 1) or serially, in order """
+    if workers is not None and workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield fn(task)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        for result in executor.map(fn, tasks):
+            yield result
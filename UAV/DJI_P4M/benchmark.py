@@ -0,0 +1,349 @@
+"""
+Benchmark of the DJI P4M correction and stacking code
+
+Generates synthetic DJI P4M image sets: 5 bands of 16-bit TIFF with the
+XMP / EXIF tags read by the correction (VignettingData, DewarpData,
+RelativeOpticalCenterX/Y, Irradiance, ...), each band warped from the NIR
+band by a known homography. The bands are drawn in the corrected image
+frame and sent through the inverse of the correction remap and vignetting,
+so the homographies hold on the exported reflectance. For every dataset
+size (number of image sets) it times the metadata extraction (ExifTool),
+the correction, the reflectance export and the alignment and stacking of
+the exported reflectance (parallel.stack_sets, as in process.py), and
+checks the alignment warps against the homographies (mean reprojection
+error in pixels).
+
+Results are written to a JSON file. With a baseline (the JSON of an earlier
+run), the times are compared and the steps slower than the tolerance are
+reported as regressions.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --sets 1 4 16 --width 1600 --height 1300 --workers 4 --output benchmark.json
+    python benchmark.py --baseline benchmark.json --tolerance 0.2
+    python benchmark.py --water 0.7 --texture-tile 64 --min-cc 0.7 --features orb
+"""
+
+import os, sys, json, time, shutil, argparse, tempfile, platform
+# The EXIF tags are written to IFD0, which OpenCV's TIFF reader warns about on every image
+os.environ.setdefault("OPENCV_LOG_LEVEL", "ERROR")
+import numpy as np
+import cv2
+import tifffile
+
+import helper.metadata as metadata
+import helper.imageset as imageset
+import helper.correction as correction
+import helper.reflectance as reflectance
+import helper.parallel as parallel
+import helper.profiling as profiling
+
+BAND_NAMES = ["Blue", "Green", "Red", "RedEdge", "NIR"]
+BAND_RESPONSE = [0.6, 0.8, 0.7, 1.1, 1.4]
+NIR = BAND_NAMES.index("NIR")
+BLACK_LEVEL = 4096
+ADD_CROP_PIXELS = 10
+
+
+##### SYNTHETIC DATA #####
+def band_homographies(width, height, seed=0):
+    """ Get the homography of every band onto the NIR band (identity for NIR): small shifts, rotations, scales """
+    rng = np.random.default_rng(seed)
+    center = np.array([[1, 0, width / 2.0], [0, 1, height / 2.0], [0, 0, 1]])
+    homographies = []
+    for b in range(len(BAND_NAMES)):
+        if b == NIR:
+            homographies.append(np.eye(3))
+            continue
+        angle, scale = np.radians(rng.uniform(-0.3, 0.3)), 1 + rng.uniform(-0.003, 0.003)
+        H = np.array([[scale * np.cos(angle), -scale * np.sin(angle), rng.uniform(-6, 6)],
+                      [scale * np.sin(angle), scale * np.cos(angle), rng.uniform(-6, 6)],
+                      [rng.uniform(-2e-7, 2e-7) * 1600 / width, rng.uniform(-2e-7, 2e-7) * 1600 / width, 1]])
+        homographies.append(center.dot(H).dot(np.linalg.inv(center)))
+    return homographies
+
+
+def synthetic_scene(width, height, water=0.0, seed=0):
+    """ Get the reflectance of every band: textured land and a flat water strip (water: fraction of the width) """
+    rng = np.random.default_rng(seed)
+    land = np.zeros((height, width), np.float32)
+    for sigma, weight in ((2, 0.2), (8, 0.3), (32, 0.5)):
+        noise = cv2.GaussianBlur(rng.random((height, width), dtype=np.float32), (0, 0), sigma * width / 1600.0 + 0.5)
+        land += weight * (noise - noise.mean()) / (noise.std() + 1e-9)
+    land = np.clip(0.25 + 0.06 * land, 0.02, 0.6)
+    water_mask = np.zeros((height, width), bool)
+    water_mask[:, :int(round(water * width))] = True
+    bands = []
+    for response in BAND_RESPONSE:
+        band = land * response + rng.normal(0, 0.002, (height, width)).astype(np.float32)
+        # Water is dark and flat (darker in the infrared), with a few sunglint spots
+        band[water_mask] = 0.05 / response + rng.normal(0, 0.001, water_mask.sum())
+        band[water_mask & (rng.random((height, width)) < 0.0005)] = 0.8
+        bands.append(band)
+    return bands
+
+
+def synthetic_tags(band, width, height, set_index):
+    """ Get the XMP / EXIF tags of a band, keyed as extracted by ExifTool """
+    scale = width / 1600.0
+    return {"XMP:Make": "DJI",
+            "XMP:Model": "FC6360",
+            "XMP:BandName": BAND_NAMES[band],
+            "XMP:RelativeAltitude": 50.0 + 0.1 * set_index,
+            "XMP:RelativeOpticalCenterX": [2.5, -1.8, 3.1, -2.2, 0.0][band] * scale,
+            "XMP:RelativeOpticalCenterY": [-1.4, 2.6, 0.9, -3.3, 0.0][band] * scale,
+            "XMP:CalibratedOpticalCenterX": width / 2.0 + [3.2, -2.1, 1.5, -0.8, 0.4][band],
+            "XMP:CalibratedOpticalCenterY": height / 2.0 + [-1.7, 2.4, -0.6, 1.3, 0.2][band],
+            "XMP:VignettingData": ", ".join("{:.6e}".format(k / scale ** (n + 1)) for n, k in
+                                            enumerate([1.0e-4, 2.0e-7, 1.0e-10, -5.0e-14, 1.0e-17, -1.0e-21])),
+            "XMP:DewarpData": "2020-06-12;{0:.2f},{0:.2f},{1:.2f},{2:.2f},-0.0890,0.0740,0.0001,0.0003,-0.0300".format(
+                1460.0 * scale, [4.0, -3.1, 2.2, -1.0, 0.5][band], [-3.0, 1.9, -2.4, 0.8, 0.3][band]),
+            "XMP:SensorGain": 1.0,
+            "XMP:SensorGainAdjustment": [1.21, 1.05, 0.98, 1.12, 1.0][band],
+            "XMP:Irradiance": [900.0, 1020.0, 1105.0, 980.0, 760.0][band] * (1 + 0.01 * set_index),
+            "EXIF:ExposureTime": [1100.0, 900.0, 800.0, 700.0, 500.0][band],
+            "EXIF:BlackLevel": BLACK_LEVEL,
+            "EXIF:FocalLength": 5.74}
+
+
+def xmp_packet(tags):
+    """ Build the XMP packet of a DJI P4M band image from its tags """
+    namespaces = {"XMP:Make": "tiff:Make", "XMP:Model": "tiff:Model", "XMP:BandName": "Camera:BandName"}
+    attributes = "".join('\n    {}="{}"'.format(namespaces.get(k, "drone-dji:" + k.split(":")[1]), v)
+                         for k, v in tags.items() if k.startswith("XMP:"))
+    return ('<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+            ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+            '  <rdf:Description rdf:about=""\n'
+            '    xmlns:tiff="http://ns.adobe.com/tiff/1.0/"\n'
+            '    xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/"\n'
+            '    xmlns:Camera="http://pix4d.com/camera/1.0/"{}/>\n'
+            ' </rdf:RDF>\n'
+            '</x:xmpmeta>\n'
+            '<?xpacket end="w"?>').format(attributes)
+
+
+def write_band(file_path, image, tags):
+    """ Write a 16-bit band image with its EXIF tags (IFD0) and XMP packet """
+    xmp = xmp_packet(tags).encode("utf-8")
+    extratags = [(700, "B", len(xmp), xmp, True),
+                 (33434, "2I", 1, (int(tags["EXIF:ExposureTime"]), 1), True),
+                 (37386, "2I", 1, (int(tags["EXIF:FocalLength"] * 100), 100), True),
+                 (50714, "H", 1, tags["EXIF:BlackLevel"], True)]
+    tifffile.imwrite(file_path, image, extratags=extratags, metadata=None)
+
+
+def vignette(tags, width, height):
+    """ Get the vignetting factor of the raw pixels of a band (the inverse of the correction gain) """
+    coord_x, coord_y = np.meshgrid(np.arange(1, width + 1) - tags["XMP:RelativeOpticalCenterX"],
+                                   np.arange(1, height + 1) - tags["XMP:RelativeOpticalCenterY"])
+    r = np.sqrt((coord_x - tags["XMP:CalibratedOpticalCenterX"]) ** 2 +
+                (coord_y - tags["XMP:CalibratedOpticalCenterY"]) ** 2)
+    k = [float(i) for i in tags["XMP:VignettingData"].split(",")]
+    return 1.0 / np.polyval([k[5], k[4], k[3], k[2], k[1], k[0], 1.0], r)
+
+
+def inverse_maps(calib, iterations=20):
+    """ Get the corrected pixel sampled by every raw pixel, inverting the correction remap by fixed point iteration """
+    map_x, map_y = cv2.convertMaps(calib.map1, calib.map2, cv2.CV_32FC1)
+    height, width = map_x.shape
+    raw_x, raw_y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    x, y = raw_x.copy(), raw_y.copy()
+    for _ in range(iterations):
+        x += raw_x - cv2.remap(map_x, x, y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        y += raw_y - cv2.remap(map_y, x, y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    return x, y
+
+
+def reflectance_frame(calibs, width, height):
+    """ Get the (x, y) offset and (width, height) of the exported reflectance in the corrected frame """
+    crop_left, crop_right, crop_bottom, crop_top = [max(c) + ADD_CROP_PIXELS for c in zip(*[c.crop() for c in calibs])]
+    return (crop_bottom, crop_left), (width - crop_bottom - crop_top, height - crop_left - crop_right)
+
+
+def synthetic_dataset(raw_dir, n_sets, width=1600, height=1300, water=0.0, seed=0):
+    """ Write n_sets synthetic image sets to raw_dir
+
+    Returns {file path: tags}, {set id: [band homographies onto the NIR
+    band]} and the reflectance size: the homographies are given in the
+    frame of the exported reflectance (corrected and cropped).
+    """
+    rig = band_homographies(width, height, seed)
+    rng = np.random.default_rng(seed + 1)
+    band_tags = [synthetic_tags(b, width, height, 0) for b in range(len(BAND_NAMES))]
+    engine = correction.CorrectionEngine()
+    calibs = [engine.calibration(metadata.Metadata.from_dict(tags), width, height) for tags in band_tags]
+    maps = [inverse_maps(calib) for calib in calibs]
+    gains = [vignette(tags, width, height) for tags in band_tags]
+    (x0, y0), size = reflectance_frame(calibs, width, height)
+    to_frame = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]])
+    file_tags, sets = {}, {}
+    for s in range(n_sets):
+        set_id = "{:03d}".format(s + 1)
+        scene = synthetic_scene(width, height, water, seed + 2 + s)
+        # The rig barely moves between captures: a sub-pixel jitter per set
+        jitter = np.array([[1, 0, rng.uniform(-0.3, 0.3)], [0, 1, rng.uniform(-0.3, 0.3)], [0, 0, 1]])
+        homographies = [H if b == NIR else jitter.dot(H) for b, H in enumerate(rig)]
+        for b, H in enumerate(homographies):
+            image = cv2.warpPerspective(scene[b], H, (width, height), borderMode=cv2.BORDER_REFLECT)
+            image = cv2.remap(image, maps[b][0], maps[b][1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+            tags = synthetic_tags(b, width, height, s)
+            raw = np.clip(BLACK_LEVEL + image * 40000 * gains[b], 0, 65535).astype(np.uint16)
+            file_path = os.path.join(raw_dir, "DJI_{}{}.TIF".format(set_id, b + 1))
+            write_band(file_path, raw, tags)
+            file_tags[file_path] = tags
+        sets[set_id] = [to_frame.dot(H).dot(np.linalg.inv(to_frame)) for H in homographies]
+    return file_tags, sets, size
+
+
+##### CHECKS #####
+def same_tags(exif, tags):
+    """ Check that extracted metadata holds the written tags """
+    for key, value in tags.items():
+        if key not in exif:
+            return False
+        if isinstance(value, float) and not np.isclose(float(exif[key]), value, rtol=1e-6):
+            return False
+    return True
+
+
+def warp_error(warp_matrix, H, width, height, n=10):
+    """ Get the mean distance (pixels) between the points of a grid mapped by the estimated warp and by H """
+    x, y = np.meshgrid(np.linspace(0, width - 1, n), np.linspace(0, height - 1, n))
+    points = np.stack([x.ravel(), y.ravel(), np.ones(n * n)])
+    mapped = [np.dot(M, points) for M in (warp_matrix, H)]
+    mapped = [m[:2] / m[2] for m in mapped]
+    return float(np.mean(np.linalg.norm(mapped[0] - mapped[1], axis=0)))
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_size(folder, n_sets, args):
+    """ Benchmark one dataset size, returns its results """
+    raw_dir = os.path.join(folder, "Raw")
+    refl_dir = os.path.join(folder, "Reflectance")
+    stack_dir = os.path.join(folder, "Stacked")
+    unstack_dir = os.path.join(folder, "Unstacked")
+    for d in (raw_dir, refl_dir, stack_dir, unstack_dir):
+        os.makedirs(d)
+    file_tags, homographies, (width, height) = synthetic_dataset(raw_dir, n_sets, args.width, args.height, args.water,
+                                                                 args.seed)
+    index = imageset.ImageSetIndex(raw_dir)
+    result = {"sets": n_sets, "images": len(file_tags)}
+
+    # Metadata extraction, with a cold cache
+    with metadata.MetadataStore(None, args.exiftool) as store:
+        try:
+            _, result["metadata"] = timed(store.read, index.files())
+            if not all(same_tags(store.get(f).get_all(), tags) for f, tags in file_tags.items()):
+                raise AssertionError("Extracted tags differ from the written tags")
+        except (OSError, AttributeError, ValueError) as e:
+            print("Metadata extraction skipped ({}: {})".format(type(e).__name__, e))
+            result["metadata"] = None
+        # The correction uses the written tags, so that it runs without ExifTool too
+        for file_path, tags in file_tags.items():
+            store.add(file_path, tags)
+
+        spill = reflectance.ReflectanceSpill(os.path.join(folder, "Spill"))
+        _, result["correct"] = timed(parallel.correct_sets, raw_dir, spill, index.sets, store, ADD_CROP_PIXELS,
+                                     args.workers)
+    _, result["export"] = timed(parallel.export_reflectance, spill, refl_dir, True, args.workers)
+
+    # Alignment and stacking of the exported reflectance
+    band_names = {f: BAND_NAMES[b] for file_names in index.sets.values() for b, f in enumerate(file_names)}
+    align_options = {"texture_tile": args.texture_tile, "texture_fraction": args.texture_fraction,
+                     "min_cc": args.min_cc, "features": args.features}
+    (_, stats), result["stack"] = timed(parallel.stack_sets, refl_dir, stack_dir, unstack_dir, index.sets, band_names,
+                                        args.ksize, args.n_iter, args.eps, args.workers, levels=args.levels,
+                                        align_options=align_options)
+    errors = [warp_error(np.array(r["warp"]), homographies[r["set_id"]][BAND_NAMES.index(r["key"])], width, height)
+              for r in stats if r["converged"]]
+    result["converged"] = sum(r["converged"] for r in stats)
+    result["bands"] = len(stats)
+    result["align_error"] = float(np.mean(errors)) if errors else None
+    result["align_error_max"] = float(np.max(errors)) if errors else None
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """ Get the (sets, step, time, baseline time) of the steps slower than the baseline by more than tolerance """
+    previous = {r["sets"]: r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        for step in ("metadata", "correct", "export", "stack"):
+            old = previous.get(result["sets"], {}).get(step)
+            if result[step] is not None and old and result[step] > old * (1 + tolerance):
+                regressions.append((result["sets"], step, result[step], old))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('--sets', type=int, nargs='+', default=[1, 4], help="dataset sizes, in image sets")
+    parser.add_argument('--width', type=int, default=800, help="image width (DJI P4M: 1600)")
+    parser.add_argument('--height', type=int, default=650, help="image height (DJI P4M: 1300)")
+    parser.add_argument('--water', type=float, default=0.0, help="fraction of the frames covered by water")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', '-w', type=int, default=1)
+    parser.add_argument('--exiftool', type=str, default=None, help="path to the exiftool executable")
+    parser.add_argument('--ksize', type=int, default=5)
+    parser.add_argument('--n-iter', type=int, default=2500)
+    parser.add_argument('--eps', type=float, default=1e-9)
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--texture-tile', type=int, default=0, help="see process.py")
+    parser.add_argument('--texture-fraction', type=float, default=0.3)
+    parser.add_argument('--min-cc', type=float, default=None)
+    parser.add_argument('--features', type=str, default=None, choices=["orb", "akaze"])
+    parser.add_argument('--max-error', type=float, default=0.5, help="largest mean alignment error, in pixels")
+    parser.add_argument('--output', '-o', type=str, default="benchmark.json")
+    parser.add_argument('--baseline', type=str, default=None, help="JSON of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    print("{:>5} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+        "sets", "images", "exiftool", "correct", "export", "stack", "converged", "error (px)"))
+    results = []
+    for n_sets in args.sets:
+        folder = tempfile.mkdtemp(prefix="dji_benchmark_")
+        try:
+            result = run_size(folder, n_sets, args)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        results.append(result)
+        print("{:>5} {:>7} {:>10} {:>10.2f} {:>10.2f} {:>10.2f} {:>10} {:>12}".format(
+            n_sets, result["images"], "-" if result["metadata"] is None else "{:.2f}".format(result["metadata"]),
+            result["correct"], result["export"], result["stack"], "{}/{}".format(result["converged"], result["bands"]),
+            "-" if result["align_error"] is None else "{:.3f}".format(result["align_error"])))
+
+    report = {"parameters": vars(args),
+              "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                              "cpus": os.cpu_count(), "numpy": np.__version__, "opencv": cv2.__version__},
+              "results": results,
+              "steps": profiling.profiler.summary()}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Results written to", args.output)
+
+    failed = False
+    for result in results:
+        if result["align_error"] is None or result["align_error"] > args.max_error or result["converged"] < result["bands"]:
+            print("FAILED: alignment of {} sets: {}/{} bands converged, mean error {} px".format(
+                result["sets"], result["converged"], result["bands"], result["align_error"]))
+            failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for n_sets, step, seconds, old in regressions:
+            print("REGRESSION: {} of {} sets took {:.2f} s, baseline {:.2f} s (+{:.0f}%)".format(
+                step, n_sets, seconds, old, 100 * (seconds / old - 1)))
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
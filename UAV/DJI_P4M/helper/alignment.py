@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# References:
+# https://learnopencv.com/image-alignment-ecc-in-opencv-c-python/
+
+"""
+Band alignment
+
+Align difference caused by different exposure times by warping every band
+of an image set to the NIR band with ECC image alignment on image gradients.
+
+ECC is run coarse to fine on an image pyramid: most iterations are spent on
+the small levels and the full resolution level only refines the warp. As the
+rig geometry barely changes between captures, each band is seeded with its
+warp from the previous set and only refined on the finer levels.
+
+Water and sunglint carry no usable gradient and can pull ECC to a wrong
+warp. With a texture mask, ECC only uses the tiles of the reference band
+with the strongest gradients and only runs on the window around them (e.g.
+the shore of a water frame), runs are stopped as soon as the correlation
+of a level drops below min_cc, and bands where ECC fails can fall back to a
+homography from matched keypoints (ORB / AKAZE + RANSAC).
+"""
+
+import time
+import numpy as np
+import cv2
+
+
+def get_gradient(im, ksize=5):
+    """ Get the combined x and y gradients of an image (Sobel operator) """
+    grad_x = cv2.Sobel(im, cv2.CV_32F, 1, 0, ksize=ksize)
+    grad_y = cv2.Sobel(im, cv2.CV_32F, 0, 1, ksize=ksize)
+    return cv2.addWeighted(np.absolute(grad_x), 0.5, np.absolute(grad_y), 0.5, 0)
+
+
+def gradient_pyramid(im, levels=3, ksize=5):
+    """ Get the gradients of an image pyramid, from full resolution to coarsest """
+    pyramid = [im]
+    for _ in range(levels - 1):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return [get_gradient(level, ksize) for level in pyramid]
+
+
+def identity_warp(warp_mode=cv2.MOTION_HOMOGRAPHY):
+    if warp_mode == cv2.MOTION_HOMOGRAPHY:
+        return np.eye(3, 3, dtype=np.float32)
+    return np.eye(2, 3, dtype=np.float32)
+
+
+def scale_warp(warp_matrix, factor):
+    """ Convert a warp matrix to an image scaled by factor """
+    warp_matrix = np.array(warp_matrix, dtype=np.float32)
+    warp_matrix[0:2, 2] *= factor
+    if warp_matrix.shape[0] == 3:
+        warp_matrix[2, 0:2] /= factor
+    return warp_matrix
+
+
+def warp_image(image, warp_matrix, warp_mode=cv2.MOTION_HOMOGRAPHY):
+    """ Warp an image onto the reference band with a warp matrix found by ECC """
+    height, width = image.shape[:2]
+    # Use Perspective warp when the transformation is a Homography
+    if warp_mode == cv2.MOTION_HOMOGRAPHY:
+        return cv2.warpPerspective(image, warp_matrix, (width, height),
+                                   flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+    # Use Affine warp when the transformation is not a Homography
+    return cv2.warpAffine(image, warp_matrix, (width, height),
+                          flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+
+
+def level_iterations(n_iter, levels, level):
+    """ Get the maximum ECC iterations of a pyramid level: n_iter on the coarsest, a quarter per finer level """
+    return max(n_iter // 4 ** (levels - 1 - level), 10)
+
+
+def texture_mask(grad, tile_size=64, fraction=0.3, min_score=0.25):
+    """ Get a uint8 mask of the tiles with the strongest gradients (fraction of the tiles)
+
+    Tiles are ranked by their median gradient, so that a few sunglint spots
+    do not make a water tile look textured. Tiles below min_score times the
+    best tile are left out, so mostly water frames keep their land tiles only.
+    """
+    height, width = grad.shape[:2]
+    rows, cols = -(-height // tile_size), -(-width // tile_size)
+    padded = np.full((rows * tile_size, cols * tile_size), np.nan, dtype=np.float32)
+    padded[:height, :width] = grad
+    tiles = padded.reshape(rows, tile_size, cols, tile_size).transpose(0, 2, 1, 3).reshape(rows, cols, -1)
+    score = np.nanmedian(tiles, axis=2)
+    n_tiles = max(1, int(round(fraction * score.size)))
+    selected = np.zeros(score.size, dtype=np.uint8)
+    selected[np.argsort(score, axis=None)[-n_tiles:]] = 1
+    selected[score.ravel() < min_score * np.nanmax(score)] = 0
+    mask = np.kron(selected.reshape(rows, cols), np.ones((tile_size, tile_size), dtype=np.uint8))
+    return np.ascontiguousarray(mask[:height, :width])
+
+
+def mask_window(mask, margin=32, multiple=1):
+    """ Get the (x0, y0, x1, y1) bounding box of a mask, grown by margin, with x0 / y0 multiples of multiple """
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    height, width = mask.shape[:2]
+    if not len(rows):
+        return 0, 0, width, height
+    x0 = max(0, cols[0] - margin) // multiple * multiple
+    y0 = max(0, rows[0] - margin) // multiple * multiple
+    return x0, y0, min(width, cols[-1] + 1 + margin), min(height, rows[-1] + 1 + margin)
+
+
+def crop_pyramid(pyramid, window):
+    """ Crop every level of a pyramid to a full resolution window (x0 / y0 multiples of 2 ** levels-1) """
+    x0, y0, x1, y1 = window
+    return [np.ascontiguousarray(level[y0 >> k:-(-y1 >> k), x0 >> k:-(-x1 >> k)]) for k, level in enumerate(pyramid)]
+
+
+def offset_warp(warp_matrix, x0, y0):
+    """ Convert a warp to the coordinates of a window at (x0, y0), or back with (-x0, -y0) """
+    full = np.eye(3)
+    full[:warp_matrix.shape[0]] = warp_matrix
+    T = np.array([[1, 0, x0], [0, 1, y0], [0, 0, 1]], dtype=np.float64)
+    full = np.linalg.inv(T).dot(full).dot(T)
+    return (full / full[2, 2])[:warp_matrix.shape[0]].astype(np.float32)
+
+
+def feature_detector(name="orb"):
+    if name == "orb":
+        return cv2.ORB_create(4000)
+    if name == "akaze" and hasattr(cv2, "AKAZE_create"):
+        return cv2.AKAZE_create()
+    raise ValueError("Unsupported feature detector: {}".format(name))
+
+
+def to_uint8(grad, mask=None):
+    """ Scale a gradient image to uint8 for keypoint detection (99.5th percentile of the masked values to 255) """
+    values = grad if mask is None else grad[mask > 0]
+    high = np.percentile(values, 99.5) if values.size else 1
+    return np.clip(grad * (255.0 / (high or 1)), 0, 255).astype(np.uint8)
+
+
+def feature_warp(grad_ref, grad_image, mask=None, detector="orb", ratio=0.75, min_inliers=25):
+    """ Get the homography of an image onto the reference from matched keypoints of their gradients
+
+    Matches pass Lowe's ratio test and the homography is fitted with
+    RANSAC. Returns (warp_matrix, inliers), warp_matrix None if there are
+    fewer than min_inliers inliers.
+    """
+    detect = feature_detector(detector)
+    kp_ref, des_ref = detect.detectAndCompute(to_uint8(grad_ref, mask), mask)
+    if des_ref is None or len(kp_ref) < min_inliers:
+        return None, 0
+    kp_image, des_image = detect.detectAndCompute(to_uint8(grad_image, mask), None)
+    if des_image is None or len(kp_image) < min_inliers:
+        return None, 0
+    pairs = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(des_ref, des_image, k=2)
+    matches = [p[0] for p in pairs if len(p) == 2 and p[0].distance < ratio * p[1].distance]
+    if len(matches) < min_inliers:
+        return None, 0
+    src = np.float32([kp_ref[m.queryIdx].pt for m in matches])
+    dst = np.float32([kp_image[m.trainIdx].pt for m in matches])
+    warp_matrix, inliers = cv2.findHomography(src, dst, cv2.RANSAC, 1.0)
+    n_inliers = 0 if inliers is None else int(inliers.sum())
+    if warp_matrix is None or n_inliers < min_inliers:
+        return None, n_inliers
+    return warp_matrix.astype(np.float32), n_inliers
+
+
+def warp_shift(warp_matrix, width, height):
+    """ Get the largest displacement (pixels) of the image corners by a homography """
+    corners = np.float32([[0, 0], [width - 1, 0], [0, height - 1], [width - 1, height - 1]]).reshape(-1, 1, 2)
+    return float(np.abs(cv2.perspectiveTransform(corners, np.asarray(warp_matrix, np.float32)) - corners).max())
+
+
+def find_transform_pyramid(grad_ref, grad_image, warp_matrix, warp_mode=cv2.MOTION_HOMOGRAPHY,
+                           n_iter=2500, eps=1e-9, inputMask=None, start_level=None, min_cc=None):
+    """ Run ECC coarse to fine over gradient pyramids
+
+    The coarsest level gets n_iter iterations and every finer level a
+    quarter of the level below it, so that each level costs about the same.
+    start_level skips the coarser levels (e.g. for a good initial warp).
+    warp_matrix is the full resolution initial warp. Returns the full
+    resolution warp and the correlation coefficient of the finest level.
+    With min_cc, returns (None, cc) as soon as the correlation coefficient
+    of a level is below min_cc, without running the finer levels.
+    Raises cv2.error if ECC does not converge.
+    """
+    levels = len(grad_ref)
+    if start_level is None:
+        start_level = levels - 1
+    warp_matrix = scale_warp(warp_matrix, 0.5 ** start_level)
+    cc = None
+    for level in range(start_level, -1, -1):
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, level_iterations(n_iter, levels, level), eps)
+        mask = None
+        if inputMask is not None:
+            mask = cv2.resize(inputMask, grad_image[level].shape[1::-1], interpolation=cv2.INTER_NEAREST)
+        (cc, warp_matrix) = cv2.findTransformECC(grad_ref[level],
+                                                 grad_image[level],
+                                                 warp_matrix,
+                                                 warp_mode,
+                                                 criteria,
+                                                 inputMask=mask,
+                                                 gaussFiltSize=1)
+        if min_cc is not None and cc < min_cc:
+            return None, cc
+        if level > 0:
+            warp_matrix = scale_warp(warp_matrix, 2)
+    return warp_matrix, cc
+
+
+class BandAligner(object):
+    """ Pyramid ECC alignment of image sets, reusing each band's warp from the previous set
+
+    With texture_tile, ECC only uses the texture_fraction of texture_tile
+    tiles with the strongest reference gradients (see texture_mask). min_cc
+    rejects ECC runs whose correlation coefficient drops below it (checked
+    on every level, so failing runs stop early). features ("orb" or
+    "akaze") enables the keypoint fallback for the bands where ECC fails:
+    its homography is kept if it has min_inliers RANSAC inliers and moves
+    the image corners by less than max_shift (fraction of the width), and
+    is refined by ECC on the full resolution level when possible.
+
+    stats holds one record per aligned band: key, correlation coefficient,
+    whether a cached warp was available as seed, the number of ECC attempts
+    (the identity warp is tried when the seeded run fails), the maximum
+    number of ECC iterations of these attempts (OpenCV does not report the
+    iterations actually run), the method of the warp ("ecc", "features" or
+    None), the keypoint inliers, whether a warp was found, the warp (nested
+    list, None if not found) and the time spent.
+    """
+
+    def __init__(self, ksize=5, n_iter=2500, eps=1e-9, levels=3, warp_mode=cv2.MOTION_HOMOGRAPHY,
+                 texture_tile=0, texture_fraction=0.3, min_cc=None, features=None, min_inliers=25, max_shift=0.05):
+        self.ksize = ksize
+        self.n_iter = n_iter
+        self.eps = eps
+        self.levels = levels
+        self.warp_mode = warp_mode
+        self.texture_tile = texture_tile
+        self.texture_fraction = texture_fraction
+        self.min_cc = min_cc
+        self.features = features
+        self.min_inliers = min_inliers
+        self.max_shift = max_shift
+        self.warps = {}
+        self.stats = []
+
+    def fallback_warp(self, grad_ref, grad_image, mask=None):
+        """ Get the keypoint homography of a band, refined by ECC on the full resolution level
+
+        Returns (warp_matrix, cc, inliers), warp_matrix None if the
+        homography is missing or implausible.
+        """
+        warp_matrix, inliers = feature_warp(grad_ref[0], grad_image[0], mask, self.features, min_inliers=self.min_inliers)
+        height, width = grad_ref[0].shape[:2]
+        if warp_matrix is None or warp_shift(warp_matrix, width, height) > self.max_shift * width:
+            return None, None, inliers
+        if self.warp_mode != cv2.MOTION_HOMOGRAPHY:
+            warp_matrix = warp_matrix[:2] / warp_matrix[2, 2]
+        try:
+            refined, cc = find_transform_pyramid(grad_ref, grad_image, warp_matrix, self.warp_mode, self.n_iter,
+                                                 self.eps, mask, start_level=0, min_cc=self.min_cc)
+            if refined is not None:
+                return refined, cc, inliers
+        except cv2.error:
+            pass
+        return warp_matrix, None, inliers
+
+    def align_band(self, grad_ref, image, key=None, mask=None, window=None):
+        """ Get the warp of one band onto the reference gradients, or None if no method finds one
+
+        mask is the texture mask of the reference (None: whole image) and
+        window the (x0, y0, x1, y1) the reference gradients and mask are
+        cropped to (None: whole image).
+        """
+        start = time.time()
+        grad_image = gradient_pyramid(image, self.levels, self.ksize)
+        x0, y0 = 0, 0
+        if window is not None:
+            grad_image = crop_pyramid(grad_image, window)
+            x0, y0 = window[:2]
+        # A cached warp only needs refining on the finer levels, the identity warp needs the full pyramid
+        seeded = key in self.warps
+        seeds = [(identity_warp(self.warp_mode), None)]
+        if seeded:
+            seeds.insert(0, (offset_warp(self.warps[key], x0, y0), min(1, self.levels - 1)))
+        warp_matrix, cc, attempts, max_iterations = None, None, 0, 0
+        for seed, start_level in seeds:
+            attempts += 1
+            first_level = self.levels - 1 if start_level is None else start_level
+            max_iterations += sum(level_iterations(self.n_iter, self.levels, level) for level in range(first_level + 1))
+            try:
+                warp_matrix, cc = find_transform_pyramid(grad_ref, grad_image, seed, self.warp_mode, self.n_iter,
+                                                         self.eps, mask, start_level, self.min_cc)
+            except cv2.error:
+                continue
+            if warp_matrix is not None:
+                break
+        method, inliers = "ecc" if warp_matrix is not None else None, None
+        if warp_matrix is None and self.features:
+            warp_matrix, cc, inliers = self.fallback_warp(grad_ref, grad_image, mask)
+            if warp_matrix is not None:
+                max_iterations += level_iterations(self.n_iter, self.levels, 0)
+            method = "features" if warp_matrix is not None else None
+        if warp_matrix is not None:
+            warp_matrix = offset_warp(warp_matrix, -x0, -y0)
+        if warp_matrix is not None and key is not None:
+            self.warps[key] = warp_matrix
+        self.stats.append({"key": key,
+                           "cc": cc,
+                           "seeded": seeded,
+                           "attempts": attempts,
+                           "max_iterations": max_iterations,
+                           "method": method,
+                           "inliers": inliers,
+                           "converged": warp_matrix is not None,
+                           "warp": None if warp_matrix is None else warp_matrix.tolist(),
+                           "seconds": time.time() - start})
+        return warp_matrix
+
+    def align(self, images, ref_index, keys=None):
+        """ Warp all bands of a set to the reference band
+
+        keys identify the bands across sets (e.g. band names) for the warp
+        cache. Returns the aligned images, with None for the bands where ECC
+        did not converge.
+        """
+        if keys is None:
+            keys = [None] * len(images)
+        grad_ref = gradient_pyramid(images[ref_index], self.levels, self.ksize)
+        mask, window = None, None
+        if self.texture_tile:
+            mask = texture_mask(grad_ref[0], self.texture_tile, self.texture_fraction)
+            window = mask_window(mask, self.texture_tile // 2, 2 ** (self.levels - 1))
+            grad_ref = crop_pyramid(grad_ref, window)
+            mask = np.ascontiguousarray(mask[window[1]:window[3], window[0]:window[2]])
+        aligned = []
+        for k, image in enumerate(images):
+            if k == ref_index:
+                aligned.append(image)
+                continue
+            warp_matrix = self.align_band(grad_ref, image, keys[k], mask, window)
+            aligned.append(None if warp_matrix is None else warp_image(image, warp_matrix, self.warp_mode))
+        return aligned
+
+
+def align_set(images, ref_index, ksize=5, n_iter=2500, eps=1e-9, warp_mode=cv2.MOTION_HOMOGRAPHY, levels=3):
+    """ Warp all bands of a set to the reference band
+
+    Returns the aligned images, with None for the bands where ECC did not
+    converge.
+    """
+    return BandAligner(ksize, n_iter, eps, levels, warp_mode).align(images, ref_index)
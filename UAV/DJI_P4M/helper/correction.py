@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# References:
+# P4 Multispectral Image Processing Guide (https://dl.djicdn.com/downloads/p4-multispectral/20200717/P4_Multispectral_Image_Processing_Guide_EN.pdf)
+
+"""
+DJI P4M radiometric and geometric correction
+
+The phase difference translation, vignetting polynomial and undistortion
+only depend on the calibration tags of a band (RelativeOpticalCenter,
+CalibratedOpticalCenter, VignettingData, DewarpData). They are folded into
+one remap table and one gain map per distinct calibration, which are cached
+and reused for every image taken with that band. Correcting an image is
+then a single float32 remap followed by one multiply.
+"""
+
+import numpy as np
+import cv2
+
+
+class Calibration(object):
+    """ Precomputed remap tables, gain map and crop for one band calibration """
+
+    def __init__(self, meta, width, height):
+        xoff = meta.get_item("XMP:RelativeOpticalCenterX")
+        yoff = meta.get_item("XMP:RelativeOpticalCenterY")
+        center_x = meta.get_item("XMP:CalibratedOpticalCenterX")
+        center_y = meta.get_item("XMP:CalibratedOpticalCenterY")
+        k = [float(i) for i in meta.get_item("XMP:VignettingData").split(",")]
+        dewarp = meta.get_item("XMP:DewarpData").split(";")[1]
+        fx, fy, cx, cy, k1, k2, p1, p2, k3 = [float(i) for i in dewarp.split(",")]
+
+        # Undistortion maps from output pixels to translated image coordinates
+        dist = np.array([[k1, k2, p1, p2, k3]])
+        mtx = np.array([[fx, 0, center_x + cx], [0, fy, center_y + cy], [0, 0, 1]])
+        newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (width, height), 1, (width, height))
+        map_x, map_y = cv2.initUndistortRectifyMap(mtx, dist, None, newcameramtx, (width, height), cv2.CV_32FC1)
+
+        # Vignetting gain evaluated where each output pixel samples the translated image
+        r = np.sqrt((map_x + 1 - center_x)**2 + (map_y + 1 - center_y)**2)
+        gain = np.polyval([k[5], k[4], k[3], k[2], k[1], k[0], 1.0], r).astype(np.float32)
+
+        # Fold the translation into the maps so that the raw image is sampled directly
+        map_x += xoff
+        map_y += yoff
+        valid = ((map_x >= 0) & (map_x <= width - 1) & (map_y >= 0) & (map_y <= height - 1) &
+                 (map_x - xoff >= 0) & (map_x - xoff <= width - 1) &
+                 (map_y - yoff >= 0) & (map_y - yoff <= height - 1))
+        gain[~valid] = 0
+        self.gain = gain
+        self.map1, self.map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+        # Cropping parameters from translation and distortion correction
+        x, y, w, h = roi
+        self.crop_left = max(int(np.abs(np.ceil(xoff))) if xoff >= 0 else 0, x)
+        self.crop_right = max(0 if xoff >= 0 else int(np.abs(np.floor(xoff))), x)
+        self.crop_bottom = max(int(np.abs(np.ceil(yoff))) if yoff >= 0 else 0, y)
+        self.crop_top = max(0 if yoff >= 0 else int(np.abs(np.floor(yoff))), y)
+
+    def crop(self):
+        """ Get cropping parameters (left, right, bottom, top) """
+        return self.crop_left, self.crop_right, self.crop_bottom, self.crop_top
+
+
+def calibration_key(meta, width, height):
+    """ Get the tags that determine the remap tables and gain map of a band """
+    return (width, height,
+            meta.get_item("XMP:RelativeOpticalCenterX"),
+            meta.get_item("XMP:RelativeOpticalCenterY"),
+            meta.get_item("XMP:CalibratedOpticalCenterX"),
+            meta.get_item("XMP:CalibratedOpticalCenterY"),
+            meta.get_item("XMP:VignettingData"),
+            meta.get_item("XMP:DewarpData"))
+
+
+def image_scale(meta):
+    """ Get the scalar converting black level corrected DN to sunlight sensor adjusted values """
+    val_gain = meta.get_item("XMP:SensorGain")
+    val_etime = meta.get_item("EXIF:ExposureTime")
+    p_camera = meta.get_item("XMP:SensorGainAdjustment")
+    irr = meta.get_item("XMP:Irradiance")
+    return p_camera / (65535 * val_gain * (val_etime/1e6) * irr)
+
+
+class CorrectionEngine(object):
+    """ Correct DJI P4M band images, caching calibrations across images """
+
+    def __init__(self):
+        self._calibrations = {}
+
+    def __len__(self):
+        return len(self._calibrations)
+
+    def calibration(self, meta, width, height):
+        """ Get the cached Calibration of an image, building it on first use """
+        key = calibration_key(meta, width, height)
+        calib = self._calibrations.get(key)
+        if calib is None:
+            calib = Calibration(meta, width, height)
+            self._calibrations[key] = calib
+        return calib
+
+    def correct(self, image, meta):
+        """ Get the sunlight sensor adjusted image (float32) and its cropping parameters """
+        height, width = image.shape[:2]
+        calib = self.calibration(meta, width, height)
+        I_sun = cv2.remap(image.astype(np.float32), calib.map1, calib.map2, cv2.INTER_LINEAR)
+        I_sun -= np.float32(meta.get_item("EXIF:BlackLevel"))
+        cv2.multiply(I_sun, calib.gain, dst=I_sun, scale=image_scale(meta))
+        return I_sun, calib.crop()
+
+
+def crop_set(images, crops, add_pixels=0):
+    """ Crop all bands of a set with the largest cropping parameters of the set """
+    crop_left, crop_right, crop_bottom, crop_top = [max(c) for c in zip(*crops)]
+    cropped = []
+    for image in images:
+        height, width = image.shape[:2]
+        cropped.append(image[crop_left+add_pixels:height-crop_right-add_pixels,
+                             crop_bottom+add_pixels:width-crop_top-add_pixels])
+    return cropped
+
+
+def correct_steps(image, meta):
+    """ Run the step by step float64 correction and return all intermediate images
+
+    Slow reference implementation, used to check the corrections visually and
+    to validate CorrectionEngine.
+    """
+    steps = {"raw": image}
+
+    # Translate image
+    xoff = meta.get_item("XMP:RelativeOpticalCenterX")
+    yoff = meta.get_item("XMP:RelativeOpticalCenterY")
+    height, width = image.shape[:2]
+    T = np.float32([[1, 0, -xoff], [0, 1, -yoff]])
+    steps["translated"] = cv2.warpAffine(image, T, (width, height))
+
+    # Normalize 16-bit values
+    steps["normalized"] = steps["translated"] / 65535 - meta.get_item("EXIF:BlackLevel") / 65535
+
+    # Vignetting correction
+    center_x = meta.get_item("XMP:CalibratedOpticalCenterX")
+    center_y = meta.get_item("XMP:CalibratedOpticalCenterY")
+    coord_x, coord_y = np.meshgrid(range(1, width+1), range(1, height+1))
+    r = np.sqrt(((coord_x-center_x)**2) + ((coord_y-center_y)**2))
+    k = [float(i) for i in meta.get_item("XMP:VignettingData").split(",")]
+    steps["vignette correction"] = steps["normalized"] * (k[5]*r**6 + k[4]*r**5 + k[3]*r**4 +
+                                                          k[2]*r**3 + k[1]*r**2 + k[0]*r + 1.0)
+
+    # Distortion correction
+    dewarp = meta.get_item("XMP:DewarpData").split(";")[1]
+    fx, fy, cx, cy, k1, k2, p1, p2, k3 = [float(i) for i in dewarp.split(",")]
+    dist = np.array([[k1, k2, p1, p2, k3]])
+    mtx = np.array([[fx, 0, center_x + cx], [0, fy, center_y + cy], [0, 0, 1]])
+    newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (width, height), 1, (width, height))
+    steps["distortion correction"] = cv2.undistort(steps["vignette correction"], mtx, dist, None, newcameramtx)
+
+    # Calculate image signal value
+    val_gain = meta.get_item("XMP:SensorGain")
+    val_etime = meta.get_item("EXIF:ExposureTime")
+    steps["image signal"] = steps["distortion correction"] / (val_gain * (val_etime/1e6))
+
+    # Sunlight sensor adjustment
+    p_camera = meta.get_item("XMP:SensorGainAdjustment")
+    irr = meta.get_item("XMP:Irradiance")
+    steps["sunsensor adjusted"] = steps["image signal"] * p_camera / irr
+    return steps
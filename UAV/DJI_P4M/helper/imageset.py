@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+DJI P4M capture set indexing
+
+DJI P4M writes one DJI_xxxx{band}.TIF file per band for each capture. The
+folder is scanned once and the files are grouped into image sets keyed by
+set id, so that the processing loops never search or remove entries from
+file lists.
+"""
+
+import os
+import re
+from collections import OrderedDict
+
+import pandas as pd
+
+# Columns of meta.csv and the metadata items they are read from
+META_TAGS = [("Make", "XMP:Make"),
+             ("Model", "XMP:Model"),
+             ("BandName", "XMP:BandName"),
+             ("RelativeAltitude", "XMP:RelativeAltitude"),
+             ("FocalLength", "EXIF:FocalLength"),
+             ("GPSAltitudeRef", "EXIF:GPSAltitudeRef"),
+             ("GPSLatitudeRef", "EXIF:GPSLatitudeRef"),
+             ("GPSLongitudeRef", "EXIF:GPSLongitudeRef"),
+             ("GPSAltitude", "EXIF:GPSAltitude"),
+             ("GPSLatitude", "EXIF:GPSLatitude"),
+             ("GPSLongitude", "EXIF:GPSLongitude")]
+
+
+class ImageSetIndex(object):
+    """ Index of the image sets in a folder of DJI P4M images
+
+    sets maps each complete set id to its file names in band order,
+    incomplete maps set ids with missing bands to the files found.
+    """
+
+    def __init__(self, folder, num_bands=5):
+        self.folder = folder
+        self.num_bands = num_bands
+        pattern = re.compile(r"^DJI_(\d+)(\d{%d})\.tif$" % len(str(num_bands)), re.IGNORECASE)
+        bands = {}
+        for entry in os.scandir(folder):
+            match = pattern.match(entry.name)
+            if match is not None:
+                set_id, band_id = match.group(1), int(match.group(2))
+                bands.setdefault(set_id, {})[band_id] = entry.name
+        self.sets = OrderedDict()
+        self.incomplete = OrderedDict()
+        for set_id in sorted(bands):
+            file_names = [bands[set_id].get(j) for j in range(1, num_bands+1)]
+            if None in file_names:
+                self.incomplete[set_id] = sorted(bands[set_id].values())
+            else:
+                self.sets[set_id] = file_names
+
+    def __len__(self):
+        return len(self.sets)
+
+    def __iter__(self):
+        return iter(self.sets.items())
+
+    def files(self):
+        """ Get the paths of all images in complete sets """
+        return [os.path.join(self.folder, f) for file_names in self.sets.values() for f in file_names]
+
+    def subset(self, set_ids):
+        """ Get {set_id: file names} for some of the sets """
+        return OrderedDict((set_id, self.sets[set_id]) for set_id in set_ids)
+
+    def metadata_frame(self, store, source_dir):
+        """ Build the meta.csv table of all images from a MetadataStore in one go
+
+        SourceFile points to the image with the same name in source_dir.
+        """
+        columns = {"SourceFile": [], "FileName": []}
+        columns.update((column, []) for column, tag in META_TAGS)
+        for file_path in self.files():
+            file_name = os.path.basename(file_path)
+            meta = store.get(file_path)
+            columns["SourceFile"].append(os.path.join(source_dir, file_name))
+            columns["FileName"].append(file_name)
+            for column, tag in META_TAGS:
+                columns[column].append(meta.get_item(tag))
+        return pd.DataFrame(columns)
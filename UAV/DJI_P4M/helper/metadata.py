@@ -31,6 +31,8 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 from __future__ import unicode_literals
 
 import os
+import glob
+import json
 import exiftool
 
 
@@ -52,6 +54,13 @@ class Metadata(object):
         with exiftool.ExifTool(self.exiftoolPath) as exift:
             self.exif = exift.get_metadata(filename)
 
+    @classmethod
+    def from_dict(cls, exif):
+        """ Wrap an already extracted metadata dict (e.g. from MetadataStore) """
+        meta = cls.__new__(cls)
+        meta.exif = exif
+        return meta
+
     def get_all(self):
         """ Get all extracted metadata items """
         return self.exif
@@ -99,4 +108,172 @@ class Metadata(object):
     def print_all(self):
         for item in self.get_all():
             print("{}: {}".format(item, self.get_item(item)))
-            
\ No newline at end of file
+            
+
+class MetadataStore(object):
+    """ Batched and cached metadata reader for a folder of DJI P4M images
+
+    A single ExifTool process is kept open for the lifetime of the store and
+    files are read with get_metadata_batch. Extracted tags are kept in a JSON
+    cache keyed by path, modification time and size, so re-runs over the same
+    folder skip extraction entirely.
+    """
+
+    def __init__(self, cache_path=None, exiftool_path=None, batch_size=256):
+        if exiftool_path is not None:
+            self.exiftoolPath = exiftool_path
+        elif os.environ.get('exiftoolpath') is not None:
+            self.exiftoolPath = os.path.normpath(os.environ.get('exiftoolpath'))
+        else:
+            self.exiftoolPath = None
+        self.cache_path = cache_path
+        self.batch_size = batch_size
+        self._exift = None
+        self._dirty = False
+        self._cache = {}
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path) as f:
+                self._cache = json.load(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _key(filename):
+        return os.path.normcase(os.path.abspath(filename))
+
+    @staticmethod
+    def _stamp(filename):
+        st = os.stat(filename)
+        return [st.st_mtime, st.st_size]
+
+    def _session(self):
+        """ Start the shared ExifTool process on first use """
+        if self._exift is None:
+            self._exift = exiftool.ExifTool(self.exiftoolPath)
+            self._exift.start()
+        return self._exift
+
+    def _is_cached(self, filename):
+        entry = self._cache.get(self._key(filename))
+        return entry is not None and entry["stamp"] == self._stamp(filename)
+
+    def read(self, filenames):
+        """ Extract metadata of all files that are not cached yet, in batches """
+        for filename in filenames:
+            if not os.path.isfile(filename):
+                raise IOError("Input path is not a file: {}".format(filename))
+        missing = [f for f in filenames if not self._is_cached(f)]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            exifs = self._session().get_metadata_batch(batch)
+            for filename, exif in zip(batch, exifs):
+                self._cache[self._key(filename)] = {"stamp": self._stamp(filename), "exif": exif}
+            self._dirty = True
+        if missing:
+            self.save()
+        return len(missing)
+
+    def read_dir(self, directory, pattern="*.TIF"):
+        """ Extract metadata of all images in a folder, returns the sorted file list """
+        filenames = sorted(glob.glob(os.path.join(directory, pattern)))
+        self.read(filenames)
+        return filenames
+
+    def add(self, filename, exif):
+        """ Cache already known metadata of a file (e.g. synthetic images), as if it was extracted """
+        self._cache[self._key(filename)] = {"stamp": self._stamp(filename), "exif": exif}
+        self._dirty = True
+
+    def get(self, filename):
+        """ Get Metadata of a file, extracting it if it is not cached yet """
+        if not self._is_cached(filename):
+            self.read([filename])
+        return Metadata.from_dict(self._cache[self._key(filename)]["exif"])
+
+    def save(self):
+        """ Write the cache to disk """
+        if self.cache_path is None or not self._dirty:
+            return
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._cache, f)
+        os.replace(tmp_path, self.cache_path)
+        self._dirty = False
+
+    def close(self):
+        """ Save the cache and stop the ExifTool process """
+        self.save()
+        if self._exift is not None:
+            self._exift.terminate()
+            self._exift = None
+
+
+class MetadataWriter(object):
+    """ Bulk tag writeback through a single ExifTool process
+
+    Current tag values are read in batches and only files whose tags differ
+    are rewritten, so re-running a writeback over a folder is cheap.
+    """
+
+    def __init__(self, exiftool_path=None, batch_size=256):
+        if exiftool_path is not None:
+            self.exiftoolPath = exiftool_path
+        elif os.environ.get('exiftoolpath') is not None:
+            self.exiftoolPath = os.path.normpath(os.environ.get('exiftoolpath'))
+        else:
+            self.exiftoolPath = None
+        self.batch_size = batch_size
+        self._exift = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _same(current, value):
+        try:
+            return abs(float(current) - float(value)) < 1e-9
+        except (TypeError, ValueError):
+            return str(current) == str(value)
+
+    def changed(self, file_tags):
+        """ Get the files of {file: {tag: value}} whose tags differ from the values on disk """
+        if self._exift is None:
+            self._exift = exiftool.ExifTool(self.exiftoolPath)
+            self._exift.start()
+        filenames = list(file_tags)
+        changed = []
+        for start in range(0, len(filenames), self.batch_size):
+            batch = filenames[start:start + self.batch_size]
+            tags = sorted(set(tag for f in batch for tag in file_tags[f]))
+            for filename, current in zip(batch, self._exift.get_tags_batch(tags, batch)):
+                # Keys of the current values are prefixed by their group (e.g. EXIF:Make)
+                current = dict((key.split(":")[-1], value) for key, value in current.items())
+                if any(not self._same(current.get(tag), value) for tag, value in file_tags[filename].items()):
+                    changed.append(filename)
+        return changed
+
+    def write(self, file_tags):
+        """ Write {file: {tag: value}} in place, skipping files that are up to date
+
+        Values are written as numbers (exiftool -n). Returns the files written.
+        """
+        changed = self.changed(file_tags)
+        for filename in changed:
+            params = ["-n", "-overwrite_original"]
+            params += ["-{}={}".format(tag, value) for tag, value in file_tags[filename].items()]
+            params.append(filename)
+            self._exift.execute(*[os.fsencode(p) for p in params])
+        return changed
+
+    def close(self):
+        """ Stop the ExifTool process """
+        if self._exift is not None:
+            self._exift.terminate()
+            self._exift = None
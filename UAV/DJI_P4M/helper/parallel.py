@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Parallel processing of DJI P4M image sets
+
+Image sets are independent of each other, so they are sent to a process
+pool in chunks. Workers read their inputs from disk and write their results
+to disk (float32 spill files for the correction, stacked COGs for the
+stacking), only file names and small summaries are sent back. Results are
+collected in submission order.
+
+Band alignment is seeded with the warps of the previous set of the same
+chunk, and the first set of every chunk is aligned from scratch, so the
+stacked outputs only depend on the sets and the chunk size, not on the
+number of workers or on which chunks a worker ran before. Seeds are
+starting points of ECC: a different chunking (e.g. an incremental re-run
+that restacks only some sets) can change the outputs by about 1e-5.
+
+Steps are timed with profiling.profiler. The records of the worker
+processes are sent back with every task result and merged into the parent's
+profiler.
+"""
+
+import os
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from . import metadata
+from . import correction
+from . import reflectance
+from . import alignment
+from . import raster
+from . import profiling
+
+IMREAD_FLAGS = cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR
+
+_engine = None
+_aligners = {}
+
+
+def _init_worker():
+    """ Use one OpenCV thread per worker to avoid oversubscribing the cores """
+    global _engine
+    cv2.setNumThreads(1)
+    _engine = correction.CorrectionEngine()
+    _aligners.clear()
+
+
+def _init_pool_worker():
+    """ Start worker processes with an empty profiler (forked workers inherit the parent's records) """
+    profiling.profiler.reset()
+    _init_worker()
+
+
+def _profiled(fn, task):
+    return fn(task), profiling.profiler.drain()
+
+
+def _aligner(ksize, n_iter, eps, levels, options=None):
+    """ Get the worker's BandAligner (its cached warps are cleared at the start of every chunk) """
+    options = options or {}
+    key = (ksize, n_iter, eps, levels, tuple(sorted(options.items())))
+    if key not in _aligners:
+        _aligners[key] = alignment.BandAligner(ksize, n_iter, eps, levels, **options)
+    return _aligners[key]
+
+
+def _chunks(items, chunk_size):
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def _run(fn, tasks, workers):
+    """ Run fn over tasks in a process pool (or serially if workers <= 1), keeping the task order """
+    if workers is None or workers > 1:
+        results = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_pool_worker) as executor:
+            for result, records in executor.map(partial(_profiled, fn), tasks):
+                profiling.profiler.extend(records)
+                results.append(result)
+        return results
+    _init_worker()
+    return [fn(task) for task in tasks]
+
+
+def _correct_chunk(task):
+    raw_dir, spill_dir, chunk, add_crop_pixels = task
+    span = profiling.profiler.span
+    results = []
+    for set_id, file_names, exifs in chunk:
+        I_sun_set, crops = [], []
+        for file_name, exif in zip(file_names, exifs):
+            with span("imread", "correct", file_name=file_name):
+                image = cv2.imread(os.path.join(raw_dir, file_name), IMREAD_FLAGS)
+            meta = metadata.Metadata.from_dict(exif)
+            # Vignetting and distortion tables, only built for the first image of a band
+            with span("calibration", "correct", file_name=file_name):
+                _engine.calibration(meta, image.shape[1], image.shape[0])
+            with span("remap", "correct", file_name=file_name):
+                I_sun, crop = _engine.correct(image, meta)
+            I_sun_set.append(I_sun)
+            crops.append(crop)
+        with span("spill", "correct", set_id=set_id):
+            I_max = max(reflectance.spill_image(spill_dir, file_name, I_crop) for file_name, I_crop
+                        in zip(file_names, correction.crop_set(I_sun_set, crops, add_crop_pixels)))
+        results.append((set_id, file_names, I_max))
+    return results
+
+
+def correct_sets(raw_dir, spill, sets, store, add_crop_pixels=10, workers=None, chunk_size=4):
+    """ Correct image sets in parallel and register the spilled images with a ReflectanceSpill
+
+    sets maps set ids to file names in band order (e.g. ImageSetIndex.sets)
+    and store is a MetadataStore holding the metadata of all raw images.
+    Returns {set_id: maximum of the corrected set}.
+    """
+    items = [(set_id, file_names, [store.get(os.path.join(raw_dir, f)).get_all() for f in file_names])
+             for set_id, file_names in sets.items()]
+    tasks = [(raw_dir, spill.spill_dir, chunk, add_crop_pixels) for chunk in _chunks(items, chunk_size)]
+    set_max = OrderedDict()
+    for results in _run(_correct_chunk, tasks, workers):
+        for set_id, file_names, I_max in results:
+            spill.extend(file_names, I_max)
+            set_max[set_id] = I_max
+    return set_max
+
+
+def _write_raster(file_path, bands, compress="DEFLATE", tags=None, cat="export"):
+    with profiling.profiler.span("write", cat, file_name=os.path.basename(file_path)):
+        raster.write_raster(file_path, bands, compress, tags=tags)
+
+
+def _export_chunk(task):
+    spill_dir, out_dir, file_names, I_max, compress, tags = task
+    write = partial(_write_raster, compress=compress)
+    for file_name, file_tags in zip(file_names, tags):
+        with profiling.profiler.span("export", "export", file_name=file_name):
+            reflectance.export_spill(spill_dir, file_name, out_dir, I_max, write, tags=file_tags)
+    return len(file_names)
+
+
+def export_reflectance(spill, out_dir, overwrite=False, workers=None, chunk_size=16, compress="DEFLATE", tags=None,
+                       I_max=None):
+    """ Rescale and export all spilled images of a ReflectanceSpill in parallel
+
+    tags optionally maps file names to the meta.csv rows embedded in the outputs.
+    I_max defaults to the maximum of the spilled images (e.g. a whole flight
+    maximum when only some sets were spilled).
+    """
+    tags = tags or {}
+    I_max = spill.I_max if I_max is None else I_max
+    file_names = [f for f in spill.file_names if overwrite or not os.path.exists(os.path.join(out_dir, f))]
+    tasks = [(spill.spill_dir, out_dir, chunk, I_max, compress, [tags.get(f) for f in chunk])
+             for chunk in _chunks(file_names, chunk_size)]
+    _run(_export_chunk, tasks, workers)
+    spill.close()
+
+
+def _rescale_chunk(task):
+    folder, file_names, factor, compress, tags = task
+    for file_name, file_tags in zip(file_names, tags):
+        file_path = os.path.join(folder, file_name)
+        with profiling.profiler.span("rescale", "rescale", file_name=file_name):
+            bands = [band * np.float32(factor) for band in raster.read_bands(file_path)]
+            raster.write_raster(file_path + ".tmp", bands, compress, tags=file_tags)
+            os.replace(file_path + ".tmp", file_path)
+    return len(file_names)
+
+
+def rescale_files(folder, file_names, factor, workers=None, chunk_size=16, compress="DEFLATE", tags=None):
+    """ Multiply all bands of existing outputs by factor in parallel (e.g. after a change of I_max)
+
+    tags optionally maps file names to the meta.csv rows embedded in the outputs.
+    """
+    tags = tags or {}
+    tasks = [(folder, chunk, factor, compress, [tags.get(f) for f in chunk]) for chunk in _chunks(file_names, chunk_size)]
+    _run(_rescale_chunk, tasks, workers)
+
+
+def _stack_chunk(task):
+    refl_dir, stack_dir, unstack_dir, chunk, ksize, n_iter, eps, levels, compress, options = task
+    aligner = _aligner(ksize, n_iter, eps, levels, options)
+    aligner.warps.clear()
+    span = profiling.profiler.span
+    results = []
+    for set_id, file_names, band_names, tags in chunk:
+        with span("read", "stack", set_id=set_id):
+            images = [raster.read_band(os.path.join(refl_dir, f)) for f in file_names]
+        n_stats = len(aligner.stats)
+        with span("align", "stack", set_id=set_id):
+            aligned = aligner.align(images, band_names.index("NIR"), band_names)
+        stats = aligner.stats[n_stats:]
+        for record, file_name in zip(stats, [f for f, b in zip(file_names, band_names) if b != "NIR"]):
+            record["set_id"] = set_id
+            record["file_name"] = file_name
+        profiling.profiler.count("ecc", set_id=set_id, bands=len(stats),
+                                 converged=sum(r["converged"] for r in stats),
+                                 attempts=sum(r["attempts"] for r in stats),
+                                 max_iterations=sum(r["max_iterations"] for r in stats),
+                                 features=sum(r["method"] == "features" for r in stats))
+        failed = [f for f, image in zip(file_names, aligned) if image is None]
+        if failed:
+            for file_name, image in zip(file_names, images):
+                if file_name in failed:
+                    _write_raster(os.path.join(unstack_dir, file_name), image, compress, cat="stack")
+        else:
+            _write_raster(os.path.join(stack_dir, "DJI_SET{}.TIF".format(set_id)), aligned, compress, tags, "stack")
+        results.append((set_id, failed, stats))
+    return results
+
+
+def stack_sets(refl_dir, stack_dir, unstack_dir, sets, band_names, ksize=5, n_iter=2500, eps=1e-9,
+               workers=None, chunk_size=4, levels=3, compress="DEFLATE", tags=None, align_options=None):
+    """ Align and stack image sets in parallel
+
+    band_names maps file names to their XMP:BandName and tags optionally maps
+    set ids to the meta.csv rows embedded in the stacked images.
+    align_options are extra BandAligner arguments (e.g. texture_tile,
+    min_cc, features). Returns
+    {set_id: [file names that could not be aligned]} and the BandAligner
+    convergence stats of all bands, with set_id and file_name added.
+    """
+    tags = tags or {}
+    items = [(set_id, file_names, [band_names[f] for f in file_names], tags.get(set_id))
+             for set_id, file_names in sets.items()]
+    tasks = [(refl_dir, stack_dir, unstack_dir, chunk, ksize, n_iter, eps, levels, compress, align_options)
+             for chunk in _chunks(items, chunk_size)]
+    failed, stats = OrderedDict(), []
+    for results in _run(_stack_chunk, tasks, workers):
+        for set_id, failed_files, set_stats in results:
+            failed[set_id] = failed_files
+            stats.extend(set_stats)
+    return failed, stats
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Incremental processing of DJI P4M image sets
+
+Each stage output folder (Reflectance, Stacked) keeps a manifest.json with
+one entry per image set: the fingerprint of the set's inputs and of the
+stage parameters it was processed with, plus the values later runs need to
+reuse the output (e.g. the reflectance scale). On a re-run, only the sets
+whose fingerprint changed or whose outputs are missing are processed again.
+
+Reflectance is normalized by the maximum of the whole flight, so a changed
+set can change the scale of every output. The other sets are then only
+rescaled (value * old scale / new scale) instead of being corrected or
+aligned again, as both steps are linear in the image values.
+"""
+
+import os
+import json
+import hashlib
+
+VERSION = 1  # bump to invalidate all manifests when the processing changes
+
+
+def file_stamp(file_path):
+    """ Get the [modification time, size] of a file """
+    st = os.stat(file_path)
+    return [st.st_mtime, st.st_size]
+
+
+def fingerprint(*parts):
+    """ Get the sha1 of JSON serializable parts (file stamps, parameters, upstream fingerprints) """
+    data = json.dumps([VERSION] + list(parts), sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def files_fingerprint(folder, file_names, *params):
+    """ Get the fingerprint of the files of a set and stage parameters """
+    return fingerprint([(f, file_stamp(os.path.join(folder, f))) for f in file_names], *params)
+
+
+class StageManifest(object):
+    """ Per set fingerprints of a stage output folder, kept in its manifest.json
+
+    sets maps set ids to entries: {"fingerprint": ..., other stage values}.
+    """
+
+    def __init__(self, folder, name="manifest.json"):
+        self.path = os.path.join(folder, name)
+        self.sets = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.sets = json.load(f)["sets"]
+
+    def __len__(self):
+        return len(self.sets)
+
+    def get(self, set_id):
+        return self.sets.get(set_id)
+
+    def is_current(self, set_id, set_fingerprint):
+        """ Check whether a set was processed with this fingerprint """
+        entry = self.sets.get(set_id)
+        return entry is not None and entry["fingerprint"] == set_fingerprint
+
+    def update(self, set_id, set_fingerprint, **values):
+        self.sets[set_id] = dict(values, fingerprint=set_fingerprint)
+
+    def invalidate(self, set_ids):
+        """ Remove sets whose outputs are about to be rewritten, so an interrupted run redoes them """
+        for set_id in set_ids:
+            self.sets.pop(set_id, None)
+        self.save()
+
+    def retain(self, set_ids):
+        """ Remove the sets that are no longer in the input folder """
+        set_ids = set(set_ids)
+        self.sets = {k: v for k, v in self.sets.items() if k in set_ids}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": VERSION, "sets": self.sets}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Timing and memory instrumentation
+
+Every process has one Profiler (profiler) that records spans (wall and CPU
+time of a named step, e.g. "imread" of the "correct" stage) and counters
+(e.g. ECC convergence of an image set). Worker processes send their records
+back with their results (see parallel.py), so the parent ends up with the
+records of the whole run. Reports can be printed, or written as JSON, CSV
+or a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def peak_rss():
+    """ Get the peak resident memory of this process in bytes, None if it cannot be measured """
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    return None
+
+
+class Profiler(object):
+    """ Spans and counters of one process
+
+    spans are {"cat", "name", "pid", "start", "wall", "cpu", "args"} with
+    start in seconds since the epoch, counters are {"name", "pid", "time",
+    "values"}.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.counters = []
+
+    def reset(self):
+        self.spans = []
+        self.counters = []
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        """ Time a step: with profiler.span("imread", "correct", file_name=...) """
+        start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.spans.append({"cat": cat, "name": name, "pid": os.getpid(), "start": start,
+                               "wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu, "args": args})
+
+    def count(self, name, **values):
+        """ Record counter values, e.g. profiler.count("ecc", set_id=..., converged=...) """
+        self.counters.append({"name": name, "pid": os.getpid(), "time": time.time(), "values": values})
+
+    def sample_memory(self):
+        rss = peak_rss()
+        if rss is not None:
+            self.count("memory", peak_rss=rss)
+
+    def drain(self):
+        """ Get and clear the records of this process (with its peak memory), to send them to the parent """
+        self.sample_memory()
+        records = (self.spans, self.counters)
+        self.reset()
+        return records
+
+    def extend(self, records):
+        """ Add the records drained from another process """
+        spans, counters = records
+        self.spans.extend(spans)
+        self.counters.extend(counters)
+
+    def summary(self):
+        """ Get the totals per step: [{"cat", "name", "count", "wall", "cpu", "mean_wall"}] """
+        totals = OrderedDict()
+        for span in self.spans:
+            total = totals.setdefault((span["cat"], span["name"]), {"cat": span["cat"], "name": span["name"],
+                                                                    "count": 0, "wall": 0.0, "cpu": 0.0})
+            total["count"] += 1
+            total["wall"] += span["wall"]
+            total["cpu"] += span["cpu"]
+        for total in totals.values():
+            total["mean_wall"] = total["wall"] / total["count"]
+        return list(totals.values())
+
+    def peak_memory(self):
+        """ Get {pid: peak resident memory in bytes} of all processes """
+        peaks = {}
+        for counter in self.counters:
+            if counter["name"] == "memory":
+                peaks[counter["pid"]] = max(peaks.get(counter["pid"], 0), counter["values"]["peak_rss"])
+        return peaks
+
+    def report(self):
+        """ Get the summary as a text table """
+        lines = ["{:<10} {:<12} {:>7} {:>10} {:>10} {:>10}".format("Stage", "Step", "Count", "Wall (s)", "CPU (s)",
+                                                                   "Mean (ms)")]
+        for total in self.summary():
+            lines.append("{:<10} {:<12} {:>7} {:>10.2f} {:>10.2f} {:>10.1f}".format(
+                total["cat"], total["name"], total["count"], total["wall"], total["cpu"], total["mean_wall"] * 1000))
+        peaks = self.peak_memory()
+        if peaks:
+            lines.append("Peak memory: {:.0f} MB (largest of {} processes)".format(max(peaks.values()) / 2.0 ** 20,
+                                                                                    len(peaks)))
+        return "\n".join(lines)
+
+    def write_json(self, file_path, **extra):
+        """ Write the summary, peak memory, spans and counters (and extra items, e.g. parameters) """
+        data = OrderedDict([("summary", self.summary()),
+                            ("peak_rss", {str(pid): rss for pid, rss in self.peak_memory().items()}),
+                            ("spans", self.spans),
+                            ("counters", self.counters)])
+        data.update(extra)
+        with open(file_path, "w") as f:
+            json.dump(data, f, indent=1, default=str)
+
+    def write_csv(self, file_path):
+        """ Write one row per span, with a column per span argument """
+        arg_names = []
+        for span in self.spans:
+            arg_names.extend(k for k in span["args"] if k not in arg_names)
+        with open(file_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["cat", "name", "pid", "start", "wall", "cpu"] + arg_names)
+            for span in self.spans:
+                writer.writerow([span["cat"], span["name"], span["pid"], span["start"], span["wall"], span["cpu"]] +
+                                [span["args"].get(k, "") for k in arg_names])
+
+    def write_chrome_trace(self, file_path):
+        """ Write the spans and counters in the Chrome trace event format, one track per process """
+        events = []
+        for span in self.spans:
+            events.append({"name": span["name"], "cat": span["cat"], "ph": "X", "pid": span["pid"],
+                           "tid": span["pid"], "ts": span["start"] * 1e6, "dur": span["wall"] * 1e6,
+                           "args": dict(span["args"], cpu_ms=span["cpu"] * 1000)})
+        for counter in self.counters:
+            values = {k: v for k, v in counter["values"].items() if isinstance(v, (int, float))}
+            events.append({"name": counter["name"], "ph": "C", "pid": counter["pid"], "tid": counter["pid"],
+                           "ts": counter["time"] * 1e6, "args": values})
+        with open(file_path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+
+profiler = Profiler()
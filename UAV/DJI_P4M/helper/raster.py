@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Raster output
+
+Shared writer for the correction and stacking stages. Images are written as
+Cloud Optimized GeoTIFFs: tiled, compressed with the floating point predictor
+and with internal overviews, so that outputs are smaller on disk and partial
+or low resolution reads only touch the tiles they need.
+
+The meta.csv tags (camera, band and GPS position) are embedded at write time,
+as GDAL metadata items and as an XMP packet, so that the outputs do not need
+to be rewritten by exiftool afterwards.
+"""
+
+from fractions import Fraction
+
+import numpy as np
+from osgeo import gdal
+
+GDAL_TYPES = {np.dtype(np.float32): gdal.GDT_Float32,
+              np.dtype(np.float64): gdal.GDT_Float64,
+              np.dtype(np.uint16): gdal.GDT_UInt16,
+              np.dtype(np.uint8): gdal.GDT_Byte}
+
+
+def creation_options(dtype, compress="DEFLATE", blocksize=256, overviews=True):
+    """ Get COG creation options for a data type """
+    options = ["COMPRESS={}".format(compress),
+               "BLOCKSIZE={}".format(blocksize),
+               "OVERVIEWS={}".format("AUTO" if overviews else "NONE"),
+               "BIGTIFF=IF_SAFER"]
+    if compress in ("DEFLATE", "ZSTD", "LZW"):
+        # Floating point predictor for float data, horizontal differencing otherwise
+        options.append("PREDICTOR={}".format("FLOATING_POINT" if np.dtype(dtype).kind == "f" else "STANDARD"))
+    return options
+
+
+# XMP properties of the meta.csv columns, GPS references are folded into the coordinates
+XMP_NAMESPACES = {"tiff": "http://ns.adobe.com/tiff/1.0/",
+                  "exif": "http://ns.adobe.com/exif/1.0/",
+                  "drone-dji": "http://www.dji.com/drone-dji/1.0/",
+                  "Camera": "http://pix4d.com/camera/1.0/"}
+XMP_TAGS = {"Make": "tiff:Make",
+            "Model": "tiff:Model",
+            "BandName": "Camera:BandName",
+            "RelativeAltitude": "drone-dji:RelativeAltitude",
+            "FocalLength": "exif:FocalLength",
+            "GPSAltitude": "exif:GPSAltitude",
+            "GPSAltitudeRef": "exif:GPSAltitudeRef",
+            "GPSLatitude": "exif:GPSLatitude",
+            "GPSLongitude": "exif:GPSLongitude"}
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def xmp_coordinate(value, ref):
+    """ Format a decimal degree coordinate as an XMP GPS coordinate (DDD,MM.mmmmmmK) """
+    value = float(value)
+    if value < 0:
+        value = -value
+        ref = {"N": "S", "E": "W"}.get(ref, ref)
+    degrees = int(value)
+    return "{},{:.6f}{}".format(degrees, (value - degrees) * 60, ref)
+
+
+def xmp_packet(tags):
+    """ Build an XMP packet from a meta.csv row """
+    properties = {}
+    for column, value in tags.items():
+        if column not in XMP_TAGS or _is_missing(value):
+            continue
+        if column in ("GPSLatitude", "GPSLongitude"):
+            ref = tags.get(column + "Ref")
+            value = xmp_coordinate(value, ref if not _is_missing(ref) else ("N" if column == "GPSLatitude" else "E"))
+        elif column in ("FocalLength", "GPSAltitude"):
+            fraction = Fraction(float(value)).limit_denominator(10000)
+            value = "{}/{}".format(fraction.numerator, fraction.denominator)
+        elif column == "GPSAltitudeRef":
+            value = int(value)
+        properties[XMP_TAGS[column]] = value
+    attributes = "".join('\n    {}="{}"'.format(name, str(value).replace("&", "&amp;").replace('"', "&quot;"))
+                         for name, value in properties.items())
+    namespaces = "".join('\n    xmlns:{}="{}"'.format(prefix, uri) for prefix, uri in XMP_NAMESPACES.items())
+    return ('<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+            ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+            '  <rdf:Description rdf:about=""{}{}/>\n'
+            ' </rdf:RDF>\n'
+            '</x:xmpmeta>\n'
+            '<?xpacket end="w"?>').format(namespaces, attributes)
+
+
+def write_raster(file_path, bands, compress="DEFLATE", blocksize=256, overviews=True, tags=None):
+    """ Write one band (2D array) or a list of bands to a Cloud Optimized GeoTIFF
+
+    The bands are assembled in an in-memory dataset and copied with the COG
+    driver, which writes the tiles and overviews in a single pass. tags is
+    an optional meta.csv row ({column: value}) embedded in the file.
+    """
+    if isinstance(bands, np.ndarray) and bands.ndim == 2:
+        bands = [bands]
+    dtype = np.asarray(bands[0]).dtype
+    height, width = bands[0].shape[:2]
+    mem = gdal.GetDriverByName("MEM").Create("", width, height, len(bands), GDAL_TYPES[dtype])
+    for n, band in enumerate(bands):
+        mem.GetRasterBand(n+1).WriteArray(np.asarray(band))
+    if tags is not None:
+        mem.SetMetadata({str(k): str(v) for k, v in tags.items()
+                         if k not in ("SourceFile", "FileName") and not _is_missing(v)})
+        mem.SetMetadata([xmp_packet(tags)], "xml:XMP")
+    gdal.GetDriverByName("COG").CreateCopy(file_path, mem, options=creation_options(dtype, compress, blocksize, overviews))
+    mem = None
+
+
+def read_band(file_path, band=1):
+    """ Read one band of a raster as an array """
+    ds = gdal.Open(file_path)
+    array = ds.GetRasterBand(band).ReadAsArray()
+    ds = None
+    return array
+
+
+def read_bands(file_path):
+    """ Read all bands of a raster as a list of arrays """
+    ds = gdal.Open(file_path)
+    arrays = [ds.GetRasterBand(n+1).ReadAsArray() for n in range(ds.RasterCount)]
+    ds = None
+    return arrays
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Streaming reflectance export
+
+As DJI P4M does not provide the conversion parameter, p_nir, reflectance is
+estimated by normalizing the sunlight sensor adjusted values of the whole
+flight to [0,1]. Instead of holding every corrected band in memory until the
+global maximum is known, pass one spills each corrected band to a float32
+.npy file and tracks a running maximum. Pass two memory-maps each spill file,
+rescales it in place and exports it, so peak memory stays at about one frame
+regardless of flight size.
+"""
+
+import os
+import shutil
+import numpy as np
+
+from . import raster
+
+
+def spill_image(spill_dir, file_name, image):
+    """ Write a corrected image to a float32 spill file and return its maximum """
+    image = np.asarray(image, dtype=np.float32)
+    np.save(os.path.join(spill_dir, file_name + ".npy"), image)
+    return float(np.max(image))
+
+
+def export_spill(spill_dir, file_name, out_dir, I_max, write=raster.write_raster, **kwargs):
+    """ Rescale a spill file in place, write it to out_dir and remove it
+
+    Extra keyword arguments (e.g. tags) are passed to write.
+    """
+    spill_path = os.path.join(spill_dir, file_name + ".npy")
+    I_ref = np.load(spill_path, mmap_mode="r+")
+    I_ref /= np.float32(I_max)
+    write(os.path.join(out_dir, file_name), I_ref, **kwargs)
+    del I_ref
+    os.remove(spill_path)
+
+
+class ReflectanceSpill(object):
+    """ Two-pass normalization of corrected images through float32 spill files """
+
+    def __init__(self, spill_dir):
+        self.spill_dir = spill_dir
+        if os.path.exists(spill_dir):
+            shutil.rmtree(spill_dir)
+        os.makedirs(spill_dir)
+        self.file_names = []
+        self.I_max = -np.inf
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def add(self, file_name, image):
+        """ Pass one: spill a corrected image and update the running maximum """
+        self.I_max = max(self.I_max, spill_image(self.spill_dir, file_name, image))
+        self.file_names.append(file_name)
+
+    def extend(self, file_names, I_max):
+        """ Register images spilled by spill_image elsewhere (e.g. worker processes) """
+        self.I_max = max(self.I_max, I_max)
+        self.file_names.extend(file_names)
+
+    def export(self, out_dir, overwrite=False, write=raster.write_raster, tags=None):
+        """ Pass two: rescale every spill file in place and write it to out_dir
+
+        write is called as write(path, image) for each reflectance image, or
+        as write(path, image, tags=tags[file_name]) if tags are given.
+        Existing outputs are skipped unless overwrite is True. Spill files are
+        removed afterwards.
+        """
+        n_files = len(self.file_names)
+        for i, file_name in enumerate(self.file_names):
+            if overwrite or not os.path.exists(os.path.join(out_dir, file_name)):
+                print("Exporting image {} / {}: {}".format(i+1, n_files, file_name))
+                kwargs = {} if tags is None else {"tags": tags.get(file_name)}
+                export_spill(self.spill_dir, file_name, out_dir, self.I_max, write, **kwargs)
+        self.close()
+
+    def close(self):
+        """ Remove all remaining spill files """
+        self.file_names = []
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,270 @@
+"""
+Command line processing of DJI P4M image sets
+
+Runs the correction (1_DjiP4M_Correction.ipynb) and stacking
+(2_DjiP4M_Stacking.ipynb) stages with image sets processed in parallel, or
+both with "all". The stages are incremental: each output folder keeps a
+manifest of the fingerprints (input files and parameters) of its image
+sets, and only the sets whose fingerprint changed are processed again (see
+helper/pipeline.py). --overwrite processes all sets. --profile writes the
+time spent in each step, the peak memory and the ECC convergence of each
+set (see helper/profiling.py).
+
+Usage:
+    python process.py correct --folder C:\\UAV\\Projects\\DjiTest --workers 8
+    python process.py stack --folder C:\\UAV\\Projects\\DjiTest --workers 8
+    python process.py all --folder C:\\UAV\\Projects\\DjiTest --add-crop-pixels 20
+    python process.py all --folder C:\\UAV\\Projects\\DjiTest --profile --trace
+    python process.py stack --folder C:\\UAV\\Projects\\DjiTest --texture-tile 64 --min-cc 0.7 --features orb
+"""
+
+import os, shutil, argparse
+from collections import OrderedDict
+import pandas as pd
+
+import helper.metadata as metadata
+import helper.imageset as imageset
+import helper.reflectance as reflectance
+import helper.parallel as parallel
+import helper.pipeline as pipeline
+import helper.profiling as profiling
+
+
+def transfer_metadata(df, folder, exiftool_path=None, writeback=False):
+    """ Write meta.csv and optionally copy the tags into the image EXIF with exiftool
+
+    The raster writer already embeds the tags (GDAL metadata and XMP), the
+    writeback is only needed by tools that read EXIF tags. It runs through
+    one ExifTool process and only rewrites files whose tags differ.
+    """
+    df.to_csv(os.path.join(folder, "meta.csv"), index=False)
+    if not writeback:
+        return
+    file_tags = {}
+    for row in df.to_dict("records"):
+        if os.path.exists(row["SourceFile"]):
+            file_tags[row["SourceFile"]] = {k: v for k, v in row.items()
+                                            if k not in ("SourceFile", "FileName") and not pd.isnull(v)}
+    with metadata.MetadataWriter(exiftool_path) as writer:
+        changed = writer.write(file_tags)
+    print("Metadata written to {} / {} images".format(len(changed), len(file_tags)))
+
+
+def run_correction(args):
+    raw_dir = os.path.join(args.folder, "Raw")
+    refl_dir = os.path.join(args.folder, "Reflectance")
+    if args.overwrite and os.path.exists(refl_dir):
+        shutil.rmtree(refl_dir)
+    if not os.path.exists(refl_dir):
+        os.mkdir(refl_dir)
+
+    index = imageset.ImageSetIndex(raw_dir, args.bands)
+    print("Total number of image sets:", len(index))
+    for set_id, file_names in index.incomplete.items():
+        print("WARNING: skipping incomplete image set {}: {}".format(set_id, file_names))
+    if not len(index):
+        return
+
+    # Sets are corrected again when their raw images or the correction parameters changed
+    manifest = pipeline.StageManifest(refl_dir)
+    manifest.retain(index.sets)
+    fingerprints = OrderedDict((set_id, pipeline.files_fingerprint(raw_dir, file_names, args.add_crop_pixels))
+                               for set_id, file_names in index)
+    todo = index.subset(set_id for set_id, file_names in index
+                        if not manifest.is_current(set_id, fingerprints[set_id])
+                        or not all(os.path.exists(os.path.join(refl_dir, f)) for f in file_names))
+    maxima = OrderedDict((set_id, manifest.get(set_id)["I_max"]) for set_id in index.sets if set_id not in todo)
+    scales = OrderedDict((set_id, manifest.get(set_id)["scale"]) for set_id in maxima)
+    manifest.invalidate(todo)
+
+    with metadata.MetadataStore(os.path.join(args.folder, "meta_cache.json"), args.exiftool) as store:
+        with profiling.profiler.span("exiftool", "metadata"):
+            store.read(index.files())
+        df = index.metadata_frame(store, refl_dir)
+
+        print("Correcting {} image sets with {} workers...".format(len(todo), args.workers))
+        spill = reflectance.ReflectanceSpill(os.path.join(args.folder, "Spill"))
+        maxima.update(parallel.correct_sets(raw_dir, spill, todo, store, args.add_crop_pixels, args.workers,
+                                            args.chunk_size))
+    I_max = max(maxima.values())
+    tags = df.set_index("FileName", drop=False).to_dict("index")
+
+    print("Exporting reflectance images...")
+    parallel.export_reflectance(spill, refl_dir, True, args.workers, compress=args.compress, tags=tags, I_max=I_max)
+
+    # The flight maximum changed: the other sets are rescaled instead of corrected again
+    rescale = OrderedDict()
+    for set_id, scale in scales.items():
+        if scale != I_max:
+            rescale.setdefault(scale, []).append(set_id)
+    if rescale:
+        print("Rescaling {} image sets to the new flight maximum...".format(sum(len(s) for s in rescale.values())))
+        for scale, set_ids in rescale.items():
+            manifest.invalidate(set_ids)
+            parallel.rescale_files(refl_dir, [f for set_id in set_ids for f in index.sets[set_id]], scale / I_max,
+                                   args.workers, compress=args.compress, tags=tags)
+
+    for set_id in index.sets:
+        manifest.update(set_id, fingerprints[set_id], I_max=maxima[set_id], scale=I_max)
+    manifest.save()
+
+    with profiling.profiler.span("transfer", "metadata"):
+        transfer_metadata(df, refl_dir, args.exiftool, args.writeback)
+    print("Completed!")
+
+
+def stack_outputs(stack_dir, unstack_dir, set_id, failed):
+    """ Get the output files of a stacked set: the stacked image, or its bands that could not be aligned """
+    if failed:
+        return [os.path.join(unstack_dir, f) for f in failed]
+    return [os.path.join(stack_dir, "DJI_SET{}.TIF".format(set_id))]
+
+
+def alignment_options(args):
+    """ Get the BandAligner options of the texture mask and keypoint fallback """
+    return {"texture_tile": args.texture_tile, "texture_fraction": args.texture_fraction, "min_cc": args.min_cc,
+            "features": args.features}
+
+
+def run_stacking(args):
+    refl_dir = os.path.join(args.folder, "Reflectance")
+    stack_dir = os.path.join(args.folder, "Stacked")
+    unstack_dir = os.path.join(args.folder, "Unstacked")
+    for folder in (stack_dir, unstack_dir):
+        if args.overwrite and os.path.exists(folder):
+            shutil.rmtree(folder)
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+
+    meta_csv = pd.read_csv(os.path.join(refl_dir, "meta.csv")).set_index("FileName")
+    index = imageset.ImageSetIndex(refl_dir, args.bands)
+    print("Total number of image sets:", len(index))
+
+    # Stacked images take the metadata of their NIR band
+    nir_files = [next(f for f in file_names if meta_csv.loc[f, "BandName"] == "NIR") for set_id, file_names in index]
+    df = meta_csv.loc[nir_files].drop(columns="BandName").reset_index()
+    df["FileName"] = ["DJI_SET{}.TIF".format(set_id) for set_id in index.sets]
+    df["SourceFile"] = [os.path.join(stack_dir, f) for f in df["FileName"]]
+    df = df[["SourceFile", "FileName"] + [c for c in df.columns if c not in ("SourceFile", "FileName")]]
+    tags = dict(zip(index.sets, df.to_dict("records")))
+
+    # Sets are aligned again when their reflectance images or the alignment parameters changed. The
+    # correction fingerprint is used when available, so that a rescaled set is only rescaled here too.
+    refl_manifest = pipeline.StageManifest(refl_dir)
+    manifest = pipeline.StageManifest(stack_dir)
+    manifest.retain(index.sets)
+    align_options = alignment_options(args)
+    params = (args.ksize, args.n_iter, args.eps, args.levels, align_options)
+    fingerprints, scales = OrderedDict(), OrderedDict()
+    for set_id, file_names in index:
+        refl = refl_manifest.get(set_id)
+        if refl is None:
+            fingerprints[set_id] = pipeline.files_fingerprint(refl_dir, file_names, *params)
+            scales[set_id] = None
+        else:
+            fingerprints[set_id] = pipeline.fingerprint(refl["fingerprint"], *params)
+            scales[set_id] = refl["scale"]
+    done = OrderedDict()
+    for set_id in index.sets:
+        entry = manifest.get(set_id)
+        if (manifest.is_current(set_id, fingerprints[set_id])
+                and all(os.path.exists(f) for f in stack_outputs(stack_dir, unstack_dir, set_id, entry["failed"]))
+                and (entry["scale"] == scales[set_id] or None not in (entry["scale"], scales[set_id]))):
+            done[set_id] = entry
+    todo = index.subset(set_id for set_id in index.sets if set_id not in done)
+    manifest.invalidate(todo)
+    for set_id, file_names in todo.items():
+        # Outputs of the previous run, which may have failed differently
+        for file_path in stack_outputs(stack_dir, unstack_dir, set_id, []) + stack_outputs(stack_dir, unstack_dir,
+                                                                                          set_id, file_names):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    print("Aligning and stacking {} image sets with {} workers...".format(len(todo), args.workers))
+    band_names = meta_csv["BandName"].to_dict()
+    failed, stats = parallel.stack_sets(refl_dir, stack_dir, unstack_dir, todo, band_names,
+                                        args.ksize, args.n_iter, args.eps, args.workers, args.chunk_size,
+                                        args.levels, args.compress, tags, align_options)
+    if stats:
+        df_stats = pd.DataFrame(stats)
+        df_stats.to_csv(os.path.join(args.folder, "alignment_stats.csv"), index=False)
+        print("Aligned {} bands, {} did not converge, mean time {:.1f} s".format(
+            len(df_stats), int((~df_stats["converged"]).sum()), df_stats["seconds"].mean()))
+
+    # Unchanged sets whose reflectance was rescaled are rescaled the same way
+    rescale = OrderedDict()
+    for set_id, entry in done.items():
+        if entry["scale"] != scales[set_id]:
+            folder = unstack_dir if entry["failed"] else stack_dir
+            rescale.setdefault((folder, entry["scale"] / scales[set_id]), []).append(set_id)
+    if rescale:
+        print("Rescaling {} stacked image sets...".format(sum(len(s) for s in rescale.values())))
+        stack_tags = {"DJI_SET{}.TIF".format(set_id): set_tags for set_id, set_tags in tags.items()}
+        for (folder, factor), set_ids in rescale.items():
+            manifest.invalidate(set_ids)
+            file_names = [os.path.basename(f) for set_id in set_ids
+                          for f in stack_outputs(stack_dir, unstack_dir, set_id, done[set_id]["failed"])]
+            parallel.rescale_files(folder, file_names, factor, args.workers, compress=args.compress, tags=stack_tags)
+
+    for set_id in index.sets:
+        set_failed = failed[set_id] if set_id in failed else done[set_id]["failed"]
+        manifest.update(set_id, fingerprints[set_id], scale=scales[set_id], failed=set_failed)
+        for file_name in set_failed:
+            print("ERROR: {} could not be aligned".format(file_name))
+    manifest.save()
+
+    with profiling.profiler.span("transfer", "metadata"):
+        transfer_metadata(df, stack_dir, args.exiftool, args.writeback)
+    print("Completed!")
+
+
+def write_profile(args):
+    """ Print the timing summary and write profile.json / profile.csv (and profile_trace.json) to the folder """
+    profiler = profiling.profiler
+    profiler.sample_memory()
+    print(profiler.report())
+    profiler.write_json(os.path.join(args.folder, "profile.json"), parameters=vars(args))
+    profiler.write_csv(os.path.join(args.folder, "profile.csv"))
+    if args.trace:
+        profiler.write_chrome_trace(os.path.join(args.folder, "profile_trace.json"))
+
+
+STAGES = OrderedDict([("correct", run_correction), ("stack", run_stacking)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument('stage', choices=list(STAGES) + ['all'])
+    parser.add_argument('--folder', '-f', type=str, required=True, help="survey folder containing the Raw folder")
+    parser.add_argument('--bands', type=int, default=5)
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=4, help="image sets per task")
+    parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--compress', type=str, default="DEFLATE", choices=["DEFLATE", "ZSTD", "LZW"],
+                        help="compression of the output COGs")
+    parser.add_argument('--exiftool', type=str, default=None, help="path to the exiftool executable")
+    parser.add_argument('--writeback', action='store_true', help="also write the tags as EXIF with exiftool")
+    parser.add_argument('--add-crop-pixels', type=int, default=10)
+    parser.add_argument('--ksize', type=int, default=5)
+    parser.add_argument('--n-iter', type=int, default=2500)
+    parser.add_argument('--eps', type=float, default=1e-9)
+    parser.add_argument('--levels', type=int, default=3, help="image pyramid levels for band alignment")
+    parser.add_argument('--texture-tile', type=int, default=0,
+                        help="align on the most textured tiles of this size (e.g. 64 for water), default: whole image")
+    parser.add_argument('--texture-fraction', type=float, default=0.3, help="fraction of the tiles used for alignment")
+    parser.add_argument('--min-cc', type=float, default=None, help="reject ECC below this correlation (e.g. 0.7)")
+    parser.add_argument('--features', type=str, default=None, choices=["orb", "akaze"],
+                        help="keypoint homography fallback for the bands where ECC fails")
+    parser.add_argument('--profile', action='store_true', help="write step timings and memory to profile.json / .csv")
+    parser.add_argument('--trace', action='store_true', help="with --profile, also write a Chrome trace")
+    args = parser.parse_args()
+
+    for stage in (STAGES if args.stage == 'all' else [args.stage]):
+        with profiling.profiler.span(stage, "stage"):
+            STAGES[stage](args)
+    if args.profile:
+        write_profile(args)
+
+
+if __name__ == '__main__':
+    main()